@@ -1,9 +1,11 @@
 import streamlit as st
 from datetime import datetime
+import hashlib
 import html
+import os
 import textwrap
-import json
-import re
+import time
+import uuid
 
 # ============================================
 # ページ設定（アプリの最重要設定：最優先で実行）
@@ -16,15 +18,60 @@ st.set_page_config(
 )
 
 # 外部ロジックをインポート
-from openai_logic import generate_email_with_openai
+from openai_logic import (
+    PARALLEL_GENERATION,
+    PATTERN_FAILED_MARK,
+    STRUCTURED_OUTPUT,
+    get_cached_email,
+    iter_patterns_parallel,
+    iter_patterns_structured,
+    iter_refine_patterns,
+    openai_available,
+    stream_email_with_openai,
+)
+from pattern_parser import (
+    PatternRecord,
+    PatternStreamParser,
+    parse_pattern_block,
+    parse_patterns,
+    split_pattern_blocks,
+)
+
+from jobs_logic import (
+    CANCELLED,
+    DONE,
+    PRIORITY_HIGH,
+    PRIORITY_NORMAL,
+    JobCancelled,
+    JobQueueFull,
+    job_queue,
+)
+from resilience_logic import HedgedIterator
+from quota_logic import quota_tracker
+from similar_logic import SIMILAR_MODE, similar_index
+from chat_log import CHAT_LOG_WINDOW, CHAT_LOG_WINDOW_STEP, ChatLog
+from copy_component import copy_events
+from metrics_logic import span, start_exporters, trace
+from static_assets import inject_assets, picture_html
+from template_registry import get_registry
 
 # DB保存ロジック（あれば使う）
 try:
-    from db_logic import save_email_batch, log_copy_click
+    from db_logic import save_email_batch, log_copy_click, load_similar_index
     HAS_DB = True
 except ImportError:
     HAS_DB = False
 
+# メトリクスの書き出し（ARKY_METRICS_FILE / ARKY_METRICS_PORT。プロセスで1回だけ）
+start_exporters()
+
+# 類似リクエスト用インデックスを読み込む（プロセスで1回だけ。失敗したら間隔をあけて再試行）
+if HAS_DB and SIMILAR_MODE != "off":
+    try:
+        load_similar_index()
+    except Exception as e:
+        print("[app] 類似リクエスト用インデックスの読み込みに失敗しました:", e)
+
 
 # ============================================
 # 時候の挨拶（ヘルパー）
@@ -49,68 +96,293 @@ def get_seasonal_greeting() -> str:
 
 
 # ============================================
-# AI パターンブロックを分解するヘルパー
+# プレビューカードの HTML を組み立てるヘルパー
 # ============================================
-def parse_pattern_block(block: str) -> dict:
+def build_pattern_card_html(idx: int, parsed: dict, status: str | None = None) -> str:
     """
-    openai_logic から返ってきた 1 パターン分の Markdown テキストから、
-    件名／本文／改善点／注意点 をざっくり抽出する。
+    parse_pattern_block の結果から、右カラムのプレビューカード HTML を作る。
+    status（例：「✨ 生成中…」）を渡すと、コピーアイコンの代わりにその表示を出す。
     """
-    # 先頭の "## パターンX" 行を削除
-    block = re.sub(r"^##\s*パターン[^\n]*\n?", "", block, count=1, flags=re.MULTILINE)
-
-    subject = ""
-    body = ""
-    improve = ""
-    caution = ""
-
-    # 件名
-    m = re.search(r"件名[:：]\s*(.+)", block)
-    if m:
-        subject = m.group(1).strip()
-
-    # "本文:" 以降を切り出し
-    pos_body_label = block.find("本文:")
-    if pos_body_label != -1:
-        rest = block[pos_body_label + len("本文:") :]
+    subj = html.escape(parsed["subject"] or "").replace("\n", "<br>")
+    body = html.escape(parsed["body"] or "").replace("\n", "<br>")
+    improve = html.escape(parsed["improve"] or "").replace("\n", "<br>")
+    caution = html.escape(parsed["caution"] or "").replace("\n", "<br>")
+
+    if status:
+        header_right = f'<span class="preview-section-label">{html.escape(status)}</span>'
     else:
-        rest = block
+        header_right = f"""<span class="pattern-copy-icon"
+                          data-pattern="{idx}"
+                          title="メッセージをコピーします">
+                      📋 テキストコピー
+                    </span>"""
 
-    # 改善点・注意点の位置
-    idx_improve = rest.find("- 改善点")
-    idx_caution = rest.find("- 注意点")
+    return f"""
+                <div class="preview-main-wrapper">
+                  <div class="preview-header">
+                    <span></span>
+                    {header_right}
+                  </div>
 
-    # 本文
-    if idx_improve != -1:
-        body = rest[:idx_improve].strip()
-        rest2 = rest[idx_improve:]
-    else:
-        body = rest.strip()
-        rest2 = ""
-
-    # 改善点・注意点
-    if rest2:
-        if idx_caution != -1 and rest2.find("- 注意点") > -1:
-            split_pos = rest2.find("- 注意点")
-            improve_block = rest2[:split_pos].strip()
-            caution_block = rest2[split_pos:].strip()
-        else:
-            improve_block = rest2.strip()
-            caution_block = ""
-    else:
-        improve_block = ""
-        caution_block = ""
+                  <div style="margin-top:4px;">
+                    <div class="preview-section-label">件名</div>
+                    <div class="preview-subject">{subj}</div>
+                  </div>
 
-    # ラベル部分を削る
-    improve = re.sub(r"^-+\s*改善点[:：]?\s*", "", improve_block, flags=re.MULTILINE).strip()
-    caution = re.sub(r"^-+\s*注意点[:：]?\s*", "", caution_block, flags=re.MULTILINE).strip()
+                  <div style="margin-top:12px;">
+                    <div class="preview-section-label">本文</div>
+                    <div class="preview-body">{body}</div>
+                  </div>
 
-    return {
-        "subject": subject,
-        "body": body,
-        "improve": improve,
-        "caution": caution,
-    }
+                  <div style="margin-top:12px;">
+                    <div class="preview-section-label">改善点</div>
+                    <div class="preview-note-body">{improve}</div>
+                  </div>
+
+                  <div style="margin-top:12px;">
+                    <div class="preview-section-label">注意点</div>
+                    <div class="preview-note-body">{caution}</div>
+                  </div>
+                </div>
+                """
+
+
+# 生成ジョブの途中経過を見に行く間隔（秒）。render_generation_job だけがこの間隔で再実行される
+JOB_POLL_INTERVAL_SEC = float(os.getenv("ARKY_JOB_POLL_INTERVAL_SEC", "0.5"))
+
+# ログインしていないユーザーを見分けるブラウザのクッキー名（assets/arky_identity.js と同じ）
+USER_COOKIE = "arky_uid"
+
+# プレビューカードの状態表示
+STREAMING_STATUS = "✨ 生成中…"
+SIMILAR_DRAFT_STATUS = "📝 類似リクエストの下書き（AI生成中…）"
+PROVISIONAL_STATUS = "📝 仮の下書き（AI生成中…）"
+
+# 生成ジョブの最初の表示（まだ何も届いていないタブ）
+SKELETON_CARD = {"subject": "…", "body": "…", "improve": "", "caution": ""}
+
+# ヘッジ：AI の最初の応答がこの秒数までに届かなければ、仮の下書きを先に表示する（0 で無効）
+HEDGE_BUDGET_SEC = float(os.getenv("ARKY_HEDGE_BUDGET_SEC", "2.5"))
+# これを過ぎたら AI を待つのをやめ、届いていないパターンは仮の下書きのまま確定する
+HEDGE_DEADLINE_SEC = float(os.getenv("ARKY_HEDGE_DEADLINE_SEC", "45"))
+
+# 仮の下書きが残ったときにプレビューの上に出す案内
+PROVISIONAL_NOTICE = (
+    "⚠️ AI の応答が得られなかったパターンは、仮の下書きを表示しています。"
+    "しばらくしてから再度送信すると、AI の文面に置き換わります。"
+)
+# ローカル下書き（generate_email）の注意点欄
+LOCAL_DRAFT_CAUTION = (
+    "AI の応答が遅れているため、定型文から作った仮の下書きです。"
+    "日時・固有名詞などの具体的な内容を書き足してからお使いください。"
+)
+
+
+def generation_card(i: int, progress: dict, pending: dict, elapsed: float) -> tuple:
+    """
+    生成ジョブの途中経過から、i 番目のタブに出すカードの内容と状態表示を決める。
+    AI の文面 → 選ばなかったパターン（一部だけのリライト）→ 類似リクエスト・仮の下書き
+    → スケルトンの順。
+    """
+    stream = progress.get("stream")
+    if stream is not None and i < len(stream):
+        streaming = i >= progress.get("completed", 0)
+        return parse_pattern_block(stream[i]), STREAMING_STATUS if streaming else None
+    block = progress.get("blocks", {}).get(i)
+    if block is not None and PATTERN_FAILED_MARK not in block:
+        return parse_pattern_block(block), None
+
+    fallback_blocks = pending["fallback_blocks"]
+    if i < len(fallback_blocks):
+        fallback = parse_pattern_block(fallback_blocks[i])
+        if pending["partial_targets"] and i not in pending["partial_targets"]:
+            return fallback, None
+        if pending["similar"]:
+            return fallback, SIMILAR_DRAFT_STATUS
+        if HEDGE_BUDGET_SEC > 0 and elapsed >= HEDGE_BUDGET_SEC:
+            return fallback, PROVISIONAL_STATUS
+    return SKELETON_CARD, STREAMING_STATUS
+
+
+# ============================================
+# 生成結果をセッションに保存するヘルパー
+# ============================================
+def set_ai_suggestions(
+    ai_text: str | None, provisional: bool = False, patterns: list | None = None
+) -> None:
+    """
+    AI の出力（Markdown）と、その解析結果（PatternRecord のリスト）を
+    セッションに一緒に保存する。再実行のたびに解析し直さないようにするため。
+    provisional=True は、仮の下書きが混ざっている（AI の応答が得られなかった）印。
+    patterns に解析済みの結果（生成ジョブで解析したもの）を渡せば解析し直さない。
+    """
+    st.session_state.ai_suggestions = ai_text
+    if patterns is None and ai_text:
+        with span("parse"):
+            patterns = parse_patterns(ai_text)
+    st.session_state.ai_patterns = patterns if ai_text else None
+    st.session_state.ai_provisional = provisional
+
+
+# ============================================
+# フォームのコールバック（スクリプト本体より先に実行される）
+# ============================================
+def on_submit() -> None:
+    """
+    送信ボタンの on_click。
+    入力が揃っていれば、この run の冒頭からサイドバーをロックしておく
+    （生成後に st.rerun() でスクリプト全体をもう一度実行しなくて済むように）。
+    """
+    ss = st.session_state
+    if not ss.get("user_message_input"):
+        return
+    if ss.get("template_radio") == "➕ その他" and not ss.get("custom_template_input"):
+        return
+    if ss.get("recipient_radio") == "➕ その他" and not ss.get("custom_recipient_input"):
+        return
+    ss.nav_lock_requested = True
+
+
+def cancel_generation() -> None:
+    """生成中の「キャンセル」ボタンの on_click。前回までの結果はそのまま残す。"""
+    pending = st.session_state.generation_job
+    if pending is None:
+        return
+    job_queue.cancel(pending["id"])
+    st.session_state.generation_job = None
+    st.session_state.messages.append("assistant", "生成をキャンセルしました。")
+
+
+def reset_session() -> None:
+    """リセットボタンの on_click。描画前に状態を消すので st.rerun() は不要。"""
+    if st.session_state.generation_job is not None:
+        job_queue.cancel(st.session_state.generation_job["id"])
+        st.session_state.generation_job = None
+    st.session_state.messages.clear()
+    st.session_state.chat_log_window = CHAT_LOG_WINDOW
+    st.session_state.last_user_message = ""
+    st.session_state.generated_email = None
+    set_ai_suggestions(None)
+    st.session_state.variation_count = 0
+
+
+def show_older_messages() -> None:
+    """チャットログの「以前のメッセージを表示」の on_click。"""
+    st.session_state.chat_log_window += CHAT_LOG_WINDOW_STEP
+
+
+# ============================================
+# 部分再実行（フラグメント）
+# ============================================
+# コピーのクリックなどでは、サイドバー・フォーム・CSS を含むスクリプト全体ではなく
+# 該当するフラグメントだけが再実行される。
+@st.fragment
+def render_chat_log() -> None:
+    """左カラム下部のチャットログ。"""
+    # 末尾 chat_log_window 件だけを DOM に出す。古いものはボタンで少しずつ表示する
+    # （ボタンはフラグメント内なので、押してもチャットログだけが再実行される）
+    log = st.session_state.messages
+    window = st.session_state.chat_log_window
+    hidden = log.hidden_count(window)
+    if hidden:
+        st.button(
+            f"以前のメッセージを表示（残り {hidden} 件）",
+            key="chat_log_more",
+            on_click=show_older_messages,
+        )
+    st.markdown(log.window_html(window), unsafe_allow_html=True)
+
+
+@st.fragment
+def render_preview() -> None:
+    """右カラム：AIが作った3パターンのプレビュー（タブ表示）。"""
+    ai_text = st.session_state.ai_suggestions
+
+    if not ai_text:
+        placeholder_html = textwrap.dedent(
+            """
+            <div class="preview-main-wrapper">
+                <p><em>メッセージを送信すると、ここにAIが生成した3パターンのプレビューが表示されます。</em></p>
+            </div>
+            """
+        )
+        st.markdown(placeholder_html, unsafe_allow_html=True)
+        return
+
+    # 解析結果は ai_suggestions と一緒にセッションに保存済み（再実行で解析し直さない）
+    patterns = st.session_state.ai_patterns
+    if patterns is None:
+        set_ai_suggestions(ai_text)
+        patterns = st.session_state.ai_patterns
+
+    if st.session_state.ai_provisional:
+        st.markdown(
+            f"<div class='preview-provisional-note'>{html.escape(PROVISIONAL_NOTICE)}</div>",
+            unsafe_allow_html=True,
+        )
+
+    # タブ生成
+    tab_labels = [f"パターン {i + 1}" for i in range(len(patterns))]
+    tabs = st.tabs(tab_labels)
+
+    for idx, (tab, pattern) in enumerate(zip(tabs, patterns)):
+        with tab:
+            with span("render_html"):
+                card_html = build_pattern_card_html(idx, pattern.as_dict())
+            st.markdown(card_html, unsafe_allow_html=True)
+            st.markdown("<div style='height: 16px;'></div>", unsafe_allow_html=True)
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL_SEC)
+def render_generation_job() -> None:
+    """
+    右カラム：生成ジョブの途中経過（届いたパターン・仮の下書き・スケルトン）。
+    JOB_POLL_INTERVAL_SEC ごとにこのフラグメントだけが再実行されてジョブを見に行き、
+    終わったら結果をセッションに入れてアプリ全体を1回だけ再実行する。
+    """
+    pending = st.session_state.generation_job
+    job = job_queue.get(pending["id"]) if pending else None
+    if job is None or job.finished:
+        finish_generation_job(job, pending)
+        st.rerun()
+
+    progress = job.progress()
+    elapsed = time.time() - job.created_at
+    st.markdown(
+        """
+        <div class="intro-bubble" style="margin-bottom: 8px;">
+          <span class="intro-bubble-text">✨ メッセージを生成しています… 数秒お待ちください。</span>
+        </div>
+        """,
+        unsafe_allow_html=True,
+    )
+    tabs = st.tabs([f"パターン {i + 1}" for i in range(3)])
+    with span("render_html"):
+        for i, tab in enumerate(tabs):
+            parsed, status = generation_card(i, progress, pending, elapsed)
+            tab.markdown(build_pattern_card_html(i, parsed, status=status), unsafe_allow_html=True)
+
+
+@st.fragment
+def render_copy_logger(copy_texts: list, template: str, tone: str, recipient: str) -> None:
+    """
+    コピー用コンポーネント（copy_component.py）を描画し、届いたコピーイベントを記録する。
+    コピー自体はブラウザだけで行い、イベントはまとめて届くので、
+    再実行はこのフラグメントだけ・数クリックに1回で済む。
+    """
+    for event in copy_events(copy_texts):
+        if not HAS_DB:
+            continue
+        try:
+            log_copy_click(
+                template=template,
+                tone=tone,
+                recipient=recipient,
+                pattern_index=int(event["id"]) + 1,
+            )
+        except Exception as e:
+            st.error(f"コピー履歴の保存に失敗しました: {e}")
+            break
 
 
 # ============================================
@@ -124,851 +396,226 @@ def generate_email(
     variation=0,
     seasonal_text: str | None = None,
 ):
-    subject_variations = {
-        "依頼": [
-            f"【ご依頼】{message[:20]}",
-            f"【お願い】{message[:20]}",
-            f"{message[:20]}についてのご依頼",
-        ],
-        "提案": [
-            f"【ご提案】{message[:20]}",
-            f"{message[:20]}に関するご提案",
-            f"ご提案の件：{message[:20]}",
-        ],
-        "お礼": [
-            f"お礼申し上げます - {message[:15]}",
-            f"感謝の気持ちをお伝えいたします - {message[:15]}",
-            f"御礼 - {message[:15]}",
-        ],
-        "謝罪": [
-            f"お詫び申し上げます - {message[:15]}",
-            f"深くお詫び申し上げます - {message[:15]}",
-            f"謹んでお詫び申し上げます - {message[:15]}",
-        ],
-        "挨拶": [
-            f"ご挨拶 - {message[:20]}",
-            f"ご挨拶申し上げます - {message[:20]}",
-            f"{message[:20]}",
-        ],
-    }
-    template_subjects = subject_variations.get(
+    """ローカル下書き。文面は templates/email_templates.json（template_registry.py）。"""
+    return get_registry().render(
         template,
-        [f"{template} - {message[:20]}"],
+        recipient,
+        message,
+        variation=variation,
+        seasonal_text=seasonal_text,
     )
-    subject = template_subjects[variation % len(template_subjects)]
 
-    greetings_variations = {
-        "上司": [
-            "お疲れ様です。",
-            "お疲れ様でございます。",
-            "いつもお世話になっております。",
-        ],
-        "同僚": [
-            "お疲れ様です。",
-            "お疲れさまです。",
-            "こんにちは。",
-        ],
-        "部下": [
-            "お疲れ様です。",
-            "お疲れ様。",
-            "こんにちは。",
-        ],
-        "社外企業社員": [
-            "いつもお世話になっております。",
-            "平素より大変お世話になっております。",
-            "お世話になっております。",
-        ],
-        "取引先": [
-            "いつもお世話になっております。",
-            "平素より格別のご高配を賜り、厚く御礼申し上げます。",
-            "お世話になっております。",
-        ],
-    }
-    greeting_list = greetings_variations.get(recipient, ["お世話になっております。"])
-    base_greeting = greeting_list[variation % len(greeting_list)]
 
-    if seasonal_text:
-        greeting = f"{seasonal_text}、{base_greeting}"
-    else:
-        greeting = base_greeting
+def build_local_drafts(template, tone, recipient, message, seasonal_text=None) -> str:
+    """generate_email の variation 0〜2 を「## パターンN」形式の Markdown にまとめる。"""
+    records = []
+    for variation in range(3):
+        draft = generate_email(
+            template,
+            tone,
+            recipient,
+            message,
+            variation=variation,
+            seasonal_text=seasonal_text,
+        )
+        records.append(
+            PatternRecord(
+                index=variation + 1,
+                subject=draft["subject"],
+                body=draft["body"],
+                improve=draft["advice"],
+                caution=LOCAL_DRAFT_CAUTION,
+            )
+        )
+    return "\n\n".join(r.to_markdown() for r in records)
 
-    body_variations = [
-        f"""{greeting}
 
-{message}に関しまして、ご連絡させていただきます。
+def merge_with_fallback(ai_blocks: dict, fallback_blocks: list) -> tuple:
+    """
+    届いた AI のパターンと仮の下書きを合わせた Markdown と、
+    下書きを1つでも使ったかどうかを返す（失敗したパターンも下書きに差し替える）。
+    """
+    blocks = []
+    used_fallback = False
+    for i in range(max(len(fallback_blocks), max(ai_blocks, default=-1) + 1)):
+        block = ai_blocks.get(i)
+        if (block is None or PATTERN_FAILED_MARK in block) and i < len(fallback_blocks):
+            block = fallback_blocks[i]
+            used_fallback = True
+        if block is not None:
+            blocks.append(block)
+    return "\n\n".join(blocks), used_fallback
+
+
+def run_generation_job(
+    job,
+    gen_kwargs: dict,
+    partial_targets: list | None,
+    fallback_blocks: list,
+    db_kwargs: dict | None,
+) -> dict:
+    """
+    生成ジョブの本体（jobs_logic のワーカースレッドで動くので st.* は呼ばない）。
+    届いたパターンは job.update() で途中経過として書き、render_generation_job が描く。
+    締め切りまでに届かなかったパターンは仮の下書きで補い、AI の結果だけのときは DB にも保存する。
+    """
+    ai_text = None
+    if partial_targets or STRUCTURED_OUTPUT or PARALLEL_GENERATION:
+        # 一部だけのリライト／JSON モード／並列生成：確定したパターンから順に届く
+        if partial_targets:
+            # 選ばなかったパターンは前回のまま確定
+            ai_blocks = {
+                i: block for i, block in enumerate(fallback_blocks) if i not in partial_targets
+            }
 
-詳細につきましては、下記のとおりとなります。
-ご確認いただけますと幸いです。
+            # 一部だけのリライトは常に再生成なので、is_refine は渡さない
+            refine_kwargs = {k: v for k, v in gen_kwargs.items() if k != "is_refine"}
 
-お忙しいところ恐縮ですが、
-""",
-        f"""{greeting}
+            def factory():
+                return iter_refine_patterns(pattern_indexes=partial_targets, **refine_kwargs)
 
-{message}の件につきまして、ご連絡申し上げます。
+        else:
+            ai_blocks = {}
+            pattern_iter = iter_patterns_structured if STRUCTURED_OUTPUT else iter_patterns_parallel
 
-詳細は以下のとおりでございます。
-ご確認のほど、何卒よろしくお願い申し上げます。
+            def factory():
+                return pattern_iter(**gen_kwargs)
 
-ご多忙中誠に恐縮ではございますが、
-""",
-        f"""{greeting}
+        hedge = HedgedIterator(
+            factory, budget_sec=0, deadline_sec=HEDGE_DEADLINE_SEC, cancel_event=job.cancel_event
+        )
+        for idx, block in hedge:
+            ai_blocks[idx] = block
+            job.update(blocks=dict(ai_blocks))
+    else:
+        parser = PatternStreamParser(max_patterns=3)
+        hedge = HedgedIterator(
+            lambda: stream_email_with_openai(**gen_kwargs),
+            budget_sec=0,
+            deadline_sec=HEDGE_DEADLINE_SEC,
+            cancel_event=job.cancel_event,
+        )
+        for chunk in hedge:
+            parser.feed(chunk)
+            job.update(stream=list(parser.blocks), completed=parser.completed_count)
 
-{message}についてご連絡いたします。
+        if hedge.error is None and not hedge.timed_out and not hedge.cancelled:
+            parser.finish()
+            ai_text = parser.text
+        else:
+            # 途中で切れた場合は、最後まで届いたパターンだけを使う
+            ai_blocks = {i: parser.blocks[i] for i in range(parser.completed_count)}
 
-下記の内容をご確認ください。
+    if hedge.cancelled:
+        raise JobCancelled()
 
-お手数をおかけいたしますが、
-""",
-    ]
-    body_start = body_variations[variation % len(body_variations)]
+    if ai_text is None:
+        if hedge.error or hedge.timed_out:
+            print(
+                f"[app] AI 生成が完了しなかったため、仮の下書きで補います: "
+                f"{hedge.error or 'deadline exceeded'}"
+            )
+        ai_text, provisional = merge_with_fallback(ai_blocks, fallback_blocks)
+    else:
+        provisional = False
+
+    with span("parse"):
+        patterns = parse_patterns(ai_text)
+
+    # 仮の下書きが混ざった結果は AI の生成結果として保存しない
+    saved, db_error = False, None
+    if db_kwargs is not None and not provisional:
+        try:
+            with span("db_save"):
+                save_email_batch(
+                    patterns=[{"subject": p.subject, "body": p.body} for p in patterns],
+                    **db_kwargs,
+                )
+            saved = True
+        except Exception as e:
+            db_error = str(e)
 
-    closings_variations = {
-        "上司": [
-            "ご確認のほど、よろしくお願いいたします。",
-            "ご査収のほど、よろしくお願い申し上げます。",
-            "ご検討のほど、よろしくお願いいたします。",
-        ],
-        "同僚": [
-            "よろしくお願いします。",
-            "ご確認お願いします。",
-            "よろしくね。",
-        ],
-        "部下": [
-            "よろしくお願いします。",
-            "確認しておいてください。",
-            "よろしく。",
-        ],
-        "社外企業社員": [
-            "ご検討のほど、よろしくお願い申し上げます。",
-            "ご確認の上、ご返信いただけますと幸いです。",
-            "何卒よろしくお願いいたします。",
-        ],
-        "取引先": [
-            "ご検討のほど、よろしくお願い申し上げます。",
-            "ご査収のほど、何卒よろしくお願い申し上げます。",
-            "ご確認のほど、よろしくお願いいたします。",
-        ],
+    return {
+        "text": ai_text,
+        "patterns": patterns,
+        "provisional": provisional,
+        "saved": saved,
+        "db_error": db_error,
     }
-    closing_list = closings_variations.get(recipient, ["よろしくお願いいたします。"])
-    closing = closing_list[variation % len(closing_list)]
 
-    body = body_start + closing
 
-    advices = {
-        "依頼": "依頼メールでは、具体的な内容と期限を明記することで、相手が対応しやすくなります。簡潔で丁寧な表現を心掛けましょう。",
-        "提案": "提案メールでは、双方にメリットがある提案を心掛けましょう。相手の立場を考慮した表現が重要です。",
-        "お礼": "お礼メールは迅速に送ることで、誠意が伝わります。具体的に何に対する感謝なのかを明記しましょう。",
-        "謝罪": "謝罪メールでは、具体的な理由と今後の対策を含めることで、誠実さが伝わります。責任を明確にすることが大切です。",
-        "挨拶": "挨拶メールは、簡潔で丁寧な表現を心掛けましょう。相手との関係性に応じた適切なトーンを選びましょう。",
-    }
-    advice = advices.get(template, "メールは簡潔で丁寧な表現を心掛けましょう。")
+def finish_generation_job(job, pending: dict | None) -> None:
+    """終わった（または見つからなくなった）生成ジョブの結果をセッションに反映する。"""
+    st.session_state.generation_job = None
+    if job is not None and job.status == CANCELLED:
+        return
+    if job is not None and job.status == DONE:
+        result = job.result
+        set_ai_suggestions(
+            result["text"], provisional=result["provisional"], patterns=result["patterns"]
+        )
+        if result["saved"]:
+            st.session_state.generation_notice = (
+                "success",
+                "✅ メッセージの生成が完了し、データベースに保存しました！",
+            )
+        elif result["db_error"]:
+            st.session_state.generation_notice = ("error", f"❌ DB保存エラー: {result['db_error']}")
+        return
 
-    return {
-        "subject": subject,
-        "body": body,
-        "advice": advice,
-        "variation": variation,
-    }
+    # ジョブが失敗した／期限切れで消えた：仮の下書きで確定する
+    print(f"[app] 生成ジョブが完了しませんでした: {job.error if job is not None else '期限切れ'}")
+    if pending is not None:
+        ai_text, _ = merge_with_fallback({}, pending["fallback_blocks"])
+        set_ai_suggestions(ai_text, provisional=True)
 
 
-# ============================================
-# カスタムCSS（元コードそのまま）
-# ============================================
-st.markdown(
+def _hashed(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:12]
+
+
+def resolve_user_key() -> tuple:
     """
-<style>
-* { box-sizing: border-box; }
-
-/* 全体背景：濃い紺色 + ARKY背景画像 */
-.stApp {
-    background-color: #050b23;
-    position: relative;
-}
-.stApp::before {
-    content: '';
-    position: fixed;
-    top: 0;
-    left: 450px;
-    right: 0;
-    height: 100%;
-
-    background-image: url('https://raw.githubusercontent.com/smzk13tp5kg/ARKY/main/ARKYappbackgroundimage.png');
-    background-size: contain;
-    background-position: center top;
-    background-repeat: no-repeat;
-
-    opacity: 0.4;
-    z-index: 0;
-    pointer-events: none;
-}
-
-[data-testid="stAppViewContainer"] {
-    background-color: transparent;
-    position: relative;
-    z-index: 1;
-}
-
-body { background-color: #050b23; }
-
-/* ツールバー消す */
-div[data-testid="stToolbar"] {
-    height: 0 !important;
-    min-height: 0 !important;
-    padding-top: 0 !important;
-    padding-bottom: 0 !important;
-    overflow: hidden !important;
-}
-div[data-testid="stToolbar"] > div {
-    display: none !important;
-}
-
-/* メインエリア調整 */
-main.block-container {
-    padding-top: 0rem;
-    padding-left: 2.0rem !important;
-    padding-right: 2.0rem !important;
-    max-width: 100% !important;
-}
-
-/* カラムレイアウト */
-[data-testid="column"] {
-    padding: 0 !important;
-    width: 100% !important;
-    min-width: 0 !important;
-}
-div[data-testid="stHorizontalBlock"] {
-    gap: 0.5rem !important;
-    width: 100% !important;
-}
-[data-testid="stVerticalBlock"] > div {
-    max-width: 100% !important;
-}
-
-/* -------------------------------------------
-   サイドバー
-------------------------------------------- */
-[data-testid="stSidebar"] {
-    width: 400px !important;
-    min-width: 400px !important;
-    max-width: 400px !important;
-    background: #050b23;
-    border-right: 1px solid #cfae63;
-}
-
-/* サイドバーの開閉ボタン（≪アイコン）の色設定 */
-[data-testid="stSidebar"] [data-testid="collapsedControl"] {
-    color: #cfae63 !important;
-}
-[data-testid="stSidebar"] [data-testid="collapsedControl"] svg {
-    color: #cfae63 !important;
-    fill: #cfae63 !important;
-}
-
-/* サイドバー内のテキストは白色 */
-[data-testid="stSidebar"] label,
-[data-testid="stSidebar"] span:not([data-testid="collapsedControl"] span),
-[data-testid="stSidebar"] div:not([data-testid="collapsedControl"]),
-[data-testid="stSidebar"] p {
-    color: #ffffff !important;
-}
-
-/* ラジオボタンのラベルテキストも白 */
-[data-testid="stSidebar"] .stRadio label {
-    color: #ffffff !important;
-}
-
-/* 開閉ボタン内のテキストだけゴールド */
-[data-testid="stSidebar"] [data-testid="collapsedControl"] span {
-    color: #cfae63 !important;
-}
-
-/* サイドバー上部ヘッダー縮小 */
-[data-testid="stSidebarHeader"] {
-    min-height: 0 !important;
-    height: 0 !important;
-    padding-top: 0 !important;
-    padding-bottom: 0 !important;
-}
-[data-testid="stSidebarContent"] {
-    padding-top: 0px !important;
-}
-
-/* -------------------------------------------
-   すべてのボタン：3D フリップスタイル
-------------------------------------------- */
-.stButton,
-.stFormSubmitButton {
-  perspective: 1000px;
-  display: inline-block;
-  width: 100%;
-}
-
-.stButton > button,
-.stFormSubmitButton > button {
-  position: relative;
-  width: 100%;
-  height: 50px;
-  font-size: 1.0rem;
-  font-weight: 700;
-  text-transform: uppercase;
-  cursor: pointer;
-  border: none;
-  background: transparent;
-  transform-style: preserve-3d;
-  transform: translateZ(-25px);
-  transition: transform 0.25s;
-  color: transparent !important;
-}
-
-.stButton > button::before,
-.stFormSubmitButton > button::before,
-.stButton > button::after,
-.stFormSubmitButton > button::after {
-  position: absolute;
-  width: 100%;
-  height: 50px;
-  display: flex;
-  align-items: center;
-  justify-content: center;
-  border: 5px solid #000;
-  box-sizing: border-box;
-  border-radius: 8px;
-  left: 0;
-  top: 0;
-}
-
-/* 前面（オレンジ背景×白文字） */
-.stButton > button::before,
-.stFormSubmitButton > button::before {
-  content: attr(data-text);
-  background-color: #ff8c00;
-  color: #ffffff;
-  border-color: #ff8c00;
-  transform: rotateY(0deg) translateZ(25px);
-}
-
-/* 背面（黄色背景×白文字） */
-.stButton > button::after,
-.stFormSubmitButton > button::after {
-  content: attr(data-text);
-  background-color: #ffd700;
-  color: #ffffff;
-  border-color: #ffd700;
-  transform: rotateX(90deg) translateZ(25px);
-}
-
-/* ホバー時：X軸90度回転でフリップ */
-.stButton > button:hover,
-.stFormSubmitButton > button:hover {
-  transform: translateZ(-25px) rotateX(-90deg);
-}
-
-/* ボタン内部のdiv（テキスト） */
-.stButton > button > div,
-.stFormSubmitButton > button > div {
-  position: relative;
-  z-index: 10;
-  color: #ffffff !important;
-  font-weight: 700;
-  text-transform: uppercase;
-}
-
-/* -------------------------------------------
-   メインエリア：ヘッダー・見出し
-------------------------------------------- */
-.top-bar {
-    background: #050b23;
-    padding: 0px 8px 8px 8px;
-    border-bottom: 1px solid #cfae63;
-    margin-bottom: 20px;
-}
-.app-title {
-    font-size: 24px;
-    font-weight: 700;
-    color: #ffffff !important;
-}
-.section-header {
-    font-size: 16px;
-    font-weight: 700;
-    color: #ffd666;
-    margin: 8px 0;
-}
-
-/* メインブロック（stMainBlockContainer）の上パディング */
-div.stMainBlockContainer {
-    padding-top: 6px !important;
-}
-main.block-container {
-    padding-top: 6px !important;
-}
-
-/* プレビュー内の小見出し行 */
-.preview-section-label {
-    font-size: 12px;
-    font-weight: 600;
-    color: #6b7280;
-    margin-bottom: 4px;
-}
-
-/* 改善点・注意点の本文エリア背景 #fffff9 */
-.preview-note-body {
-    background: #fffff9;
-    border-radius: 8px;
-    border: 1px solid #f3e7c4;
-    color: #111827;
-    font-size: 13px;
-    padding: 10px 12px;
-    line-height: 1.5;
-    word-break: break-word;
-    white-space: pre-wrap;
-}
-
-/* プレビュー見出し＋コピーアイコン */
-.preview-header {
-    display: flex;
-    align-items: center;
-    justify-content: space-between;
-}
-
-/* コピー用ボタン（パターン用） */
-.pattern-copy-icon {
-    cursor: pointer;
-    display: inline-flex;
-    align-items: center;
-    gap: 4px;
-    padding: 4px 10px;
-    margin-left: 8px;
-    font-size: 13px;
-    font-weight: 600;
-    border-radius: 999px;
-    border: 1px solid #ffd666;
-    background: #111827;
-    color: #ffffff;
-    transition:
-        transform 0.15s ease-out,
-        box-shadow 0.15s ease-out,
-        background-color 0.15s ease-out,
-        border-color 0.15s ease-out;
-}
-.pattern-copy-icon:hover {
-    background: #1f2937;
-    border-color: #ffea99;
-}
-
-/* クリック時のキラッとエフェクト */
-.pattern-copy-icon.copy-flash {
-    animation: copy-flash 0.5s ease-out;
-}
-@keyframes copy-flash {
-    0% {
-        transform: scale(1);
-        box-shadow: none;
-        background-color: #111827;
-        border-color: #ffd666;
-        color: #ffffff;
-    }
-    30% {
-        transform: scale(1.05);
-        box-shadow: 0 0 10px rgba(255, 214, 102, 0.8);
-        background-color: #ffd666;
-        border-color: #ffe9a3;
-        color: #111827;
-    }
-    100% {
-        transform: scale(1);
-        box-shadow: none;
-        background-color: #111827;
-        border-color: #ffd666;
-        color: #ffffff;
-    }
-}
-
-/* タイトル直下のメッセージエリア */
-.intro-wrapper {
-    display: flex;
-    align-items: flex-start;
-    gap: 12px;
-    margin-bottom: 0px;
-}
-.intro-icon {
-    width: 130px;
-    height: 130px;
-    flex-shrink: 0;
-}
-.intro-icon img {
-    width: 100%;
-    height: 100%;
-    object-fit: contain;
-}
-
-/* グラデ枠＋グラデ文字の AI バブル */
-.intro-bubble {
-    position: relative;
-    padding: 0;
-    border-radius: 16px;
-    background: transparent;
-    overflow: visible;
-}
-.intro-bubble::before {
-    content: "";
-    position: absolute;
-    inset: 0;
-    border-radius: 16px;
-    padding: 4px;
-    background: linear-gradient(120deg, #6559ae, #ff7159, #6559ae);
-    background-size: 400% 400%;
-    animation: intro-gradient 3s ease-in-out infinite;
-    -webkit-mask:
-      linear-gradient(#000 0 0) content-box,
-      linear-gradient(#000 0 0);
-    -webkit-mask-composite: xor;
-            mask-composite: exclude;
-}
-.intro-bubble-text {
-    position: relative;
-    display: block;
-    padding: 10px 18px;
-    border-radius: 12px;
-    background: rgba(5, 11, 35, 0.85);
-    background-image: linear-gradient(120deg, #fdfbff, #ffd7b2, #ffe6ff);
-    background-size: 400% 400%;
-    -webkit-background-clip: text;
-    -webkit-text-fill-color: transparent;
-    font-size: 14px;
-    font-weight: 600;
-    line-height: 1.6;
-    animation: intro-gradient 3s ease-in-out infinite;
-}
-@keyframes intro-gradient {
-    0%   { background-position: 14% 0%; }
-    50%  { background-position: 87% 100%; }
-    100% { background-position: 14% 0%; }
-}
-
-/* 右：プレビューカード */
-.preview-main-wrapper {
-    background: #ffffff;
-    border-radius: 12px;
-    border: 1px solid #e5e7eb;
-    padding: 16px;
-    box-shadow: 0 4px 12px rgba(0, 0, 0, 0.1);
-    min-height: 350px;
-    width: 100%;
-    max-width: 100%;
-    box-sizing: border-box;
-    display: flex;
-    flex-direction: column;
-    overflow: hidden;
-}
-.preview-subject {
-    color: #111827;
-    font-size: 14px;
-    margin-bottom: 8px;
-    font-weight: bold;
-}
-.preview-body {
-    background: #f3f4f6;
-    border-radius: 8px;
-    border: 1px solid #d1d5db;
-    color: #111827;
-    font-size: 14px;
-    padding: 12px;
-    flex-grow: 1;
-    min-height: 120px;
-    overflow-y: auto;
-    word-break: break-word;
-    white-space: pre-wrap;
-}
-.advice-box {
-    background: #fffbe6;
-    border: 1px solid #ffd666;
-    border-radius: 8px;
-    padding: 10px;
-    color: #4b5563;
-    font-size: 13px;
-    margin-top: 12px;
-}
-.copy-info {
-    color: #ffffff;
-    font-size: 13px;
-    margin-bottom: 4px;
-}
-
-/* チャットバブル */
-.chat-log {
-    display: flex;
-    flex-direction: column;
-    gap: 6px;
-    max-height: 420px;
-    overflow-y: auto;
-    padding-right: 8px;
-}
-.chat-bubble {
-    border-radius: 12px;
-    padding: 8px 12px;
-    max-width: 100%;
-    font-size: 14px;
-    line-height: 1.5;
-    word-break: break-word;
-    box-shadow: 0 2px 4px rgba(0,0,0,0.15);
-}
-.chat-bubble.user {
-    position: relative;
-    background: #ffffff;
-    color: #111827;
-    margin-left: auto;
-    max-width: 80%;
-}
-.chat-bubble.user::after {
-    content: "";
-    position: absolute;
-    right: -8px;
-    top: 14px;
-    width: 0;
-    height: 0;
-    border-style: solid;
-    border-width: 8px 0 8px 8px;
-    border-color: transparent transparent transparent #ffffff;
-    filter: drop-shadow(-1px 1px 2px rgba(0,0,0,0.15));
-}
-/* アシスタント（ガイド）の吹き出し：枠も文字も動的に光らせる */
-.chat-bubble.assistant {
-    position: relative;
-    padding: 0;
-    border-radius: 18px;
-    background: transparent;
-    overflow: visible;
-    margin-right: auto;
-    max-width: 85%;
-}
-.chat-bubble.assistant::before {
-    content: "";
-    position: absolute;
-    inset: 0;
-    border-radius: 18px;
-    padding: 3px;
-    background: linear-gradient(120deg, #6559ae, #ff9f4a, #ffd666, #ff7159, #6559ae);
-    background-size: 300% 300%;
-    animation: assistant-glow-border 4s ease-in-out infinite;
-    -webkit-mask:
-      linear-gradient(#000 0 0) content-box,
-      linear-gradient(#000 0 0);
-    -webkit-mask-composite: xor;
-            mask-composite: exclude;
-}
-.chat-bubble.assistant > span {
-    position: relative;
-    display: block;
-    padding: 10px 18px;
-    border-radius: 14px;
-    background: rgba(5, 11, 35, 0.9);
-    background-image: linear-gradient(120deg, #fdfbff, #ffd7b2, #ffe6ff);
-    background-size: 300% 300%;
-    -webkit-background-clip: text;
-    -webkit-text-fill-color: transparent;
-    font-size: 14px;
-    font-weight: 600;
-    line-height: 1.6;
-    animation: assistant-glow-text 4s ease-in-out infinite;
-}
-
-/* 枠のグローアニメーション */
-@keyframes assistant-glow-border {
-    0% {
-        background-position: 0% 50%;
-        box-shadow: 0 0 0px rgba(255, 214, 102, 0.0);
-    }
-    50% {
-        background-position: 100% 50%;
-        box-shadow: 0 0 16px rgba(255, 214, 102, 0.35);
-    }
-    100% {
-        background-position: 0% 50%;
-        box-shadow: 0 0 0px rgba(255, 214, 102, 0.0);
-    }
-}
+    トークン使用量の上限・ジョブの公平な順番に使うユーザーの識別子を決める。
+    戻り値は (識別子, ブラウザに付けてもらうクッキーの値。付け直さなくてよければ None)。
+
+    - ログインしていればそのユーザー（st.user は Streamlit 1.42 以降・[auth] 設定時だけ）。
+    - ブラウザに USER_COOKIE があればその値。
+    - 無ければ（初めての接続）ここで値を決めて、assets/arky_identity.js に同じ値を
+      クッキーとして付けてもらう。このセッションもリロード後も同じ識別子になり、
+      同じ NAT・プロキシの向こうのほかのユーザーと枠を共有することもない。
+    クッキーは消せるので、上限を厳密に守らせたい場合はログインを有効にすること。
+    メトリクスのラベルにも出るので、メールアドレス・クッキーの値はハッシュにしておく。
+    """
+    try:
+        if st.user.is_logged_in and st.user.get("email"):
+            return "user:" + _hashed(st.user["email"]), None
+    except Exception:
+        # st.user が無いバージョン・認証（[auth]）を設定していない環境
+        pass
+    uid = st.context.cookies.get(USER_COOKIE)
+    if isinstance(uid, str) and uid:
+        return "cookie:" + _hashed(uid), None
+    uid = uuid.uuid4().hex
+    return "cookie:" + _hashed(uid), uid
 
-/* テキストのグラデ移動＆ほんのり発光 */
-@keyframes assistant-glow-text {
-    0% {
-        background-position: 0% 50%;
-        text-shadow: 0 0 0px rgba(255, 214, 102, 0.0);
-    }
-    50% {
-        background-position: 100% 50%;
-        text-shadow: 0 0 8px rgba(255, 214, 102, 0.4);
-    }
-    100% {
-        background-position: 0% 50%;
-        text-shadow: 0 0 0px rgba(255, 214, 102, 0.0);
-    }
-}
-
-/* サイドバーのラジオボタンの余白を詰める */
-[data-testid="stSidebar"] .stRadio > div {
-    margin-top: 2px !important;
-    margin-bottom: 2px !important;
-    padding: 0 !important;
-}
-[data-testid="stSidebar"] .nav-label {
-    margin-bottom: 4px !important;
-}
-
-/* -------------------------------------------
-   カスタムテンプレート入力ボックス（その他）
-------------------------------------------- */
-
-/* 外側コンテナ：幅を30px狭める＆背景を消す */
-[data-testid="stSidebar"] [data-testid="stTextInput"] > div {
-    width: calc(100% - 30px) !important;
-    margin-left: 0 !important;
-    background: transparent !important;
-}
-
-/* 実際の入力ボックス */
-[data-testid="stSidebar"] [data-testid="stTextInput"] input {
-    width: 100% !important;
-    background-color: #330033 !important;
-    border: 5px solid #ffffcc !important;
-    color: #ffffff !important;
-    padding: 6px 10px !important;
-    border-radius: 8px !important;
-}
-
-/* 右ペインの Streamlit 標準ヘッダーを高さ0にする（非表示に近い） */
-[data-testid="stHeader"] {
-    height: 0 !important;
-    min-height: 0 !important;
-    max-height: 0 !important;
-    padding: 0 !important;
-    margin: 0 !important;
-    overflow: hidden !important;
-    background: transparent !important;
-    border: none !important;
-}
-
-/* ============================================
-   プレビュータブの見た目カスタマイズ
-   （パターン1〜3用）
-============================================ */
-.stTabs {
-    margin-top: 4px;
-}
-.stTabs [role="tablist"] {
-    gap: 0.5rem;
-}
-.stTabs [role="tablist"] > [role="tab"] {
-    position: relative;
-    border: none;
-    background: transparent;
-    opacity: 1 !important;
-    border-radius: 999px;
-    padding: 0;
-    color: #ffffff !important;
-    font-weight: 600;
-    font-size: 13px;
-    cursor: pointer;
-}
-.stTabs [role="tablist"] > [role="tab"] > div {
-    position: relative;
-    border-radius: inherit;
-    padding: 4px 16px;
-}
-/* グラデ枠 */
-.stTabs [role="tablist"] > [role="tab"]::before {
-    content: "";
-    position: absolute;
-    inset: 0;
-    border-radius: 999px;
-    padding: 2px;
-    background: linear-gradient(120deg, #6559ae, #ff7159, #ffd666, #ff7159, #6559ae);
-    background-size: 400% 400%;
-    animation: tab-gradient 4s ease-in-out infinite;
-    -webkit-mask:
-      linear-gradient(#000 0 0) content-box,
-      linear-gradient(#000 0 0);
-    -webkit-mask-composite: xor;
-            mask-composite: exclude;
-}
-@keyframes tab-gradient {
-    0%   { background-position: 0% 0%;   box-shadow: 0 0 0px rgba(255,214,102,0.0); }
-    50%  { background-position: 100% 100%; box-shadow: 0 0 10px rgba(255,214,102,0.4); }
-    100% { background-position: 0% 0%;   box-shadow: 0 0 0px rgba(255,214,102,0.0); }
-}
-/* パターン別背景色 */
-.stTabs [role="tablist"] > [role="tab"]:nth-child(1) > div {
-    background-color: #990000;
-}
-.stTabs [role="tablist"] > [role="tab"]:nth-child(2) > div {
-    background-color: #660066;
-}
-.stTabs [role="tablist"] > [role="tab"]:nth-child(3) > div {
-    background-color: #336600;
-}
-/* 選択中タブの光り方 */
-.stTabs [role="tablist"] > [role="tab"][aria-selected="true"] > div {
-    box-shadow: 0 0 8px rgba(255,214,102,0.6);
-}
-
-</style>
-""",
-    unsafe_allow_html=True,
-)
 
 # ============================================
-# JS：全ボタンに data-text を付与（3D用）
-# ＋ COPY_TRIGGER_* ボタンは画面外に退避＆indexを属性で保持
+# カスタムCSS ＋ ボタン用 JS（static/ から1セッション1回だけ読み込む）
 # ============================================
-st.components.v1.html(
-    """
-    <script>
-    (function() {
-      function updateButtonText() {
-        const buttons = parent.document.querySelectorAll(
-          '.stButton > button, .stFormSubmitButton > button'
-        );
-        buttons.forEach(btn => {
-          const textDiv = btn.querySelector('div');
-          if (!textDiv || !textDiv.textContent) return;
-
-          const label = textDiv.textContent.trim();
-          // 3D ボタン用
-          btn.setAttribute('data-text', label);
-
-          // COPY_TRIGGER_* ボタンだけ special 処理
-          if (label.startsWith('COPY_TRIGGER_')) {
-            const idxStr = label.replace('COPY_TRIGGER_', '');
-            btn.setAttribute('data-copy-trigger-index', idxStr);
-
-            // 完全に画面外へ退避させて見えなくする
-            btn.style.position = 'absolute';
-            btn.style.left = '-9999px';
-            btn.style.top = '-9999px';
-            btn.style.width = '1px';
-            btn.style.height = '1px';
-            btn.style.padding = '0';
-            btn.style.margin = '0';
-            btn.style.opacity = '0';
-            btn.style.pointerEvents = 'none';
-          }
-        });
-      }
-
-      // 初回 & DOM変化のたびに再実行
-      setTimeout(updateButtonText, 500);
-      const observer = new MutationObserver(updateButtonText);
-      observer.observe(parent.document.body, { childList: true, subtree: true });
-    })();
-    </script>
-    """,
-    height=0,
-)
+# 元ファイル：assets/arky.css, assets/arky_buttons.js, assets/arky_identity.js
+if "user_key" not in st.session_state:
+    # ジョブの公平な順番・トークン使用量の上限（quota_logic）はこの単位で数える
+    st.session_state.user_key, st.session_state.user_cookie = resolve_user_key()
+inject_assets(user_cookie=st.session_state.user_cookie)
 
 # ============================================
 # セッション状態初期化
 # ============================================
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = ChatLog()
+if "chat_log_window" not in st.session_state:
+    st.session_state.chat_log_window = CHAT_LOG_WINDOW
 if "last_user_message" not in st.session_state:
     st.session_state.last_user_message = ""
 if "generated_email" not in st.session_state:
@@ -977,11 +624,23 @@ if "variation_count" not in st.session_state:
     st.session_state.variation_count = 0
 if "ai_suggestions" not in st.session_state:
     st.session_state.ai_suggestions = None
+if "ai_patterns" not in st.session_state:
+    st.session_state.ai_patterns = None
+if "ai_provisional" not in st.session_state:
+    st.session_state.ai_provisional = False
 if "copy_target_text" not in st.session_state:
     st.session_state.copy_target_text = ""
-
-# ★ ロック状態は「AI 生成済みかどうか」から毎回計算する
-nav_locked = st.session_state.ai_suggestions is not None
+if "generation_job" not in st.session_state:
+    # 実行中の生成ジョブ（jobs_logic）の ID と、途中経過の表示に使う下書きなど
+    st.session_state.generation_job = None
+
+# ★ ロック状態は「AI 生成済み・生成中かどうか」から毎回計算する
+#    （送信直後の run では on_submit が立てたフラグでも先にロックする）
+nav_locked = (
+    st.session_state.ai_suggestions is not None
+    or st.session_state.generation_job is not None
+    or st.session_state.pop("nav_lock_requested", False)
+)
 
 # ============================================
 # トップバー
@@ -1003,16 +662,13 @@ with st.sidebar:
     # テンプレート
     st.markdown("<div class='nav-section'>", unsafe_allow_html=True)
     st.markdown("<div class='nav-label'>テンプレート</div>", unsafe_allow_html=True)
+    # 選択肢はテンプレートファイルの順（＋「その他」で自由入力）
+    registry = get_registry()
+    display_to_template = {label: name for name, label in registry.template_labels.items()}
+    display_to_template["➕ その他"] = "その他"
     template_display = st.radio(
         "テンプレート",
-        [
-            "📧 依頼メール",
-            "✉️ 提案メール",
-            "🙏 お礼メール",
-            "💼 謝罪メール",
-            "📩 挨拶メール",
-            "➕ その他",
-        ],
+        list(display_to_template),
         index=0,
         label_visibility="collapsed",
         key="template_radio",
@@ -1020,19 +676,13 @@ with st.sidebar:
     )
     st.markdown("</div>", unsafe_allow_html=True)
 
-    display_to_template = {
-        "📧 依頼メール": "依頼",
-        "✉️ 提案メール": "提案",
-        "🙏 お礼メール": "お礼",
-        "💼 謝罪メール": "謝罪",
-        "📩 挨拶メール": "挨拶",
-        "➕ その他": "その他",
-    }
     template = display_to_template[template_display]
 
     custom_template = None
     if template == "その他":
-        custom_template = st.text_input("カスタムテンプレート", placeholder="例: 報告")
+        custom_template = st.text_input(
+            "カスタムテンプレート", placeholder="例: 報告", key="custom_template_input"
+        )
         template = custom_template if custom_template else "その他"
 
     # トーン
@@ -1068,16 +718,11 @@ with st.sidebar:
     # 相手
     st.markdown("<div class='nav-section'>", unsafe_allow_html=True)
     st.markdown("<div class='nav-label'>相手</div>", unsafe_allow_html=True)
+    display_to_recipient = {label: name for name, label in registry.recipient_labels.items()}
+    display_to_recipient["➕ その他"] = "その他"
     recipient_display = st.radio(
         "相手",
-        [
-            "👤 上司",
-            "😊 同僚",
-            "👔 部下",
-            "🏢 社外企業社員",
-            "🏪 取引先",
-            "➕ その他",
-        ],
+        list(display_to_recipient),
         index=0,
         label_visibility="collapsed",
         key="recipient_radio",
@@ -1085,19 +730,13 @@ with st.sidebar:
     )
     st.markdown("</div>", unsafe_allow_html=True)
 
-    display_to_recipient = {
-        "👤 上司": "上司",
-        "😊 同僚": "同僚",
-        "👔 部下": "部下",
-        "🏢 社外企業社員": "社外企業社員",
-        "🏪 取引先": "取引先",
-        "➕ その他": "その他",
-    }
     recipient = display_to_recipient[recipient_display]
 
     custom_recipient = None
     if recipient == "その他":
-        custom_recipient = st.text_input("カスタム相手", placeholder="例: 顧客")
+        custom_recipient = st.text_input(
+            "カスタム相手", placeholder="例: 顧客", key="custom_recipient_input"
+        )
         recipient = custom_recipient if custom_recipient else "その他"
 
     # 時候の挨拶
@@ -1123,6 +762,10 @@ with st.sidebar:
 # ============================================
 col1, col2 = st.columns([1, 1], gap="medium")
 
+# 右カラムの枠。フォームの処理が終わってから、この run の最後に描く
+with col2:
+    preview_slot = st.empty()
+
 # --------------------------------------------
 # 左：メッセージ＋フォーム
 # --------------------------------------------
@@ -1130,11 +773,14 @@ with col1:
     st.markdown("<div class='section-header'>💬 メッセージ</div>", unsafe_allow_html=True)
     st.markdown("<div style='height: 8px;'></div>", unsafe_allow_html=True)
 
+    avatar_html = picture_html(
+        "avatar", alt="ARKY", sizes="130px", base_url_path=st.get_option("server.baseUrlPath") or ""
+    )
     st.markdown(
-        """
+        f"""
         <div class="intro-wrapper">
           <div class="intro-icon">
-            <img src="https://raw.githubusercontent.com/smzk13tp5kg/ARKY/main/AIhontai.png">
+            {avatar_html}
           </div>
           <div class="intro-bubble">
             <span class="intro-bubble-text">
@@ -1157,98 +803,105 @@ with col1:
             placeholder="例：使用する会議室の交換をお願いしたい",
             height=120,
             label_visibility="collapsed",
+            key="user_message_input",
         )
 
+        # 追加要望を反映するパターンの選択欄（生成が終わった時点の状態で、この run の最後に描く）
+        refine_target_slot = st.empty()
+
         submit_col, reset_col = st.columns([1, 1])
         with submit_col:
-            submitted = st.form_submit_button("✓ 送信", use_container_width=True)
+            submitted = st.form_submit_button(
+                "✓ 送信", use_container_width=True, on_click=on_submit
+            )
         with reset_col:
-            reset_clicked = st.form_submit_button("リセット", use_container_width=True)
+            st.form_submit_button(
+                "リセット", use_container_width=True, on_click=reset_session
+            )
+
+    # 一部だけ選ぶと、そのパターンだけを送って書き直す（選択欄は後で描くので値は session_state から読む）
+    refine_targets = st.session_state.get("refine_targets_input")
 
-    # フォーム送信後の処理
     # フォーム送信後の処理
     if submitted and user_message:
         if template == "その他" and not custom_template:
             st.error("⚠️ カスタムテンプレートを入力してください")
         elif recipient == "その他" and not custom_recipient:
             st.error("⚠️ カスタム相手を入力してください")
+        elif st.session_state.generation_job is not None:
+            st.warning("⏳ 前の生成がまだ終わっていません。完了を待つか、キャンセルしてから送信してください。")
         else:
-            # ★ 初回送信が通ったタイミングでサイドバーをロック
-            #    （すでにロック済みなら何もしない）
-
-
-            # 既に3パターン生成済みかどうかで初回／再生成を判定
-            is_first_generation = st.session_state.ai_suggestions is None
-
-            # 初回だけベースメッセージを記録
-            if is_first_generation:
-                st.session_state.last_user_message = user_message
-
-            base_message = st.session_state.last_user_message or user_message
-
-            # チャットログ更新
-            if is_first_generation:
-                # 初回：元の要望をログに残す
-                user_display_text = (
-                    f"{user_message}\n\n"
-                    f"――――――――――\n"
-                    f"テンプレート: {template} / トーン: {tone} / 相手: {recipient}"
-                )
-                st.session_state.messages.append(
-                    {"role": "user", "content": user_display_text}
-                )
-
-                guide = (
-                    f"{template}メールを「{tone}」なトーンで、"
-                    f"{recipient}宛に作成しました！右側のプレビューをご覧ください。"
-                )
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": guide}
-                )
-            else:
-                # 再生成：追加要望としてログに残す
-                user_display_text = (
-                    f"＜追加要望＞\n{user_message}\n\n"
-                    f"――――――――――\n"
-                    f"既に生成済みの3パターンに上記の要望を反映します。"
-                )
-                st.session_state.messages.append(
-                    {"role": "user", "content": user_display_text}
-                )
+            # 送信1回ぶんのトレース（各段階の span にテンプレート・トーン・相手のラベルが付く）
+            # 自由入力のテンプレート・相手は「その他」にまとめる（ラベルの種類を増やさない）
+            with trace(
+                "submit",
+                template="その他" if custom_template else template,
+                tone=tone,
+                recipient="その他" if custom_recipient else recipient,
+            ):
+                # ★ 初回送信が通ったタイミングでサイドバーをロック
+                #    （すでにロック済みなら何もしない）
+
+
+                # 既に3パターン生成済みかどうかで初回／再生成を判定
+                is_first_generation = st.session_state.ai_suggestions is None
+
+                # 一部のパターンだけを選んだリライト（全部選んだ／何も選ばない場合は全体をリライト）
+                num_existing = len(st.session_state.ai_patterns or [])
+                partial_targets = None
+                if not is_first_generation and refine_targets and len(refine_targets) < num_existing:
+                    partial_targets = sorted(refine_targets)
+                target_names = "・".join(f"パターン{i + 1}" for i in partial_targets or [])
+
+                # 初回だけベースメッセージを記録
+                if is_first_generation:
+                    st.session_state.last_user_message = user_message
 
-                guide = (
-                    "追加要望を反映して、既存の3パターンすべてをリライトしました。"
-                    "右側のプレビューをご確認ください。"
-                )
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": guide}
-                )
+                base_message = st.session_state.last_user_message or user_message
 
-            # 初回だけ既存ロジックのベースメールも作っておく（必要なら維持）
-            if is_first_generation:
-                st.session_state.variation_count = 0
-                base_email = generate_email(
-                    template,
-                    tone,
-                    recipient,
-                    base_message,
-                    variation=0,
-                    seasonal_text=seasonal_text,
-                )
-                st.session_state.generated_email = base_email
-
-            # --- OpenAI 生成＋DB保存を spinner＋イントロbubble 付きでまとめて実行 ---
-            with st.spinner(""):
-                # イントロbubbleスタイルの「生成中」メッセージ
-                loading_html = """
-                <div class="intro-bubble" style="margin-top: 8px;">
-                  <span class="intro-bubble-text">
-                    ✨ メッセージを生成しています…<br>
-                    数秒お待ちください。
-                  </span>
-                </div>
-                """
-                st.markdown(loading_html, unsafe_allow_html=True)
+                # チャットログ更新
+                if is_first_generation:
+                    # 初回：元の要望をログに残す
+                    user_display_text = (
+                        f"{user_message}\n\n"
+                        f"――――――――――\n"
+                        f"テンプレート: {template} / トーン: {tone} / 相手: {recipient}"
+                    )
+                    st.session_state.messages.append("user", user_display_text)
+
+                    guide = (
+                        f"{template}メールを「{tone}」なトーンで、"
+                        f"{recipient}宛に作成しました！右側のプレビューをご覧ください。"
+                    )
+                    st.session_state.messages.append("assistant", guide)
+                else:
+                    # 再生成：追加要望としてログに残す
+                    target_text = target_names or "既に生成済みの3パターン"
+                    user_display_text = (
+                        f"＜追加要望＞\n{user_message}\n\n"
+                        f"――――――――――\n"
+                        f"{target_text}に上記の要望を反映します。"
+                    )
+                    st.session_state.messages.append("user", user_display_text)
+
+                    guide = (
+                        f"追加要望を反映して、{target_names or '既存の3パターンすべて'}をリライトしました。"
+                        "右側のプレビューをご確認ください。"
+                    )
+                    st.session_state.messages.append("assistant", guide)
+
+                # 初回だけ既存ロジックのベースメールも作っておく（必要なら維持）
+                if is_first_generation:
+                    st.session_state.variation_count = 0
+                    base_email = generate_email(
+                        template,
+                        tone,
+                        recipient,
+                        base_message,
+                        variation=0,
+                        seasonal_text=seasonal_text,
+                    )
+                    st.session_state.generated_email = base_email
 
                 # OpenAI に渡す message をモード別に決定
                 if is_first_generation:
@@ -1262,7 +915,7 @@ with col1:
                     prev_suggestions = st.session_state.ai_suggestions
                     refine_flag = True
 
-                ai_text = generate_email_with_openai(
+                gen_kwargs = dict(
                     template=template,
                     tone=tone,
                     recipient=recipient,
@@ -1271,246 +924,142 @@ with col1:
                     previous_suggestions=prev_suggestions,
                     is_refine=refine_flag,
                 )
-                st.session_state.ai_suggestions = ai_text
 
-                # ⑤ DB保存（あれば）
-                if HAS_DB and ai_text:
-                    try:
-                        raw_blocks = re.split(
-                            r"(?=^##\s*パターン\s*\d+)", ai_text, flags=re.MULTILINE
-                        )
-                        blocks = [b.strip() for b in raw_blocks if b.strip()]
-                        blocks = blocks[:3]
-                        while len(blocks) < 3:
-                            blocks.append("このパターンはまだ生成されていません。")
-
-                        patterns_for_db = []
-                        for b in blocks:
-                            parsed = parse_pattern_block(b)
-                            patterns_for_db.append(
-                                {
-                                    "subject": parsed.get("subject", ""),
-                                    "body": parsed.get("body", ""),
-                                }
-                            )
+                # 同じ入力の生成結果がキャッシュにあれば、スピナーを出さずに即表示
+                # （一部だけのリライトはパターンごとにキャッシュを引く）
+                cached_text = None if partial_targets else get_cached_email(**gen_kwargs)
 
-                        save_email_batch(
-                            template=template,
-                            tone=tone,
-                            recipient=recipient,
-                            message=base_message,
-                            seasonal_greeting=add_seasonal,
-                            patterns=patterns_for_db,
+                # 初回生成では、助詞や句読点だけが違う過去のリクエストも探す
+                similar = None
+                if cached_text is None and is_first_generation and SIMILAR_MODE != "off":
+                    with span("similar_lookup"):
+                        similar = similar_index.find_similar(
+                            template, tone, recipient, add_seasonal, base_message
+                        )
+                    if similar is not None:
+                        print(
+                            f"[app] 類似リクエストを検出: generatedid={similar.generatedid} "
+                            f"similarity={similar.similarity:.2f}"
                         )
 
-                        st.success("✅ メッセージの生成が完了し、データベースに保存しました！")
-
-                    except Exception as e:
-                        st.error(f"❌ DB保存エラー: {str(e)}")
-
-            # チャットログを最大50件に制限
-            if len(st.session_state.messages) > 50:
-                st.session_state.messages = st.session_state.messages[-50:]
-
-            st.rerun()
-
-    elif reset_clicked:
-        # 全リセット
-        st.session_state.messages = []
-        st.session_state.last_user_message = ""
-        st.session_state.generated_email = None
-        st.session_state.ai_suggestions = None
-        st.session_state.variation_count = 0
-        st.rerun()
+                if cached_text is not None:
+                    ai_text = cached_text
+                    set_ai_suggestions(ai_text)
+                elif similar is not None and SIMILAR_MODE == "reuse":
+                    # OpenAI を呼ばずに過去の生成結果をそのまま使う
+                    ai_text = similar.to_markdown()
+                    set_ai_suggestions(ai_text)
+                else:
+                    # AI の応答が遅い・得られないときに先に出す仮の下書き
+                    # （類似リクエスト → 再生成なら前回の3パターン → 定型文の順）
+                    if similar is not None:
+                        fallback_text = similar.to_markdown()
+                    elif not is_first_generation:
+                        fallback_text = st.session_state.ai_suggestions
+                    else:
+                        fallback_text = build_local_drafts(
+                            template, tone, recipient, base_message, seasonal_text
+                        )
+                    fallback_blocks = split_pattern_blocks(fallback_text)[:3]
+
+                    # OpenAI の生成はジョブとしてワーカーに渡し、このスクリプトスレッドは待たない
+                    # （結果は render_generation_job() がポーリングで受け取る）
+                    ai_text = None
+                    if not openai_available():
+                        # API キーが無い／ブレーカーが open：上流を待たずに下書きで確定
+                        print("[app] OpenAI を使えないため、仮の下書きを表示します")
+                    elif quota_tracker.exceeded(st.session_state.user_key):
+                        # このセッションはトークンの上限まで使った：ほかのユーザーの枠を残す
+                        print(
+                            "[app] トークンの上限に達したため、仮の下書きを表示します: "
+                            f"{st.session_state.user_key}"
+                        )
+                        st.warning(
+                            "⚠️ しばらくの間に多くの生成を行ったため、AI の生成を一時的に止めています。"
+                            "時間をおいてからお試しください。"
+                        )
+                    else:
+                        db_kwargs = None
+                        if HAS_DB:
+                            db_kwargs = dict(
+                                template=template,
+                                tone=tone,
+                                recipient=recipient,
+                                message=base_message,
+                                seasonal_greeting=add_seasonal,
+                            )
+                        try:
+                            job = job_queue.submit(
+                                run_generation_job,
+                                gen_kwargs,
+                                partial_targets,
+                                fallback_blocks,
+                                db_kwargs,
+                                kind="generation",
+                                user=st.session_state.user_key,
+                                # 初回生成はリライト（追加要望）より先に実行する
+                                priority=PRIORITY_HIGH if is_first_generation else PRIORITY_NORMAL,
+                            )
+                        except JobQueueFull as e:
+                            print(f"[app] {e}。仮の下書きを表示します")
+                        else:
+                            st.session_state.generation_job = {
+                                "id": job.id,
+                                "fallback_blocks": fallback_blocks,
+                                "partial_targets": partial_targets,
+                                "similar": similar is not None,
+                            }
+
+                    if st.session_state.generation_job is None:
+                        ai_text, provisional = merge_with_fallback({}, fallback_blocks)
+                        set_ai_suggestions(ai_text, provisional=provisional)
+
+                # ⑤ DB保存は生成ジョブ（run_generation_job）が AI の結果だけを保存する。
+                #    キャッシュ・類似リクエストから出した結果は保存済みの生成の再利用なので
+                #    保存し直さない（同じ生成グループの複製が DB と類似インデックスに増えるため）
+
+            # 結果はこの後の render_chat_log() / render_preview() が同じ run で描画する
+            # （st.rerun() でスクリプト全体をもう一度実行しない）
+
+    # 生成ジョブの結果（DB 保存の成否）は、ジョブが終わった次の run で1回だけ出す
+    notice = st.session_state.pop("generation_notice", None)
+    if notice is not None:
+        kind, text = notice
+        getattr(st, kind)(text)
+
+    # 生成済みのパターンがあれば、フォームに「リライトするパターン」を出す
+    if st.session_state.ai_patterns:
+        num_patterns = len(st.session_state.ai_patterns)
+        with refine_target_slot:
+            st.multiselect(
+                "リライトするパターン",
+                options=list(range(num_patterns)),
+                default=list(range(num_patterns)),
+                format_func=lambda i: f"パターン {i + 1}",
+                key="refine_targets_input",
+            )
 
     st.markdown("<div style='height: 12px;'></div>", unsafe_allow_html=True)
 
-    chat_html_parts = ["<div class='chat-log'>"]
-    for msg in st.session_state.messages:
-        role = msg["role"]
-        text = html.escape(msg["content"]).replace("\n", "<br>")
-        if role == "user":
-            chat_html_parts.append(f"<div class='chat-bubble user'>{text}</div>")
-        else:
-            chat_html_parts.append(
-                f"<div class='chat-bubble assistant'><span>{text}</span></div>"
-            )
-    chat_html_parts.append("</div>")
-    st.markdown("\n".join(chat_html_parts), unsafe_allow_html=True)
+    render_chat_log()
 
 # --------------------------------------------
 # 右：AIが作った3パターンのプレビュー（タブ表示）
 # --------------------------------------------
-with col2:
-    ai_text = st.session_state.ai_suggestions
-
-    if not ai_text:
-        placeholder_html = textwrap.dedent(
-            """
-            <div class="preview-main-wrapper">
-                <p><em>メッセージを送信すると、ここにAIが生成した3パターンのプレビューが表示されます。</em></p>
-            </div>
-            """
-        )
-        st.markdown(placeholder_html, unsafe_allow_html=True)
+with preview_slot.container():
+    if st.session_state.generation_job is not None:
+        # 生成中：途中経過をポーリングで表示する（このスクリプトスレッドは生成を待たない）
+        render_generation_job()
+        st.button("生成をキャンセル", key="cancel_generation", on_click=cancel_generation)
     else:
-        # 行頭が「## パターン数字」の行で分割
-        raw_blocks = re.split(r"(?=^##\s*パターン\s*\d+)", ai_text, flags=re.MULTILINE)
-        blocks = [b.strip() for b in raw_blocks if b.strip()]
-
-        # 先頭3つだけ使う
-        blocks = blocks[:3]
-
-        # 3つに満たない場合はプレースホルダで埋める
-        while len(blocks) < 3:
-            blocks.append("このパターンはまだ生成されていません。")
-
-        # コピー用テキスト配列（元の Markdown まるごと）
-        copy_texts = blocks.copy()
+        render_preview()
 
-        # タブ生成
-        tab_labels = [f"パターン {i + 1}" for i in range(len(blocks))]
-        tabs = st.tabs(tab_labels)
-
-        for idx, (tab, block) in enumerate(zip(tabs, blocks)):
-            with tab:
-                parsed = parse_pattern_block(block)
-                subj = html.escape(parsed["subject"] or "").replace("\n", "<br>")
-                body = html.escape(parsed["body"] or "").replace("\n", "<br>")
-                improve = html.escape(parsed["improve"] or "").replace("\n", "<br>")
-                caution = html.escape(parsed["caution"] or "").replace("\n", "<br>")
-
-                card_html = f"""
-                <div class="preview-main-wrapper">
-                  <div class="preview-header">
-                    <span></span>
-                    <span class="pattern-copy-icon"
-                          data-pattern="{idx}"
-                          title="メッセージをコピーします">
-                      📋 テキストコピー
-                    </span>
-                  </div>
-
-                  <div style="margin-top:4px;">
-                    <div class="preview-section-label">件名</div>
-                    <div class="preview-subject">{subj}</div>
-                  </div>
-
-                  <div style="margin-top:12px;">
-                    <div class="preview-section-label">本文</div>
-                    <div class="preview-body">{body}</div>
-                  </div>
-
-                  <div style="margin-top:12px;">
-                    <div class="preview-section-label">改善点</div>
-                    <div class="preview-note-body">{improve}</div>
-                  </div>
+with col2:
+    patterns = st.session_state.ai_patterns
+    if st.session_state.ai_suggestions and patterns and st.session_state.generation_job is None:
+        # コピー用テキスト（元の Markdown まるごと）
+        render_copy_logger([p.raw for p in patterns], template, tone, recipient)
 
-                  <div style="margin-top:12px;">
-                    <div class="preview-section-label">注意点</div>
-                    <div class="preview-note-body">{caution}</div>
-                  </div>
-                </div>
-                """
-                st.markdown(card_html, unsafe_allow_html=True)
-                st.markdown("<div style='height: 16px;'></div>", unsafe_allow_html=True)
-
-                # ★ ここが「隠しボタン」本体（表示は JS 側で即座に消す）
-                hidden_label = f"COPY_TRIGGER_{idx}"
-                hidden_pressed = st.button(hidden_label, key=f"copy_trigger_{idx}")
-
-                if hidden_pressed and HAS_DB:
-                    try:
-                        log_copy_click(
-                            template=template,
-                            tone=tone,
-                            recipient=recipient,
-                            pattern_index=idx + 1,
-                        )
-                    except Exception as e:
-                        st.error(f"コピー履歴の保存に失敗しました: {e}")
-
-        # コピーアイコン用 JS（コピー＋隠しボタンクリック）
-        texts_json = json.dumps(copy_texts, ensure_ascii=False)
-
-        st.components.v1.html(
-            f"""
-            <script>
-            (function() {{
-              const texts = {texts_json};
-
-              function setupIcons() {{
-                const icons = parent.document.querySelectorAll('.pattern-copy-icon');
-                if (!icons || icons.length === 0) return;
-
-                function copyText(text) {{
-                  if (navigator.clipboard && navigator.clipboard.writeText) {{
-                    navigator.clipboard.writeText(text).catch(function(err) {{
-                      console.warn("navigator.clipboard failed:", err);
-                      fallbackCopy(text);
-                    }});
-                  }} else {{
-                    fallbackCopy(text);
-                  }}
-                }}
-
-                function fallbackCopy(text) {{
-                  try {{
-                    const textarea = document.createElement('textarea');
-                    textarea.value = text;
-                    textarea.style.position = 'fixed';
-                    textarea.style.top = '-9999px';
-                    textarea.style.left = '-9999px';
-                    document.body.appendChild(textarea);
-                    textarea.focus();
-                    textarea.select();
-                    document.execCommand('copy');
-                    document.body.removeChild(textarea);
-                  }} catch (e) {{
-                    console.error("Fallback copy failed:", e);
-                  }}
-                }}
-
-                icons.forEach(function(icon) {{
-                  const idx = parseInt(icon.getAttribute('data-pattern'), 10);
-                  if (isNaN(idx) || !texts[idx]) return;
-
-                  icon.addEventListener('click', function() {{
-                    // ① テキストをクリップボードにコピー
-                    copyText(texts[idx]);
-
-                    // ② data-copy-trigger-index で隠しボタンを特定してクリック
-                    try {{
-                      const selector = 'button[data-copy-trigger-index="' + idx + '"]';
-                      const triggerBtn = parent.document.querySelector(selector);
-                      if (triggerBtn) {{
-                        const ev = new MouseEvent('click', {{
-                          bubbles: true,
-                          cancelable: true,
-                          view: parent.window
-                        }});
-                        triggerBtn.dispatchEvent(ev);
-                      }} else {{
-                        console.warn('No hidden trigger button found for pattern index', idx);
-                      }}
-                    }} catch (e) {{
-                      console.warn('Error clicking hidden trigger button:', e);
-                    }}
-
-                    // ③ キラキラエフェクト
-                    icon.classList.remove('copy-flash');
-                    void icon.offsetWidth;
-                    icon.classList.add('copy-flash');
-                  }});
-                }});
-              }}
-
-              setTimeout(setupIcons, 500);
-            }})();
-            </script>
-            """,
-            height=0,
-        )
 
 
 
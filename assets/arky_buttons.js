@@ -0,0 +1,37 @@
+// 全ボタンに data-text を付与（3D用）
+// ※ static_assets.py がページ本体（iframe の外）に1回だけ読み込む
+(function() {
+  if (window.__arkyButtonObserver) return;
+
+  function updateButtonText() {
+    const buttons = document.querySelectorAll(
+      '.stButton > button, .stFormSubmitButton > button'
+    );
+    buttons.forEach(btn => {
+      const textDiv = btn.querySelector('div');
+      if (!textDiv || !textDiv.textContent) return;
+
+      const label = textDiv.textContent.trim();
+      // 3D ボタン用
+      if (btn.getAttribute('data-text') !== label) {
+        btn.setAttribute('data-text', label);
+      }
+    });
+  }
+
+  // 初回 & DOM変化のたびに再実行（同じフレーム内の変化はまとめて1回）
+  let scheduled = false;
+  function scheduleUpdate() {
+    if (scheduled) return;
+    scheduled = true;
+    window.requestAnimationFrame(function() {
+      scheduled = false;
+      updateButtonText();
+    });
+  }
+
+  updateButtonText();
+  const observer = new MutationObserver(scheduleUpdate);
+  observer.observe(document.body, { childList: true, subtree: true });
+  window.__arkyButtonObserver = observer;
+})();
@@ -0,0 +1,20 @@
+// ログインしていないユーザーを見分けるためのブラウザ識別子（app.py の resolve_user_key が読む）
+// ※ static_assets.py がページ本体（iframe の外）に1回だけ読み込む
+// クッキーは WebSocket の接続時にサーバへ送られるので、初回の接続ではサーバが値を決めて
+// window.__arkyUserId で渡してくる。同じ値を付けるので、リロードしても同じユーザーのまま
+(function() {
+  const NAME = "arky_uid";
+  const exists = document.cookie.split("; ").some(function(c) {
+    return c.indexOf(NAME + "=") === 0;
+  });
+  if (exists) return;
+
+  let id = window.__arkyUserId;
+  if (!id) {
+    const bytes = new Uint8Array(12);
+    window.crypto.getRandomValues(bytes);
+    id = Array.from(bytes, function(b) { return b.toString(16).padStart(2, "0"); }).join("");
+  }
+  // 1年間（クォータの窓よりずっと長ければよい）
+  document.cookie = NAME + "=" + id + "; path=/; max-age=31536000; SameSite=Lax";
+})();
@@ -0,0 +1,59 @@
+# bench/bench_assets.py
+"""
+CSS / ボタン用 JS について、Streamlit の再実行1回あたりにブラウザへ送るバイト数を比較する。
+
+  - before         : 旧 app.py（元の CSS と JS を再実行のたびに st.markdown / iframe で送る）
+  - inline (min)   : ARKY_INLINE_ASSETS=1（縮小済みを毎回送る）
+  - static         : 既定。初回だけ読み込みスクリプトを送り、CSS / JS は static/ から1回だけ取得
+
+あわせて、背景画像・アバター画像の元 PNG と変換後（形式・幅ごと）のサイズを表示する。
+
+使い方（リポジトリのルートで）:
+    python bench/bench_assets.py [--reruns 20]
+"""
+import argparse
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from static_assets import ASSETS_DIR, build_assets, build_images, inline_html, loader_html  # noqa: E402
+
+
+def _bytes(text: str) -> int:
+    return len(text.encode("utf-8"))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--reruns", type=int, default=20, help="1セッションあたりの再実行回数")
+    args = ap.parse_args()
+
+    assets = build_assets()
+    raw_css = (ASSETS_DIR / "arky.css").read_text(encoding="utf-8")
+    raw_js = (ASSETS_DIR / "arky_buttons.js").read_text(encoding="utf-8")
+
+    before = _bytes(f"<style>\n{raw_css}\n</style>") + _bytes(f"<script>\n{raw_js}\n</script>")
+    inline_css, inline_js = inline_html(assets)
+    inline_min = _bytes(inline_css) + _bytes(inline_js)
+    loader = _bytes(loader_html(assets))
+    fetched = sum(asset.size for asset in assets.values())
+
+    n = args.reruns
+    print(f"{'mode':<16}{'first run':>12}{'each rerun':>12}{f'{n} reruns':>14}")
+    print(f"{'before':<16}{before:>12}{before:>12}{before * n:>14}")
+    print(f"{'inline (min)':<16}{inline_min:>12}{inline_min:>12}{inline_min * n:>14}")
+    print(f"{'static':<16}{loader:>12}{0:>12}{loader:>14}")
+    print(f"  (static: 別途 static/ から {fetched} バイトを初回のみ取得、以降はブラウザキャッシュ)")
+
+    print()
+    print(f"{'image':<12}{'format':>8}{'width':>8}{'bytes':>10}{'vs png':>9}")
+    for name, image in build_images().items():
+        original = image.pick("png", image.width).size
+        for v in sorted(image.variants, key=lambda v: (v.fmt != "png", v.fmt, v.width)):
+            print(f"{name:<12}{v.fmt:>8}{v.width:>8}{v.size:>10}{v.size / original:>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# bench/bench_chat_log.py
+"""
+チャットログの再実行1回あたりの描画コストを、履歴の長さごとに比較する。
+
+  - before : 旧 render_chat_log（全メッセージを毎回 html.escape して連結し、[-50:] でコピー）
+  - after  : ChatLog.window_html（追加時に作ったバブル HTML の末尾 CHAT_LOG_WINDOW 件だけ）
+
+あわせて、ブラウザへ送る HTML のバイト数（≒ DOM に出るバブル数）も表示する。
+
+使い方（リポジトリのルートで）:
+    python bench/bench_chat_log.py [--reruns 200]
+"""
+import argparse
+import html
+import pathlib
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from chat_log import CHAT_LOG_WINDOW, ChatLog  # noqa: E402
+
+USER_TEXT = (
+    "来週の定例会議の日程を変更していただけないでしょうか\n\n"
+    "――――――――――\n"
+    "テンプレート: 日程調整 / トーン: 丁寧 / 相手: 社外"
+)
+GUIDE_TEXT = "日程調整メールを「丁寧」なトーンで、社外宛に作成しました！右側のプレビューをご覧ください。"
+
+
+def render_before(messages: list) -> str:
+    """変更前の render_chat_log と同じ処理。"""
+    if len(messages) > 50:
+        messages[:] = messages[-50:]
+    parts = ["<div class='chat-log'>"]
+    for msg in messages:
+        text = html.escape(msg["content"]).replace("\n", "<br>")
+        if msg["role"] == "user":
+            parts.append(f"<div class='chat-bubble user'>{text}</div>")
+        else:
+            parts.append(f"<div class='chat-bubble assistant'><span>{text}</span></div>")
+    parts.append("</div>")
+    return "\n".join(parts)
+
+
+def _per_rerun_us(fn, reruns: int) -> float:
+    start = time.perf_counter()
+    for _ in range(reruns):
+        fn()
+    return (time.perf_counter() - start) / reruns * 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--reruns", type=int, default=200)
+    args = ap.parse_args()
+
+    print(f"{'history':>8}{'before us':>12}{'after us':>11}{'before B':>11}{'after B':>10}")
+    for n in (2, 10, 20, 50):
+        messages = []
+        log = ChatLog()
+        for i in range(n // 2):
+            for role, text in (("user", f"{USER_TEXT} #{i}"), ("assistant", GUIDE_TEXT)):
+                messages.append({"role": role, "content": text})
+                log.append(role, text)
+
+        before_us = _per_rerun_us(lambda: render_before(messages), args.reruns)
+        after_us = _per_rerun_us(lambda: log.window_html(CHAT_LOG_WINDOW), args.reruns)
+        before_b = len(render_before(messages).encode("utf-8"))
+        after_b = len(log.window_html(CHAT_LOG_WINDOW).encode("utf-8"))
+        print(f"{n:>8}{before_us:>12.1f}{after_us:>11.2f}{before_b:>11}{after_b:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# bench/bench_metrics.py
+"""
+span（metrics_logic）1回あたりのオーバーヘッドを測る。
+本番で常に有効にしておけるか（送信1回に span が十数個付いても無視できるか）の確認用。
+
+使い方（リポジトリのルートで）:
+    python bench/bench_metrics.py [--n 200000] [--show]
+
+--show を付けると、計測後の Prometheus テキスト（/metrics と同じ内容）の先頭を表示する。
+"""
+import argparse
+import pathlib
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import metrics_logic  # noqa: E402
+from metrics_logic import observe_tokens, render_prometheus, span, trace  # noqa: E402
+
+
+def per_call_ns(fn, n: int) -> float:
+    start = time.perf_counter_ns()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter_ns() - start) / n
+
+
+def empty() -> None:
+    pass
+
+
+def with_span() -> None:
+    with span("bench"):
+        pass
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=200_000)
+    ap.add_argument("--show", action="store_true")
+    args = ap.parse_args()
+
+    base = per_call_ns(empty, args.n)
+    print(f"{'case':<28}{'ns/call':>10}")
+    print(f"{'no span':<28}{base:>10.0f}")
+
+    metrics_logic.METRICS_ENABLED = False
+    print(f"{'span (ARKY_METRICS=0)':<28}{per_call_ns(with_span, args.n):>10.0f}")
+    metrics_logic.METRICS_ENABLED = True
+    print(f"{'span (no trace)':<28}{per_call_ns(with_span, args.n):>10.0f}")
+    with trace("bench", template="依頼", tone="標準ビジネス", recipient="上司"):
+        print(f"{'span (in trace)':<28}{per_call_ns(with_span, args.n):>10.0f}")
+        observe_tokens("prompt", 1200)
+
+    start = time.perf_counter()
+    text = render_prometheus()
+    print(f"\nrender_prometheus: {(time.perf_counter() - start) * 1000:.2f} ms, {len(text)} bytes")
+    if args.show:
+        print("")
+        print("\n".join(text.splitlines()[:30]))
+
+
+if __name__ == "__main__":
+    main()
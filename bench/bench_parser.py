@@ -0,0 +1,108 @@
+# bench/bench_parser.py
+"""
+AI 出力パーサのマイクロベンチマーク。
+
+bench/corpus/*.md（実際の生成結果と同じ形式の Markdown）に対して、
+  - legacy : 旧 app.py の re.split + parse_pattern_block（呼び出しごとに正規表現を解釈）
+  - single : pattern_parser.parse_patterns（1回の走査・正規表現はコンパイル済み）
+を比較し、1レスポンスあたりの解析時間を表示する。
+
+使い方（リポジトリのルートで）:
+    python bench/bench_parser.py [--number 2000]
+"""
+import argparse
+import pathlib
+import re
+import sys
+import timeit
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from pattern_parser import parse_patterns  # noqa: E402
+
+CORPUS_DIR = pathlib.Path(__file__).resolve().parent / "corpus"
+
+
+# ============================================
+# 比較用：旧 app.py の実装（そのまま）
+# ============================================
+def legacy_parse_pattern_block(block: str) -> dict:
+    block = re.sub(r"^##\s*パターン[^\n]*\n?", "", block, count=1, flags=re.MULTILINE)
+
+    subject = ""
+    m = re.search(r"件名[:：]\s*(.+)", block)
+    if m:
+        subject = m.group(1).strip()
+
+    pos_body_label = block.find("本文:")
+    if pos_body_label != -1:
+        rest = block[pos_body_label + len("本文:") :]
+    else:
+        rest = block
+
+    idx_improve = rest.find("- 改善点")
+    idx_caution = rest.find("- 注意点")
+
+    if idx_improve != -1:
+        body = rest[:idx_improve].strip()
+        rest2 = rest[idx_improve:]
+    else:
+        body = rest.strip()
+        rest2 = ""
+
+    if rest2:
+        if idx_caution != -1 and rest2.find("- 注意点") > -1:
+            split_pos = rest2.find("- 注意点")
+            improve_block = rest2[:split_pos].strip()
+            caution_block = rest2[split_pos:].strip()
+        else:
+            improve_block = rest2.strip()
+            caution_block = ""
+    else:
+        improve_block = ""
+        caution_block = ""
+
+    improve = re.sub(r"^-+\s*改善点[:：]?\s*", "", improve_block, flags=re.MULTILINE).strip()
+    caution = re.sub(r"^-+\s*注意点[:：]?\s*", "", caution_block, flags=re.MULTILINE).strip()
+    return {"subject": subject, "body": body, "improve": improve, "caution": caution}
+
+
+def legacy_parse(ai_text: str) -> list:
+    raw_blocks = re.split(r"(?=^##\s*パターン\s*\d+)", ai_text, flags=re.MULTILINE)
+    blocks = [b.strip() for b in raw_blocks if b.strip()][:3]
+    while len(blocks) < 3:
+        blocks.append("このパターンはまだ生成されていません。")
+    return [legacy_parse_pattern_block(b) for b in blocks]
+
+
+def load_corpus() -> dict:
+    return {p.name: p.read_text(encoding="utf-8") for p in sorted(CORPUS_DIR.glob("*.md"))}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--number", type=int, default=2000, help="1ファイルあたりの繰り返し回数")
+    args = ap.parse_args()
+
+    corpus = load_corpus()
+    if not corpus:
+        sys.exit(f"コーパスがありません: {CORPUS_DIR}")
+
+    print(f"{'file':<28}{'legacy(us)':>12}{'single(us)':>12}{'speedup':>10}")
+    total_legacy = total_single = 0.0
+    for name, text in corpus.items():
+        # app.py は再実行のたびに保存用と表示用で2回解析していたので、legacy は ×2
+        t_legacy = timeit.timeit(lambda: (legacy_parse(text), legacy_parse(text)), number=args.number)
+        t_single = timeit.timeit(lambda: parse_patterns(text), number=args.number)
+        us_legacy = t_legacy / args.number * 1e6
+        us_single = t_single / args.number * 1e6
+        total_legacy += us_legacy
+        total_single += us_single
+        print(f"{name:<28}{us_legacy:>12.1f}{us_single:>12.1f}{us_legacy / us_single:>9.1f}x")
+
+    print(f"{'TOTAL':<28}{total_legacy:>12.1f}{total_single:>12.1f}{total_legacy / total_single:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
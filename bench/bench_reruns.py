@@ -0,0 +1,159 @@
+# bench/bench_reruns.py
+"""
+操作1回あたりのサーバ CPU 時間と、スクリプト全体の実行回数を測る。
+
+streamlit.testing の AppTest で app.py を動かし、
+  - load   : 初回表示
+  - submit : メッセージ送信（OpenAI / DB は使わない：API キー・Supabase を空にして実行）
+  - copy   : コピー用コンポーネントからのコピーイベント（1バッチ）の受信
+のそれぞれについて、スクリプト実行スレッドの CPU 時間（time.thread_time()。
+AppTest 自体の準備・結果解析は含まない）と、inject_assets() の呼び出し回数
+（＝スクリプト全体が上から実行された回数）を表示する。
+
+AppTest はウィジェット操作を常にスクリプト全体の再実行として扱うので、
+値が変わったウィジェットが @st.fragment の中にある場合は、ブラウザと同じく
+そのフラグメントだけを再実行するように RerunData に fragment_id を付ける。
+（コピー1回ごとではなくバッチごとの測定。ブラウザ側のコピー自体はサーバを使わない）
+
+使い方（リポジトリのルートで）:
+    python bench/bench_reruns.py [--repeat 5] [--app app.py]
+
+--app の相対パスは bench/ から見たパス（変更前と比べるときは
+`git show <rev>:app.py > bench/.app_before.py` として --app .app_before.py を渡す）。
+"""
+import argparse
+import os
+import pathlib
+import statistics
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# 外部サービスには繋がない（load_dotenv は既存の環境変数を上書きしない）
+os.environ["OPENAI_API_KEY"] = ""
+os.environ["SUPABASE_URL"] = ""
+os.environ["SUPABASE_KEY"] = ""
+
+import static_assets  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+from streamlit.testing.v1 import local_script_runner  # noqa: E402
+
+MESSAGE = "使用する会議室の交換をお願いしたい"
+
+full_runs = 0
+script_cpu_sec = 0.0
+_inject_assets = static_assets.inject_assets
+
+
+def _counting_inject_assets(*args, **kwargs) -> None:
+    global full_runs
+    full_runs += 1
+    _inject_assets(*args, **kwargs)
+
+
+static_assets.inject_assets = _counting_inject_assets
+
+# 次の run をこのフラグメントだけの再実行にする（None ならスクリプト全体）
+scoped_fragment_id: str | None = None
+_RerunData = local_script_runner.RerunData
+
+
+def _scoped_rerun_data(**kwargs):
+    if scoped_fragment_id is not None:
+        kwargs.setdefault("fragment_id_queue", [scoped_fragment_id])
+    return _RerunData(**kwargs)
+
+
+# LocalScriptRunner は初期リクエストと run() の両方で RerunData を作るので、両方に付ける
+local_script_runner.RerunData = _scoped_rerun_data
+
+# AppTest は run のたびに ScriptCache を作り直して app.py をコンパイルし直す。
+# 実際のサーバと同じくバイトコードを使い回し、コンパイル時間を測定から外す
+_script_cache = local_script_runner.ScriptCache()
+local_script_runner.ScriptCache = lambda: _script_cache
+
+
+def fragment_id(at: AppTest, func_name: str) -> str | None:
+    """app.py で @st.fragment を付けた関数名から、登録済みのフラグメント ID を探す。"""
+    for fid, wrapped in at._fragment_storage._fragments.items():
+        for cell in wrapped.__closure__ or ():
+            if getattr(cell.cell_contents, "__name__", None) == func_name:
+                return fid
+    return None
+
+
+_run_script = local_script_runner.LocalScriptRunner._run_script
+
+
+def _timed_run_script(self, rerun_data) -> None:
+    global script_cpu_sec
+    start = time.thread_time()
+    try:
+        _run_script(self, rerun_data)
+    finally:
+        script_cpu_sec += time.thread_time() - start
+
+
+local_script_runner.LocalScriptRunner._run_script = _timed_run_script
+
+
+def measure(step) -> tuple[float, int]:
+    global full_runs, script_cpu_sec
+    full_runs = 0
+    script_cpu_sec = 0.0
+    step()
+    return script_cpu_sec * 1000, full_runs
+
+
+def run_once(app_path: str) -> dict:
+    at = AppTest.from_file(app_path, default_timeout=60)
+    results = {}
+
+    results["load"] = measure(at.run)
+
+    def submit():
+        at.text_area[0].input(MESSAGE)
+        next(b for b in at.button if b.label == "✓ 送信").click()
+        at.run()
+
+    results["submit"] = measure(submit)
+
+    def copy():
+        global scoped_fragment_id
+        # ブラウザの setComponentValue と同じく、コンポーネントの値としてバッチを渡す
+        at.session_state["arky_copy"] = {
+            "batch": f"bench:{time.time_ns()}",
+            "events": [{"id": 0, "hash": "", "ts": int(time.time() * 1000)}],
+        }
+        scoped_fragment_id = fragment_id(at, "render_copy_logger")
+        try:
+            at.run()
+        finally:
+            scoped_fragment_id = None
+
+    results["copy"] = measure(copy)
+
+    if at.exception:
+        sys.exit(f"app.py で例外が発生しました: {at.exception}")
+    return results
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--app", default=str(ROOT / "app.py"))
+    args = ap.parse_args()
+
+    runs = [run_once(args.app) for _ in range(args.repeat + 1)][1:]  # 1回目はウォームアップ
+
+    print(f"{'step':<10}{'cpu ms (median)':>18}{'full runs':>12}")
+    for step in ("load", "submit", "copy"):
+        cpu = statistics.median(r[step][0] for r in runs)
+        passes = runs[-1][step][1]
+        print(f"{step:<10}{cpu:>18.1f}{passes:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+# bench/bench_suite.py
+"""
+OpenAI / Supabase につながずに、主要な処理を1つずつ計測するベンチマークスイート。
+bench/stub_servers.py のスタブ（記録済みの応答を返す OpenAI 互換サーバと、
+メモリ上の PostgREST 互換サーバ）を同じプロセス内で起動し、実際のクライアント
+（openai SDK / supabase-py）越しに呼び出す。
+
+  - parse_pattern_block         : 1パターン分の Markdown の解析
+  - generate_email              : ローカル下書き（app.py の generate_email）
+  - generate_email_with_openai  : 3パターン生成（Markdown 1回・キャッシュはヒットさせない）
+  - ...[structured]             : JSON スキーマでの生成（ARKY_STRUCTURED_OUTPUT=1 相当）
+  - ...[errors]                 : --error-rate の割合で 429 を返す（リトライ込みのコスト）
+  - stream_email_with_openai    : ストリーミングで最後まで受け取る
+  - save_email_batch            : 3行の upsert（write-behind なし・同期）
+  - log_copy_click              : コピーログ1行の insert（サンプリングなし）
+
+使い方（リポジトリのルートで）:
+    python bench/bench_suite.py                    # 計測してベースラインと比べる
+    python bench/bench_suite.py --save-baseline    # 今回の結果をベースラインとして保存
+    python bench/bench_suite.py --only openai --ttft 0.05 --db-latency 0.01
+
+ベースライン（既定は bench/baselines/bench_suite.json）より p50 が --tolerance 以上、
+かつ --min-delta-us 以上遅くなったケースを REGRESSION と表示し、終了コード 1 で終わる。
+ベースラインはマシンごとの値なのでリポジトリには入れていない（.gitignore 済み）。
+初めて動かすマシンでは、比べたい変更の前のコミットで --save-baseline を1回実行してから、
+変更後に引数なしで実行する。ベースラインが無いときは計測結果を表示するだけで終わる。
+"""
+import argparse
+import ast
+import contextlib
+import io
+import itertools
+import json
+import os
+import pathlib
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from stub_servers import OpenAIStubConfig, StubOpenAIServer, StubPostgrestServer  # noqa: E402
+
+CORPUS_DIR = pathlib.Path(__file__).resolve().parent / "corpus"
+DEFAULT_BASELINE = pathlib.Path(__file__).resolve().parent / "baselines" / "bench_suite.json"
+
+MESSAGE = "来週の定例会議で使う会議室を交換してほしい"
+# app.py のサイドバーで選べる値（トーンは display_to_tone の値）
+CASES = [
+    (template, tone, recipient)
+    for template in ("依頼", "お礼", "謝罪")
+    for tone in ("標準ビジネス", "フォーマル")
+    for recipient in ("上司", "取引先")
+]
+
+
+def configure_environment(openai_url: str, postgrest_url: str, workdir: str) -> None:
+    """openai_logic / db_logic を import する前に、スタブにつなぐ環境変数を設定する。"""
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "stub",
+            "OPENAI_BASE_URL": openai_url,
+            "SUPABASE_URL": postgrest_url,
+            "SUPABASE_KEY": "stub",
+            # 呼び出しスレッドで書き込むコストを測る
+            "ARKY_DB_WRITE_BEHIND": "0",
+            "ARKY_COPY_LOG_RAW_SAMPLE_RATE": "1",
+            "ARKY_CACHE_DB": os.path.join(workdir, "cache.sqlite3"),
+            "ARKY_OUTBOX_DB": os.path.join(workdir, "outbox.sqlite3"),
+            "ARKY_QUOTA_STATE": os.path.join(workdir, "quota.json"),
+            "ARKY_USAGE_LOG": "",
+            "ARKY_TRACE_LOG": "",
+            "OPENAI_BACKOFF_BASE_SEC": "0",
+            # 1回あたりのコストを測るので、レート制限では待たせない
+            "OPENAI_RATE_LIMIT_RPM": "0",
+            "OPENAI_RATE_LIMIT_TPM": "0",
+        }
+    )
+
+
+def load_generate_email() -> Callable:
+    """app.py から generate_email だけを取り出す（app.py 全体は Streamlit なので実行しない）。"""
+    from template_registry import get_registry
+
+    src = (ROOT / "app.py").read_text(encoding="utf-8")
+    fn = next(
+        node
+        for node in ast.parse(src).body
+        if isinstance(node, ast.FunctionDef) and node.name == "generate_email"
+    )
+    namespace: dict = {"get_registry": get_registry}
+    exec(ast.get_source_segment(src, fn), namespace)
+    return namespace["generate_email"]
+
+
+def corpus_blocks() -> List[str]:
+    from pattern_parser import split_pattern_blocks
+
+    blocks: List[str] = []
+    for path in sorted(CORPUS_DIR.glob("*.md")):
+        blocks.extend(split_pattern_blocks(path.read_text(encoding="utf-8")))
+    return blocks
+
+
+def build_cases(openai_stub: StubOpenAIServer, error_rate: float) -> Dict[str, tuple]:
+    """ケース名 -> (1回分の呼び出し(i), 既定の回数, 計測前に呼ぶ準備(なければ None))"""
+    import db_logic
+    import openai_logic
+    from pattern_parser import parse_pattern_block
+
+    generate_email = load_generate_email()
+    blocks = corpus_blocks()
+    run_id = time.time_ns()
+    serial = itertools.count()
+
+    def openai_kwargs(i: int) -> dict:
+        template, tone, recipient = CASES[i % len(CASES)]
+        # ケースをまたいでも毎回違う入力にして、応答キャッシュにはヒットさせない
+        return dict(
+            template=template,
+            tone=tone,
+            recipient=recipient,
+            message=f"{MESSAGE}（{run_id}-{next(serial)}）",
+        )
+
+    def without_errors() -> None:
+        openai_stub.config.error_rate = 0.0
+        openai_stub.reseed(0)
+
+    def with_errors() -> None:
+        openai_stub.config.error_rate = error_rate
+        openai_stub.reseed(0)
+
+    def consume_stream(i: int) -> None:
+        for _ in openai_logic.stream_email_with_openai(**openai_kwargs(i)):
+            pass
+
+    def save_batch(i: int) -> None:
+        template, tone, recipient = CASES[i % len(CASES)]
+        db_logic.save_email_batch(
+            template=template,
+            tone=tone,
+            recipient=recipient,
+            message=MESSAGE,
+            seasonal_greeting=False,
+            patterns=[{"subject": f"件名{n}", "body": blocks[n % len(blocks)]} for n in range(3)],
+        )
+
+    def copy_click(i: int) -> None:
+        template, tone, recipient = CASES[i % len(CASES)]
+        db_logic.log_copy_click(
+            template=template, tone=tone, recipient=recipient, pattern_index=i % 3 + 1
+        )
+
+    return {
+        "parse_pattern_block": (lambda i: parse_pattern_block(blocks[i % len(blocks)]), 20000, None),
+        "generate_email": (
+            lambda i: generate_email(*CASES[i % len(CASES)], MESSAGE, variation=i),
+            20000,
+            None,
+        ),
+        "generate_email_with_openai": (
+            lambda i: openai_logic.generate_email_with_openai(**openai_kwargs(i), structured=False),
+            200,
+            without_errors,
+        ),
+        "generate_email_with_openai[structured]": (
+            lambda i: openai_logic.generate_email_with_openai(**openai_kwargs(i), structured=True),
+            200,
+            without_errors,
+        ),
+        "generate_email_with_openai[errors]": (
+            lambda i: openai_logic.generate_email_with_openai(**openai_kwargs(i), structured=False),
+            200,
+            with_errors,
+        ),
+        "stream_email_with_openai": (consume_stream, 200, without_errors),
+        "save_email_batch": (save_batch, 300, None),
+        "log_copy_click": (copy_click, 300, None),
+    }
+
+
+def measure(call: Callable[[int], object], number: int, warmup: int) -> dict:
+    samples = []
+    # db_logic などのデバッグ用 print は捨てる
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(warmup):
+            call(i)
+        for i in range(warmup, warmup + number):
+            start = time.perf_counter()
+            call(i)
+            samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "n": number,
+        "p50_us": round(statistics.median(samples), 2),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        "mean_us": round(statistics.fmean(samples), 2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_us: float) -> List[str]:
+    """ベースラインより遅くなったケース名のリスト。"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("cases", {}).get(name)
+        if base is None:
+            continue
+        delta = result["p50_us"] - base["p50_us"]
+        if delta > base["p50_us"] * tolerance and delta > min_delta_us:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--only", help="ケース名にこの文字列を含むものだけ実行する")
+    ap.add_argument("--scale", type=float, default=1.0, help="各ケースの回数の倍率")
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--ttft", type=float, default=0.0, help="スタブの最初のチャンクまでの秒数")
+    ap.add_argument("--chunk-interval", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.2, help="[errors] ケースで 429 を返す割合")
+    ap.add_argument("--db-latency", type=float, default=0.0, help="PostgREST スタブの応答遅延（秒）")
+    ap.add_argument("--baseline", type=pathlib.Path, default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="p50 の許容する悪化率")
+    ap.add_argument("--min-delta-us", type=float, default=5.0, help="これ未満の差はノイズとみなす")
+    args = ap.parse_args()
+
+    openai_stub = StubOpenAIServer(
+        config=OpenAIStubConfig(ttft_sec=args.ttft, chunk_interval_sec=args.chunk_interval)
+    ).start()
+    postgrest_stub = StubPostgrestServer(latency_sec=args.db_latency).start()
+    workdir = tempfile.mkdtemp(prefix="arky-bench-")
+    configure_environment(openai_stub.base_url, postgrest_stub.url, workdir)
+
+    cases = build_cases(openai_stub, args.error_rate)
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if not baseline and not args.save_baseline:
+        print(f"ベースラインがありません（{args.baseline}）。--save-baseline で作成できます。")
+
+    results: Dict[str, dict] = {}
+    print(f"{'case':<42}{'n':>7}{'p50 us':>12}{'p95 us':>12}{'base p50':>12}{'diff':>9}")
+    for name, (call, number, prepare) in cases.items():
+        if args.only and args.only not in name:
+            continue
+        if prepare is not None:
+            prepare()
+        result = measure(call, max(1, int(number * args.scale)), args.warmup)
+        results[name] = result
+        base = baseline.get("cases", {}).get(name)
+        base_text, diff_text = "-", "-"
+        if base is not None:
+            base_text = f"{base['p50_us']:.1f}"
+            diff_text = f"{(result['p50_us'] / base['p50_us'] - 1) * 100:+.0f}%"
+        print(
+            f"{name:<42}{result['n']:>7}{result['p50_us']:>12.1f}{result['p95_us']:>12.1f}"
+            f"{base_text:>12}{diff_text:>9}"
+        )
+
+    print("")
+    print(f"openai stub    : {openai_stub.counts}")
+    print(f"postgrest stub : {postgrest_stub.counts}")
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        saved = baseline.get("cases", {}) if args.only else {}
+        saved.update(results)
+        args.baseline.write_text(
+            json.dumps(
+                {
+                    "machine": f"{platform.node()} / {platform.machine()} / Python {platform.python_version()}",
+                    "saved_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "stub": {"ttft": args.ttft, "db_latency": args.db_latency},
+                    "cases": saved,
+                },
+                ensure_ascii=False,
+                indent=2,
+            )
+            + "\n"
+        )
+        print(f"baseline saved : {args.baseline}")
+        return
+
+    regressions = compare(results, baseline, args.tolerance, args.min_delta_us)
+    for name in regressions:
+        print(f"REGRESSION: {name}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# bench/bench_templates.py
+"""
+generate_email（ローカル下書き）の1回あたりのコストを測る。
+
+  - load   : templates/email_templates.json の読み込み＋索引の展開（起動時に1回）
+  - render : TemplateRegistry.render（辞書を1回引いて format するだけ）
+  - before : --before <rev> を渡したとき、そのリビジョンの app.py の generate_email
+             （呼び出しのたびに件名・挨拶・結びなどの辞書を作り直す）
+
+使い方（リポジトリのルートで）:
+    python bench/bench_templates.py [--calls 20000] [--before <rev>]
+"""
+import argparse
+import ast
+import pathlib
+import subprocess
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from template_registry import TEMPLATES_PATH, load_registry  # noqa: E402
+
+MESSAGE = "来週の定例会議の日程を変更していただきたい"
+CASES = [
+    (template, recipient)
+    for template in ("依頼", "提案", "お礼", "謝罪", "挨拶", "報告")
+    for recipient in ("上司", "同僚", "部下", "社外企業社員", "取引先", "顧客")
+]
+
+
+def load_before(rev: str):
+    """git の <rev> にある app.py から generate_email だけを取り出す（app.py 全体は実行しない）。"""
+    src = subprocess.run(
+        ["git", "show", f"{rev}:app.py"], cwd=ROOT, check=True, capture_output=True, text=True
+    ).stdout
+    fn = next(
+        node
+        for node in ast.parse(src).body
+        if isinstance(node, ast.FunctionDef) and node.name == "generate_email"
+    )
+    namespace: dict = {}
+    exec(ast.get_source_segment(src, fn), namespace)
+    return namespace["generate_email"]
+
+
+def _per_call_us(call, calls: int) -> float:
+    start = time.perf_counter()
+    for i in range(calls):
+        template, recipient = CASES[i % len(CASES)]
+        call(template, recipient, i)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=20000)
+    ap.add_argument("--before", help="比較する変更前のリビジョン（例: HEAD~1）")
+    args = ap.parse_args()
+
+    start = time.perf_counter()
+    registry = load_registry(TEMPLATES_PATH)
+    load_ms = (time.perf_counter() - start) * 1000
+    print(f"load    {load_ms:8.2f} ms  （索引 {len(registry)} 件）")
+
+    render_us = _per_call_us(
+        lambda t, r, v: registry.render(t, r, MESSAGE, variation=v, seasonal_text="初秋の候"),
+        args.calls,
+    )
+    print(f"render  {render_us:8.2f} us / call")
+
+    if args.before:
+        generate_email = load_before(args.before)
+        before_us = _per_call_us(
+            lambda t, r, v: generate_email(t, "標準ビジネス", r, MESSAGE, v, "初秋の候"),
+            args.calls,
+        )
+        print(f"before  {before_us:8.2f} us / call")
+
+
+if __name__ == "__main__":
+    main()
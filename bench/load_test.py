@@ -0,0 +1,367 @@
+# bench/load_test.py
+"""
+1つのサーバプロセスで、同時に何セッションまで捌けるかを見る負荷試験。
+
+streamlit.testing の AppTest で app.py を N セッション分（ユーザーごとに1スレッド）動かし、
+実際の操作の流れ
+  load（初回表示）→ sidebar（テンプレート・トーン・相手の選択）→ submit（送信）
+  → refine（追加要望）→ copy（コピーイベント1バッチ）→ reset
+を繰り返す。submit / refine は、生成ジョブ（jobs_logic）が終わるまで
+render_generation_job フラグメントだけを JOB_POLL_INTERVAL_SEC ごとに再実行して待ち、
+送信から結果の表示までを1回の待ち時間として数える。OpenAI / Supabase の代わりに bench/stub_servers.py を別プロセスで起動する
+（スタブの CPU・メモリを測定に混ぜないため）。
+
+同時セッション数を --levels の順に増やしながら、段階ごとに
+  - 操作1回あたりの待ち時間（p50 / p95 / p99。AppTest.run の壁時計時間）
+  - 再実行1回あたりの CPU 時間（プロセス全体の CPU 時間 / 再実行回数）
+  - 1セッションあたりの RSS 増分（段階の開始時からの増分 / セッション数）
+を表示する。AppTest はブラウザとの通信（WebSocket・差分の送信）を含まないので、
+実際のサーバより少し軽く出る。スクリプト実行スレッドの混み具合を見るためのもの。
+
+使い方（リポジトリのルートで）:
+    python bench/load_test.py [--levels 1,2,4,8,16] [--iterations 3] [--ttft 0.3]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import os
+import pathlib
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+ACTIONS = ("load", "sidebar", "submit", "refine", "copy", "reset")
+# app.py のサイドバーの選択肢（ラベルに含まれる文字列で選ぶ）
+TEMPLATES = ("依頼", "お礼", "謝罪", "提案")
+TONES = ("標準ビジネス", "フォーマル", "カジュアル")
+RECIPIENTS = ("上司", "同僚", "取引先")
+MESSAGES = (
+    "来週の定例会議で使う会議室を交換してほしい",
+    "先日の打ち合わせのお礼を伝えたい",
+    "納品が1日遅れることをお詫びしたい",
+    "今月の作業の進捗を報告したい",
+)
+REFINES = ("もう少し丁寧に", "全体を短く", "期限を明記して")
+# app.py の render_generation_job と同じポーリング間隔
+JOB_POLL_INTERVAL_SEC = float(os.getenv("ARKY_JOB_POLL_INTERVAL_SEC", "0.5"))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout_sec: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"スタブサーバ（ポート {port}）が起動しませんでした")
+
+
+def start_stubs(args) -> subprocess.Popen:
+    """スタブを別プロセスで起動し、アプリがそちらにつながるよう環境変数を設定する。"""
+    openai_port, postgrest_port = _free_port(), _free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            str(BENCH_DIR / "stub_servers.py"),
+            "--openai-port", str(openai_port),
+            "--postgrest-port", str(postgrest_port),
+            "--ttft", str(args.ttft),
+            "--chunk-interval", str(args.chunk_interval),
+            "--db-latency", str(args.db_latency),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    _wait_for_port(openai_port)
+    _wait_for_port(postgrest_port)
+
+    workdir = tempfile.mkdtemp(prefix="arky-load-")
+    os.environ.update(
+        {
+            "OPENAI_API_KEY": "stub",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+            "SUPABASE_URL": f"http://127.0.0.1:{postgrest_port}",
+            "SUPABASE_KEY": "stub",
+            "ARKY_CACHE_DB": os.path.join(workdir, "cache.sqlite3"),
+            "ARKY_OUTBOX_DB": os.path.join(workdir, "outbox.sqlite3"),
+            "ARKY_QUOTA_STATE": os.path.join(workdir, "quota.json"),
+            "ARKY_USAGE_LOG": "",
+            "ARKY_TRACE_LOG": "",
+        }
+    )
+    return proc
+
+
+def rss_bytes() -> int:
+    """このプロセスの現在の RSS（Linux は /proc、それ以外は ru_maxrss で代用）。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def install_runner_patches():
+    """
+    AppTest の実行まわりを実際のサーバに近づける（bench_reruns.py と同じ）。
+      - app.py のバイトコードを使い回す（run のたびにコンパイルし直さない）
+      - コピー・生成ジョブのポーリングはブラウザと同じくフラグメントだけを再実行する
+        （フラグメントの指定はセッション（スレッド）ごと）
+      - Runtime を全セッションで共有する。AppTest は run のたびにモックの Runtime を
+        作って終わりに消すので、複数セッションを同時に動かすと、ほかのセッションの
+        run の途中で消えてしまう（実際のサーバでも Runtime はプロセスに1つ）
+    """
+    from streamlit.runtime.runtime import Runtime
+    from streamlit.testing.v1 import local_script_runner
+
+    shared: dict = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            shared.setdefault("runtime", cls._instance)
+        runtime = shared.get("runtime")
+        if runtime is None:
+            raise RuntimeError("Runtime hasn't been created!")
+        return runtime
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or "runtime" in shared)
+
+    scoped = threading.local()
+    rerun_data = local_script_runner.RerunData
+
+    def scoped_rerun_data(**kwargs):
+        fragment_id = getattr(scoped, "fragment_id", None)
+        if fragment_id is not None:
+            kwargs.setdefault("fragment_id_queue", [fragment_id])
+        return rerun_data(**kwargs)
+
+    local_script_runner.RerunData = scoped_rerun_data
+    script_cache = local_script_runner.ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+    return scoped
+
+
+def fragment_id(at, func_name: str) -> str | None:
+    for fid, wrapped in at._fragment_storage._fragments.items():
+        for cell in wrapped.__closure__ or ():
+            if getattr(cell.cell_contents, "__name__", None) == func_name:
+                return fid
+    return None
+
+
+class SimulatedUser:
+    """1セッション分の操作。各操作の待ち時間を latencies に追記する。"""
+
+    def __init__(self, user_id: int, scoped, latencies: Dict[str, List[float]], lock: threading.Lock):
+        self.rng = random.Random(user_id)
+        self.scoped = scoped
+        self.latencies = latencies
+        self.lock = lock
+        self.at = None
+        self.reruns = 0
+        self.errors: List[str] = []
+
+    def _timed(self, action: str, run) -> None:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        self.reruns += 1
+        with self.lock:
+            self.latencies[action].append(elapsed)
+        if self.at.exception:
+            self.errors.append(f"{action}: {self.at.exception[0].message}")
+
+    def _submit(self, text: str) -> None:
+        self.at.text_area(key="user_message_input").input(text)
+        next(b for b in self.at.button if b.label == "✓ 送信").click()
+        self.at.run()
+        self._wait_generation()
+
+    def _wait_generation(self) -> None:
+        """生成ジョブが終わるまで、ブラウザと同じく render_generation_job だけを再実行する。"""
+        while self.at.session_state["generation_job"] is not None:
+            time.sleep(JOB_POLL_INTERVAL_SEC)
+            self._run_fragment("render_generation_job")
+            self.reruns += 1
+
+    def _run_fragment(self, func_name: str) -> None:
+        self.scoped.fragment_id = fragment_id(self.at, func_name)
+        page = self.at._tree
+        try:
+            self.at.run()
+        finally:
+            self.scoped.fragment_id = None
+        # フラグメントだけの再実行では AppTest の要素ツリーがフラグメント分だけになる。
+        # ブラウザと同じく、ほかの部分は直前の表示のまま残しておく
+        # （フラグメントが st.rerun() でアプリ全体を再実行したときは新しいツリーを使う）
+        if self.at.session_state["generation_job"] is not None or func_name != "render_generation_job":
+            page._runner = self.at
+            self.at._tree = page
+
+    def session(self, iterations: int) -> None:
+        from streamlit.testing.v1 import AppTest
+
+        self.at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=120)
+        self._timed("load", self.at.run)
+        for _ in range(iterations):
+            # 初回送信のあとはサイドバーがロックされる（ブラウザでも選び直せない）
+            if not self.at.radio(key="template_radio").disabled:
+                self._timed("sidebar", self._choose_sidebar)
+            self._timed("submit", lambda: self._submit(self.rng.choice(MESSAGES)))
+            self._timed("refine", lambda: self._submit(self.rng.choice(REFINES)))
+            self._timed("copy", self._copy)
+            self._timed("reset", self._reset)
+
+    def _choose_sidebar(self) -> None:
+        at = self.at
+        for key, labels in (
+            ("template_radio", TEMPLATES),
+            ("tone_radio", TONES),
+            ("recipient_radio", RECIPIENTS),
+        ):
+            radio = at.radio(key=key)
+            options = [o for o in radio.options if any(label in o for label in labels)]
+            if options:
+                radio.set_value(self.rng.choice(options))
+        at.run()
+
+    def _copy(self) -> None:
+        from copy_component import content_hash, generation_key
+
+        # ブラウザと同じく、表示中のパターンの hash と生成キーを付ける（合わないイベントは捨てられる）
+        patterns = self.at.session_state["ai_patterns"] or []
+        if not patterns:
+            return
+        hashes = [content_hash(p.raw) for p in patterns]
+        idx = self.rng.randrange(len(hashes))
+        self.at.session_state["arky_copy"] = {
+            "batch": f"load:{time.time_ns()}",
+            "events": [
+                {
+                    "id": idx,
+                    "hash": hashes[idx],
+                    "gen": generation_key(hashes),
+                    "ts": int(time.time() * 1000),
+                }
+            ],
+        }
+        self._run_fragment("render_copy_logger")
+
+    def _reset(self) -> None:
+        next(b for b in self.at.button if b.label == "リセット").click()
+        self.at.run()
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run_level(concurrency: int, iterations: int, scoped) -> dict:
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    lock = threading.Lock()
+    users = [SimulatedUser(i, scoped, latencies, lock) for i in range(concurrency)]
+
+    gc.collect()
+    rss_before = rss_bytes()
+    rss_peak = rss_before
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+
+    threads = [
+        threading.Thread(target=u.session, args=(iterations,), name=f"user-{i}", daemon=True)
+        for i, u in enumerate(users)
+    ]
+    # app.py・db_logic のデバッグ用 print は捨てる（表が読めなくなるので）
+    with contextlib.redirect_stdout(io.StringIO()):
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            rss_peak = max(rss_peak, rss_bytes())
+            time.sleep(0.05)
+
+    # セッション（AppTest）を保持したままの RSS
+    rss_peak = max(rss_peak, rss_bytes())
+    reruns = sum(u.reruns for u in users)
+    return {
+        "concurrency": concurrency,
+        "reruns": reruns,
+        "wall_sec": time.perf_counter() - wall_before,
+        "cpu_ms_per_rerun": (time.process_time() - cpu_before) * 1000 / max(reruns, 1),
+        "rss_mb_per_session": (rss_peak - rss_before) / concurrency / 2**20,
+        "latencies": latencies,
+        "errors": [e for u in users for e in u.errors],
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--levels", default="1,2,4,8,16", help="同時セッション数（カンマ区切り）")
+    ap.add_argument("--iterations", type=int, default=3, help="1セッションあたりの繰り返し回数")
+    ap.add_argument("--ttft", type=float, default=0.3, help="スタブの最初のチャンクまでの秒数")
+    ap.add_argument("--chunk-interval", type=float, default=0.005)
+    ap.add_argument("--db-latency", type=float, default=0.03)
+    ap.add_argument("--by-action", action="store_true", help="操作ごとの p50 / p95 も表示する")
+    args = ap.parse_args()
+
+    stubs = start_stubs(args)
+    try:
+        scoped = install_runner_patches()
+        # ウォームアップ（import・テンプレートの読み込みなど、プロセスで1回だけのもの）
+        run_level(1, 1, scoped)
+
+        print(
+            f"{'users':>6}{'reruns':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+            f"{'cpu ms/rerun':>14}{'rss MB/sess':>13}{'errors':>8}"
+        )
+        for concurrency in (int(x) for x in args.levels.split(",")):
+            result = run_level(concurrency, args.iterations, scoped)
+            all_latencies = [v for values in result["latencies"].values() for v in values]
+            print(
+                f"{concurrency:>6}{result['reruns']:>8}"
+                f"{statistics.median(all_latencies) * 1000:>9.0f}"
+                f"{percentile(all_latencies, 0.95) * 1000:>9.0f}"
+                f"{percentile(all_latencies, 0.99) * 1000:>9.0f}"
+                f"{result['cpu_ms_per_rerun']:>14.1f}"
+                f"{result['rss_mb_per_session']:>13.2f}"
+                f"{len(result['errors']):>8}"
+            )
+            if args.by_action:
+                for action in ACTIONS:
+                    values = result["latencies"].get(action)
+                    if values:
+                        print(
+                            f"{'':>6}  {action:<8}p50 {statistics.median(values) * 1000:>7.0f} ms"
+                            f"   p95 {percentile(values, 0.95) * 1000:>7.0f} ms"
+                        )
+            for error in result["errors"][:3]:
+                print(f"        ! {error}")
+    finally:
+        stubs.terminate()
+        stubs.wait()
+
+
+if __name__ == "__main__":
+    main()
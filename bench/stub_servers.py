@@ -0,0 +1,438 @@
+# bench/stub_servers.py
+"""
+ベンチマーク用のローカルなスタブサーバ（OpenAI / Supabase を使わずに計測するため）。
+
+  - StubOpenAIServer   : OpenAI 互換の POST /v1/chat/completions。
+                         bench/recordings/openai_chat.json の応答を順に返す
+                         （通常・ストリーミング・JSON スキーマ）。遅延とエラーを注入できる。
+  - StubPostgrestServer : PostgREST 互換の /rest/v1/<table>（メモリ上のテーブル）。
+                         test_arky_patterns / email_copy_log / email_copy_rollup の
+                         insert・upsert（on_conflict）・select（order / limit / eq）に対応。
+
+bench/bench_suite.py から使うほか、単体で起動してアプリをつなぐこともできる:
+
+    python bench/stub_servers.py [--openai-port 8901] [--postgrest-port 8902]
+        [--ttft 0.8] [--chunk-interval 0.02] [--error-rate 0.05] [--db-latency 0.03]
+
+    OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:8901/v1 \\
+    SUPABASE_URL=http://127.0.0.1:8902 SUPABASE_KEY=stub streamlit run app.py
+"""
+import argparse
+import json
+import pathlib
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlsplit
+
+RECORDINGS_PATH = pathlib.Path(__file__).resolve().parent / "recordings" / "openai_chat.json"
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # クライアントが途中で切断した（リトライ・ストリームの打ち切り）のは想定内
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+# ============================================
+# OpenAI 互換スタブ
+# ============================================
+@dataclass
+class OpenAIStubConfig:
+    """実行中に書き換えてよい（次のリクエストから反映される）。"""
+
+    ttft_sec: float = 0.0  # 最初のチャンク（通常の応答では応答全体）までの待ち時間
+    chunk_interval_sec: float = 0.0  # ストリーミングのチャンク間隔
+    chunk_chars: int = 8  # ストリーミングの1チャンクの文字数
+    error_rate: float = 0.0  # この割合のリクエストを error_status で失敗させる
+    error_status: int = 429
+    retry_after_sec: float = 0.0  # 429 に付ける Retry-After
+    seed: int = 0
+
+
+def load_recordings(path: pathlib.Path = RECORDINGS_PATH) -> Dict[str, List[dict]]:
+    """format（markdown / email_patterns / email_pattern）ごとの応答のリスト。"""
+    data = json.loads(path.read_text(encoding="utf-8"))
+    by_format: Dict[str, List[dict]] = {}
+    for response in data["responses"]:
+        by_format.setdefault(response["format"], []).append(response)
+    return by_format
+
+
+class StubOpenAIServer:
+    """
+    記録済みの応答を返す OpenAI 互換サーバ。start() でバックグラウンドのスレッドで動く。
+    counts には受け付けたリクエスト数・注入したエラー数が入る。
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        config: OpenAIStubConfig | None = None,
+        recordings_path: pathlib.Path = RECORDINGS_PATH,
+    ):
+        self.config = config or OpenAIStubConfig()
+        self.recordings = load_recordings(recordings_path)
+        self.counts = {"requests": 0, "stream_requests": 0, "errors_injected": 0}
+        self._cursor: Dict[str, int] = {}
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._server = _QuietServer(("127.0.0.1", port), self._handler_class())
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/v1"
+
+    def start(self) -> "StubOpenAIServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reseed(self, seed: int) -> None:
+        with self._lock:
+            self._rng = random.Random(seed)
+            self._cursor.clear()
+
+    def _next_response(self, response_format) -> dict:
+        fmt = "markdown"
+        if isinstance(response_format, dict) and response_format.get("type") == "json_schema":
+            fmt = response_format["json_schema"]["name"]
+        with self._lock:
+            responses = self.recordings[fmt]
+            i = self._cursor.get(fmt, 0)
+            self._cursor[fmt] = i + 1
+        return responses[i % len(responses)]
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            self.counts["requests"] += 1
+            fail = self._rng.random() < self.config.error_rate
+            if fail:
+                self.counts["errors_injected"] += 1
+            return fail
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # ヘッダと本文を別々に書くので、Nagle + 遅延 ACK の 40ms 待ちを避ける
+            disable_nagle_algorithm = True
+
+            def do_POST(self) -> None:
+                if not urlsplit(self.path).path.endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                config = stub.config
+
+                if stub._should_fail():
+                    time.sleep(config.ttft_sec)
+                    headers = {}
+                    if config.error_status == 429:
+                        headers["retry-after"] = str(config.retry_after_sec)
+                    self._send_json(
+                        config.error_status,
+                        {"error": {"message": "injected error", "type": "stub_error"}},
+                        headers,
+                    )
+                    return
+
+                response = stub._next_response(request.get("response_format"))
+                completion_id = f"chatcmpl-stub-{uuid.uuid4().hex[:12]}"
+                model = request.get("model", "stub")
+                time.sleep(config.ttft_sec)
+
+                if request.get("stream"):
+                    with stub._lock:
+                        stub.counts["stream_requests"] += 1
+                    include_usage = (request.get("stream_options") or {}).get("include_usage")
+                    self._send_stream(completion_id, model, response, include_usage, config)
+                    return
+
+                self._send_json(
+                    200,
+                    {
+                        "id": completion_id,
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": response["content"]},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": _usage_payload(response["usage"]),
+                    },
+                )
+
+            def _send_json(self, status: int, payload: dict, headers: dict | None = None) -> None:
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_stream(self, completion_id, model, response, include_usage, config) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def event(choices: list, usage=None) -> None:
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": choices,
+                    }
+                    if usage is not None:
+                        chunk["usage"] = usage
+                    self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+
+                content = response["content"]
+                step = max(1, config.chunk_chars)
+                for start in range(0, len(content), step):
+                    if start and config.chunk_interval_sec:
+                        time.sleep(config.chunk_interval_sec)
+                    event(
+                        [
+                            {
+                                "index": 0,
+                                "delta": {"content": content[start : start + step]},
+                                "finish_reason": None,
+                            }
+                        ]
+                    )
+                event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if include_usage:
+                    event([], usage=_usage_payload(response["usage"]))
+                self._write_chunk("data: [DONE]\n\n")
+                self._write_chunk("")
+
+            def _write_chunk(self, text: str) -> None:
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
+
+
+def _usage_payload(usage: dict) -> dict:
+    prompt = usage.get("prompt_tokens", 0)
+    completion = usage.get("completion_tokens", 0)
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+        "prompt_tokens_details": usage.get("prompt_tokens_details", {"cached_tokens": 0}),
+    }
+
+
+# ============================================
+# PostgREST 互換スタブ（Supabase のテーブル API）
+# ============================================
+class StubPostgrestServer:
+    """
+    メモリ上のテーブルに対する PostgREST 互換サーバ。supabase-py の
+    table(...).insert / upsert(on_conflict, ignore_duplicates) / select().order().limit()
+    が使う範囲だけを実装している。tables にテーブル名 -> 行のリストが入る。
+    """
+
+    def __init__(self, port: int = 0, latency_sec: float = 0.0):
+        self.latency_sec = latency_sec
+        self.tables: Dict[str, List[dict]] = {}
+        self.counts = {"requests": 0, "rows_written": 0}
+        self._next_id: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._server = _QuietServer(("127.0.0.1", port), self._handler_class())
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self) -> "StubPostgrestServer":
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def write(self, table: str, rows: List[dict], on_conflict: List[str], resolution: str) -> List[dict]:
+        """insert / upsert。書き込んだ（または更新した）行を返す。"""
+        written = []
+        with self._lock:
+            stored = self.tables.setdefault(table, [])
+            for row in rows:
+                row = dict(row)
+                existing = None
+                if on_conflict:
+                    key = tuple(row.get(c) for c in on_conflict)
+                    existing = next(
+                        (r for r in stored if tuple(r.get(c) for c in on_conflict) == key), None
+                    )
+                if existing is not None:
+                    if resolution == "ignore-duplicates":
+                        continue
+                    existing.update(row)
+                    written.append(existing)
+                    continue
+                if "id" not in row:
+                    row["id"] = self._next_id.get(table, 1)
+                    self._next_id[table] = row["id"] + 1
+                stored.append(row)
+                written.append(row)
+            self.counts["rows_written"] += len(written)
+        return written
+
+    def read(self, table: str, params: Dict[str, List[str]]) -> List[dict]:
+        """select=a,b / order=col.desc / limit=n / col=eq.value に対応。"""
+        with self._lock:
+            rows = list(self.tables.get(table, []))
+        for column, values in params.items():
+            if column in ("select", "order", "limit", "offset"):
+                continue
+            op, _, value = values[0].partition(".")
+            if op == "eq":
+                rows = [r for r in rows if str(r.get(column)) == value]
+        if "order" in params:
+            for term in reversed(params["order"][0].split(",")):
+                column, _, direction = term.partition(".")
+                rows.sort(
+                    key=lambda r: (r.get(column) is None, r.get(column)),
+                    reverse=direction.startswith("desc"),
+                )
+        if "limit" in params:
+            rows = rows[: int(params["limit"][0])]
+        columns = [c.strip() for c in params.get("select", ["*"])[0].split(",")]
+        if columns != ["*"]:
+            rows = [{c: r.get(c) for c in columns} for r in rows]
+        return rows
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # ヘッダと本文を別々に書くので、Nagle + 遅延 ACK の 40ms 待ちを避ける
+            disable_nagle_algorithm = True
+
+            def _table(self):
+                parts = urlsplit(self.path)
+                prefix = "/rest/v1/"
+                if not parts.path.startswith(prefix):
+                    return None, {}
+                return parts.path[len(prefix) :], parse_qs(parts.query)
+
+            def _begin(self) -> None:
+                with stub._lock:
+                    stub.counts["requests"] += 1
+                if stub.latency_sec:
+                    time.sleep(stub.latency_sec)
+
+            def do_GET(self) -> None:
+                table, params = self._table()
+                if table is None:
+                    self._send(404, {"message": "not found"})
+                    return
+                self._begin()
+                self._send(200, stub.read(table, params))
+
+            def do_POST(self) -> None:
+                table, params = self._table()
+                length = int(self.headers.get("Content-Length") or 0)
+                payload = json.loads(self.rfile.read(length) or b"[]")
+                if table is None:
+                    self._send(404, {"message": "not found"})
+                    return
+                self._begin()
+                rows = payload if isinstance(payload, list) else [payload]
+                prefer = self.headers.get("Prefer", "")
+                resolution = ""
+                if "resolution=ignore-duplicates" in prefer:
+                    resolution = "ignore-duplicates"
+                elif "resolution=merge-duplicates" in prefer:
+                    resolution = "merge-duplicates"
+                on_conflict = []
+                if resolution:
+                    on_conflict = [
+                        c.strip() for c in params.get("on_conflict", [""])[0].split(",") if c.strip()
+                    ]
+                written = stub.write(table, rows, on_conflict, resolution)
+                if "return=minimal" in prefer:
+                    self._send(201, None)
+                else:
+                    self._send(201, written)
+
+            def _send(self, status: int, payload) -> None:
+                body = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                if payload is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--openai-port", type=int, default=8901)
+    ap.add_argument("--postgrest-port", type=int, default=8902)
+    ap.add_argument("--ttft", type=float, default=0.8, help="最初のチャンクまでの秒数")
+    ap.add_argument("--chunk-interval", type=float, default=0.02)
+    ap.add_argument("--chunk-chars", type=int, default=8)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--error-status", type=int, default=429)
+    ap.add_argument("--db-latency", type=float, default=0.03)
+    args = ap.parse_args()
+
+    openai_stub = StubOpenAIServer(
+        args.openai_port,
+        OpenAIStubConfig(
+            ttft_sec=args.ttft,
+            chunk_interval_sec=args.chunk_interval,
+            chunk_chars=args.chunk_chars,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+        ),
+    ).start()
+    postgrest_stub = StubPostgrestServer(args.postgrest_port, latency_sec=args.db_latency).start()
+    print(f"OPENAI_BASE_URL={openai_stub.base_url}")
+    print(f"SUPABASE_URL={postgrest_stub.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# bench/usage_report.py
+"""
+OpenAI のトークン使用量ログ（ARKY_USAGE_LOG の JSONL）から、
+プロンプトキャッシュのヒット率と、生成1回あたりのコストを集計する。
+
+ログの取り方:
+    ARKY_USAGE_LOG=.arky_usage.jsonl streamlit run app.py
+
+使い方（リポジトリのルートで）:
+    python bench/usage_report.py .arky_usage.jsonl [--since-hours 24]
+
+あわせて、固定の system メッセージ（全リクエストで共通のプレフィックス）の長さを表示する。
+OpenAI のプロンプトキャッシュは、先頭 1024 トークン以上が一致したときだけ効く。
+"""
+import argparse
+import pathlib
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from usage_logic import format_report, load_usage_log, summarize  # noqa: E402
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("log", help="ARKY_USAGE_LOG で書き出した JSONL")
+    ap.add_argument("--since-hours", type=float, default=None, help="直近 N 時間分だけ集計する")
+    args = ap.parse_args()
+
+    records = load_usage_log(args.log)
+    if args.since_hours is not None:
+        cutoff = time.time() - args.since_hours * 3600
+        records = [r for r in records if r.ts >= cutoff]
+
+    print(format_report(summarize(records)))
+
+    # 固定プレフィックスの長さ（openai_logic の import は API キーが無くても動く）
+    import openai_logic
+
+    print("")
+    print("static system prefixes (chars):")
+    for name in ("MARKDOWN_SYSTEM_PROMPT", "SINGLE_PATTERN_SYSTEM_PROMPT", "STRUCTURED_SYSTEM_PROMPT"):
+        print(f"  {name:<30}{len(getattr(openai_logic, name)):>6}")
+
+
+if __name__ == "__main__":
+    main()
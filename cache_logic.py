@@ -0,0 +1,246 @@
+# cache_logic.py
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# L1（プロセス内 LRU）の最大件数と有効期限（秒）
+CACHE_L1_MAX_ENTRIES = int(os.getenv("ARKY_CACHE_L1_MAX_ENTRIES", "256"))
+CACHE_L1_TTL_SEC = float(os.getenv("ARKY_CACHE_L1_TTL_SEC", "3600"))
+
+# L2（SQLite 永続キャッシュ）のファイルパスと有効期限（秒）
+# ARKY_CACHE_DB に空文字を入れると L2 を使わない
+CACHE_DB_PATH = os.getenv("ARKY_CACHE_DB", ".arky_cache.sqlite3")
+CACHE_L2_TTL_SEC = float(os.getenv("ARKY_CACHE_L2_TTL_SEC", str(7 * 24 * 3600)))
+# L2 の最大件数（書き込みのたびに、期限切れの行と古い行から消す）
+CACHE_L2_MAX_ENTRIES = int(os.getenv("ARKY_CACHE_L2_MAX_ENTRIES", "10000"))
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str | None) -> str:
+    """
+    キャッシュキー用に日本語テキストを正規化する。
+    NFKC（全角英数・半角カナなどを統一）→ 連続する空白・改行を1つの半角スペースに。
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def make_cache_key(
+    model: str,
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    pattern_index: int | None = None,
+) -> str:
+    """
+    正規化済みの入力とモデル名から、キャッシュキー（SHA-256）を作る。
+
+    pattern_index はパターン単位のリライト（1ブロックだけの結果）のときに渡す。
+    3パターンまとめてのリライトと同じ入力でも、別のキーになる。
+    """
+    payload = {
+        "model": model,
+        "template": normalize_text(template),
+        "tone": normalize_text(tone),
+        "recipient": normalize_text(recipient),
+        "seasonal_text": normalize_text(seasonal_text),
+        "message": normalize_text(message),
+        "is_refine": bool(is_refine and previous_suggestions),
+        "previous_suggestions": normalize_text(previous_suggestions) if is_refine else "",
+    }
+    if pattern_index is not None:
+        # 既存のキー（全パターン分の結果）は変えないよう、パターン単位のときだけ入れる
+        payload["pattern_index"] = int(pattern_index)
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# ============================================
+# 2階層キャッシュ本体
+# ============================================
+class ResponseCache:
+    """
+    生成結果のキャッシュ。
+      - L1: プロセス内の LRU（TTL 付き）。全セッションで共有する。
+      - L2: SQLite の永続キャッシュ。プロセス再起動後も使える。
+
+    L2 でヒットした値は L1 に載せ直す。
+    L2 も書き込みのたびに、期限切れの行と l2_max_entries を超えた古い行を消す。
+    hit / miss / eviction の回数を stats() で返す。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CACHE_L1_MAX_ENTRIES,
+        ttl_sec: float = CACHE_L1_TTL_SEC,
+        db_path: str | None = CACHE_DB_PATH,
+        l2_ttl_sec: float = CACHE_L2_TTL_SEC,
+        l2_max_entries: int = CACHE_L2_MAX_ENTRIES,
+    ):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.l2_ttl_sec = l2_ttl_sec
+        self.l2_max_entries = l2_max_entries
+        self._l1: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {
+            "l1_hits": 0,
+            "l2_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "l2_evictions": 0,
+        }
+
+        self._conn: sqlite3.Connection | None = None
+        if db_path:
+            try:
+                self._conn = sqlite3.connect(db_path, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "create table if not exists response_cache ("
+                    " key text primary key,"
+                    " value text not null,"
+                    " created_at real not null)"
+                )
+                self._conn.execute(
+                    "create index if not exists idx_response_cache_created_at"
+                    " on response_cache (created_at)"
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                # L2 が使えなくても L1 だけで動かす
+                print("[cache] SQLite キャッシュを開けませんでした:", e)
+                self._conn = None
+
+    # ---------- L1 ----------
+    def _l1_get(self, key: str, now: float) -> str | None:
+        item = self._l1.get(key)
+        if item is None:
+            return None
+        stored_at, value = item
+        if now - stored_at > self.ttl_sec:
+            del self._l1[key]
+            self._counters["expirations"] += 1
+            return None
+        self._l1.move_to_end(key)
+        return value
+
+    def _l1_put(self, key: str, value: str, now: float) -> None:
+        self._l1[key] = (now, value)
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.max_entries:
+            self._l1.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    # ---------- L2 ----------
+    def _l2_get(self, key: str, now: float) -> str | None:
+        if self._conn is None:
+            return None
+        try:
+            row = self._conn.execute(
+                "select value, created_at from response_cache where key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print("[cache] SQLite 読み込みエラー:", e)
+            return None
+        if row is None:
+            return None
+        value, created_at = row
+        if now - created_at > self.l2_ttl_sec:
+            return None
+        return value
+
+    def _l2_put(self, key: str, value: str, now: float) -> None:
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(
+                "insert or replace into response_cache (key, value, created_at) values (?, ?, ?)",
+                (key, value, now),
+            )
+            self._l2_prune(now)
+            self._conn.commit()
+        except sqlite3.Error as e:
+            print("[cache] SQLite 書き込みエラー:", e)
+
+    def _l2_prune(self, now: float) -> None:
+        """期限切れの行を消し、l2_max_entries を超えた分を created_at の古い順に消す。"""
+        expired = self._conn.execute(
+            "delete from response_cache where created_at < ?", (now - self.l2_ttl_sec,)
+        ).rowcount
+        evicted = self._conn.execute(
+            "delete from response_cache where key in ("
+            " select key from response_cache order by created_at desc limit -1 offset ?)",
+            (max(self.l2_max_entries, 0),),
+        ).rowcount
+        self._counters["expirations"] += expired
+        self._counters["l2_evictions"] += evicted
+
+    # ---------- 公開API ----------
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            value = self._l1_get(key, now)
+            if value is not None:
+                self._counters["l1_hits"] += 1
+                return value
+
+            value = self._l2_get(key, now)
+            if value is not None:
+                self._counters["l2_hits"] += 1
+                self._l1_put(key, value, now)
+                return value
+
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._l1_put(key, value, now)
+            self._l2_put(key, value, now)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._l1.clear()
+            if self._conn is not None:
+                try:
+                    self._conn.execute("delete from response_cache")
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    print("[cache] SQLite 削除エラー:", e)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["l1_size"] = len(self._l1)
+            if self._conn is not None:
+                try:
+                    stats["l2_size"] = self._conn.execute(
+                        "select count(*) from response_cache"
+                    ).fetchone()[0]
+                except sqlite3.Error as e:
+                    print("[cache] SQLite 読み込みエラー:", e)
+        return stats
+
+
+# アプリ全体（全セッション）で共有するキャッシュ
+response_cache = ResponseCache()
@@ -0,0 +1,108 @@
+# chat_log.py
+import hashlib
+import html
+import os
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Iterator
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# セッションごとに保持するメッセージ数（古いものからリングバッファで捨てる）
+CHAT_LOG_MAX = int(os.getenv("ARKY_CHAT_LOG_MAX", "50"))
+
+# 一度に DOM に出すバブル数と、「以前のメッセージ」で増やす数
+CHAT_LOG_WINDOW = int(os.getenv("ARKY_CHAT_LOG_WINDOW", "12"))
+CHAT_LOG_WINDOW_STEP = int(os.getenv("ARKY_CHAT_LOG_WINDOW_STEP", "12"))
+
+# バブル HTML のプロセス内 LRU の最大件数（ガイド文などはセッションをまたいで同じ）
+BUBBLE_CACHE_MAX_ENTRIES = int(os.getenv("ARKY_BUBBLE_CACHE_MAX_ENTRIES", "512"))
+
+_bubble_cache: "OrderedDict[str, str]" = OrderedDict()
+_bubble_lock = threading.Lock()
+
+
+def _bubble_key(role: str, content: str) -> str:
+    return hashlib.sha256(f"{role}\0{content}".encode("utf-8")).hexdigest()[:16]
+
+
+def render_bubble(role: str, content: str) -> str:
+    """1メッセージ分のバブル HTML。role と本文の content hash でメモ化する。"""
+    key = _bubble_key(role, content)
+    with _bubble_lock:
+        cached = _bubble_cache.get(key)
+        if cached is not None:
+            _bubble_cache.move_to_end(key)
+            return cached
+
+    text = html.escape(content).replace("\n", "<br>")
+    if role == "user":
+        rendered = f"<div class='chat-bubble user'>{text}</div>"
+    else:
+        rendered = f"<div class='chat-bubble assistant'><span>{text}</span></div>"
+
+    with _bubble_lock:
+        _bubble_cache[key] = rendered
+        while len(_bubble_cache) > BUBBLE_CACHE_MAX_ENTRIES:
+            _bubble_cache.popitem(last=False)
+    return rendered
+
+
+@dataclass(frozen=True)
+class ChatMessage:
+    """ログ1件。html は追加時に1回だけ作ったバブル HTML。"""
+
+    role: str
+    content: str
+    html: str
+
+
+class ChatLog:
+    """
+    st.session_state.messages に置くチャットログ。
+
+    - 追加時にバブル HTML を作り（render_bubble でメモ化）、以降の再実行では作り直さない
+    - 上限を超えたら deque(maxlen) が古いものから捨てる（[-50:] のコピーをしない）
+    - window_html() は末尾の window 件だけを返し、結果は次に追加されるまで使い回す
+    """
+
+    def __init__(self, maxlen: int = CHAT_LOG_MAX):
+        self._messages: "deque[ChatMessage]" = deque(maxlen=maxlen)
+        # append / clear のたびに増える。window_html のキャッシュキー
+        self._version = 0
+        self._window_cache: tuple = (-1, 0, "")
+
+    def append(self, role: str, content: str) -> None:
+        self._messages.append(ChatMessage(role, content, render_bubble(role, content)))
+        self._version += 1
+
+    def clear(self) -> None:
+        self._messages.clear()
+        self._version += 1
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[ChatMessage]:
+        return iter(self._messages)
+
+    def hidden_count(self, window: int) -> int:
+        """window 件だけ表示したときに DOM に出ない古いメッセージの数。"""
+        return max(len(self._messages) - window, 0)
+
+    def window_html(self, window: int) -> str:
+        """末尾 window 件のバブルを並べた .chat-log の HTML。"""
+        version, cached_window, cached_html = self._window_cache
+        if version == self._version and cached_window == window:
+            return cached_html
+
+        start = self.hidden_count(window)
+        parts = ["<div class='chat-log'>"]
+        # deque はスライスできないので、末尾側だけを index で取り出す
+        parts.extend(self._messages[i].html for i in range(start, len(self._messages)))
+        parts.append("</div>")
+        rendered = "\n".join(parts)
+        self._window_cache = (self._version, window, rendered)
+        return rendered
@@ -0,0 +1,95 @@
+# copy_component.py
+import hashlib
+import os
+from pathlib import Path
+from typing import List
+
+import streamlit as st
+import streamlit.components.v1 as components
+
+# ============================================
+# コピー用カスタムコンポーネント
+# ============================================
+# フロントエンド：components/arky_copy/index.html
+# - コピーはブラウザだけで行い、コピーイベントはまとめて（COPY_FLUSH_MS ごとに）送り返す。
+# - 本文は content hash ごとに1回だけ送り、以降の描画では {id, hash} だけを渡す。
+# - イベントには描画時の生成キー（全パターンの hash から作る）を付けて返してもらい、
+#   別の生成結果のときにためられたイベントは捨てる（前の生成のコピーを今の条件で記録しない）。
+COMPONENT_DIR = Path(__file__).resolve().parent / "components" / "arky_copy"
+
+# コピーイベントをまとめて送る間隔（ミリ秒）
+COPY_FLUSH_MS = int(os.getenv("ARKY_COPY_FLUSH_MS", "5000"))
+
+# 処理済みバッチ ID を覚えておく数（コンポーネントの値は次に送られるまで毎回返ってくる）
+_SEEN_BATCHES_MAX = 32
+
+_arky_copy = components.declare_component("arky_copy", path=str(COMPONENT_DIR))
+
+
+def content_hash(text: str) -> str:
+    """コピー本文の識別子（ブラウザ側のキャッシュキー）。"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def generation_key(hashes: List[str]) -> str:
+    """いま表示している生成結果の識別子（パターンの hash の並びから作る）。"""
+    return content_hash(",".join(hashes))
+
+
+def copy_events(texts: List[str], key: str = "arky_copy") -> List[dict]:
+    """
+    コピー用コンポーネントを描画し、まだ処理していないコピーイベントを返す。
+
+    texts はパターン順のコピー本文。戻り値は
+    [{"id": パターンの 0 始まり index, "hash": content_hash, "gen": 生成キー, "ts": ミリ秒}, ...]。
+
+    コンポーネントの値は st.session_state[key] から描画前に読み、
+    - 同じバッチを2回処理しないように batch ID を覚えておく
+    - ブラウザに本文が無いと言われた hash（missing）は、今回の描画で送り直す
+    - 生成キーや hash が今の texts と合わないイベント（前の生成結果のときに
+      ためられ、コンポーネントが消えている間に送れなかったもの）は捨てる
+    """
+    ss = st.session_state
+    sent: set = ss.setdefault("copy_texts_sent", set())
+    seen: list = ss.setdefault("copy_batches_seen", [])
+
+    hashes = [content_hash(text) for text in texts]
+    generation = generation_key(hashes)
+
+    events: List[dict] = []
+    value = ss.get(key)
+    if isinstance(value, dict) and value.get("batch") not in seen:
+        seen.append(value.get("batch"))
+        del seen[:-_SEEN_BATCHES_MAX]
+        for event in value.get("events") or []:
+            if _is_current(event, generation, hashes):
+                events.append(event)
+            else:
+                ss["copy_events_dropped"] = ss.get("copy_events_dropped", 0) + 1
+        sent.difference_update(value.get("missing") or [])
+
+    patterns = []
+    new_texts = {}
+    for idx, (text, h) in enumerate(zip(texts, hashes)):
+        patterns.append({"id": idx, "hash": h})
+        if h not in sent:
+            new_texts[h] = text
+
+    _arky_copy(
+        patterns=patterns,
+        texts=new_texts,
+        generation=generation,
+        flush_ms=COPY_FLUSH_MS,
+        key=key,
+        default=None,
+    )
+    sent.update(new_texts)
+    return events
+
+
+def _is_current(event, generation: str, hashes: List[str]) -> bool:
+    """event がいま表示している生成結果のパターンに対するコピーか。"""
+    if not isinstance(event, dict) or event.get("gen") != generation:
+        return False
+    idx = event.get("id")
+    return isinstance(idx, int) and 0 <= idx < len(hashes) and event.get("hash") == hashes[idx]
@@ -1,9 +1,20 @@
 # db_logic.py
+import atexit
 import os
+import random
+import threading
+import time
 from datetime import datetime, timezone
 from typing import List, Dict
+from postgrest.exceptions import APIError
 from supabase import create_client, Client
 
+from id_logic import generatedid_generator
+from metrics_logic import registry, span
+from outbox_logic import WriteBehindQueue
+from rollup_logic import CounterRollup
+from similar_logic import similar_index
+
 # .env（ローカル） or Streamlit Secrets（クラウド）から読み込み
 try:
     from dotenv import load_dotenv
@@ -38,6 +49,44 @@ TABLE_NAME = "test_arky_patterns"
 #   );
 COPY_LOG_TABLE_NAME = "email_copy_log"
 
+# コピークリックの集計（ロールアップ）用テーブル名
+# 想定DDL例：
+#   create table public.email_copy_rollup (
+#     bucket_start  timestamptz not null,   -- 時間バケットの開始時刻（UTC）
+#     writer_id     bigint      not null,   -- 書き込んだプロセスのID（集計時は合計する）
+#     template      text        not null,
+#     tone          text        not null,
+#     recipient     text        not null,
+#     pattern_index integer     not null,
+#     copy_count    bigint      not null,   -- そのバケット内の累積クリック数
+#     primary key (bucket_start, writer_id, template, tone, recipient, pattern_index)
+#   );
+COPY_ROLLUP_TABLE_NAME = "email_copy_rollup"
+COPY_ROLLUP_KEY_FIELDS = ["template", "tone", "recipient", "pattern_index"]
+
+# 集計の時間バケット幅と送信間隔（秒）
+COPY_ROLLUP_BUCKET_SEC = int(os.getenv("ARKY_COPY_ROLLUP_BUCKET_SEC", "3600"))
+COPY_ROLLUP_FLUSH_INTERVAL_SEC = float(os.getenv("ARKY_COPY_ROLLUP_FLUSH_INTERVAL_SEC", "30"))
+
+# 生ログ（email_copy_log）に1クリック1行で残す割合（0.0〜1.0）。既定は残さない
+COPY_LOG_RAW_SAMPLE_RATE = float(os.getenv("ARKY_COPY_LOG_RAW_SAMPLE_RATE", "0"))
+
+# 類似リクエスト用インデックスに起動時に読み込む直近の行数
+SIMILAR_INDEX_LOAD_LIMIT = int(os.getenv("ARKY_SIMILAR_INDEX_LOAD_LIMIT", "3000"))
+# 読み込みに失敗したとき、次に試すまでの待ち時間（秒）。失敗が続くたびに倍にする
+SIMILAR_INDEX_RETRY_SEC = float(os.getenv("ARKY_SIMILAR_INDEX_RETRY_SEC", "30"))
+SIMILAR_INDEX_MAX_RETRY_SEC = float(os.getenv("ARKY_SIMILAR_INDEX_MAX_RETRY_SEC", "600"))
+_similar_index_lock = threading.Lock()
+_similar_index_failures = 0
+_similar_index_retry_at = 0.0
+
+# write-behind（バックグラウンド書き込み）の設定
+#   ARKY_DB_WRITE_BEHIND=0 にすると従来どおり呼び出しスレッドで同期的に INSERT する
+WRITE_BEHIND = os.getenv("ARKY_DB_WRITE_BEHIND", "1") == "1"
+OUTBOX_DB_PATH = os.getenv("ARKY_OUTBOX_DB", ".arky_outbox.sqlite3")
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("ARKY_WRITE_BEHIND_BATCH_SIZE", "50"))
+WRITE_BEHIND_FLUSH_INTERVAL_SEC = float(os.getenv("ARKY_WRITE_BEHIND_FLUSH_INTERVAL_SEC", "2"))
+
 
 def _assert_client():
     """Supabaseクライアントが無い場合は例外を投げる。"""
@@ -48,31 +97,6 @@ def _assert_client():
         )
 
 
-def _get_next_generatedid(table: str) -> int:
-    """
-    指定テーブルの現在の最大 generatedid を取得し、
-    次に使う generatedid を返す。
-
-    ※ generatedid が NULL の行は無視する前提。
-    """
-    _assert_client()
-
-    res = (
-        supabase.table(table)
-        .select("generatedid")
-        .order("generatedid", desc=True)
-        .limit(1)
-        .execute()
-    )
-
-    if res.data:
-        max_generatedid = res.data[0].get("generatedid") or 0
-    else:
-        max_generatedid = 0
-
-    return int(max_generatedid) + 1
-
-
 # ============================================
 # 3パターン分を「3レコード」で保存する関数（B案）
 # ============================================
@@ -84,7 +108,7 @@ def save_email_batch(
     seasonal_greeting: bool,
     patterns: List[Dict[str, str]],
     table_name: str = TABLE_NAME,
-) -> None:
+) -> int:
     """
     App 側から渡された 3パターン分の subject/body を
     Supabase の test_arky_patterns テーブルに「3レコード」として保存する。
@@ -102,7 +126,8 @@ def save_email_batch(
         subject           text        null,
         body              text        null,
         created_at        timestamptz not null default now(),
-        constraint chk_pattern_index check (pattern_index >= 1 and pattern_index <= 3)
+        constraint chk_pattern_index check (pattern_index >= 1 and pattern_index <= 3),
+        constraint uq_generatedid_pattern unique (generatedid, pattern_index)
       );
 
     patterns: [
@@ -110,6 +135,15 @@ def save_email_batch(
       {"subject": "...", "body": "..."},
       {"subject": "...", "body": "..."},
     ]
+
+    generatedid は id_logic の時刻順 64bit ID をクライアント側で発行する
+    （MAX(generatedid)+1 の問い合わせは行わない）。戻り値は発行した generatedid。
+    generatedid は保存する行に入れてからアウトボックスに積むので、write-behind の再送は
+    (generatedid, pattern_index) の一意制約（uq_generatedid_pattern）への upsert になり、
+    重複行はできない。既存のテーブルには README の「DB マイグレーション」の制約追加が必要。
+
+    write-behind が有効な場合（既定）はアウトボックスに積んで即座に戻り、
+    INSERT はバックグラウンドのワーカーがまとめて行う。
     """
     _assert_client()
 
@@ -122,8 +156,9 @@ def save_email_batch(
     while len(patterns) < 3:
         patterns.append({"subject": "", "body": ""})
 
-    # グループ共通の generatedid を採番
-    generatedid = _get_next_generatedid(table_name)
+    # グループ共通の generatedid をクライアント側で発行（DB への問い合わせなし）
+    with span("id_generate"):
+        generatedid = generatedid_generator.next_id()
 
     # created_at はテーブル側の default now() に任せるので明示指定しない
     rows = []
@@ -141,15 +176,151 @@ def save_email_batch(
                 "body": p.get("body", "") or "",
             }
         )
+    batch = {"rows": rows}
+
+    if WRITE_BEHIND:
+        # バックグラウンドで書き込む（ここではアウトボックスに積むだけ）
+        with span("db_enqueue"):
+            _get_write_behind().enqueue("email_batch", table_name, batch)
+        return generatedid
 
     # 挿入実行
     try:
-        res = supabase.table(table_name).insert(rows).execute()
-        # デバッグ用ログ（Streamlit の Logs に出る）
-        print("[save_email_batch] inserted rows:", res.data)
+        _flush_email_batches(table_name, [batch])
     except Exception as e:
         # App 側で st.error に出したいので、そのまま投げる
         raise RuntimeError(f"Supabase 挿入エラー: {e}")
+    return generatedid
+
+
+class GeneratedIdCollisionError(ValueError):
+    """別の生成グループと generatedid が重複した（ARKY_NODE_ID の設定漏れなど）。"""
+
+
+# 送り直しかどうかを見分けるときに比べる列
+_EMAIL_ROW_FIELDS = [
+    "template", "tone", "recipient", "seasonal_greeting", "user_message", "subject", "body",
+]
+
+
+def _flush_email_batches(table_name: str, batches: List[Dict]) -> None:
+    """
+    save_email_batch で受け付けた複数グループを、1回のリクエストでまとめて書き込む。
+
+    generatedid は発行済みなので、送り直し（前回の INSERT は通ったが応答を受け取れなかった）
+    では同じ行が既にある。一意制約違反（23505）になったら _drop_replayed_rows で
+    既にある行を除いて残りだけ書き込む。別のグループと generatedid が重複していた場合は
+    GeneratedIdCollisionError を投げる（write-behind では dead_letter に移る）。
+    """
+    _assert_client()
+
+    rows = [row for batch in batches for row in batch["rows"]]
+
+    with span("db_insert"):
+        try:
+            inserted = len(supabase.table(table_name).insert(rows).execute().data or [])
+        except APIError as e:
+            if str(e.code or "") != "23505":
+                raise
+            rows = _drop_replayed_rows(table_name, rows)
+            inserted = 0
+            if rows:
+                inserted = len(supabase.table(table_name).insert(rows).execute().data or [])
+    # デバッグ用ログ（Streamlit の Logs に出る）。行の中身（本文）は出さない
+    print("[save_email_batch] inserted rows:", inserted)
+
+    # 類似リクエスト用インデックスにも追加しておく
+    for batch in batches:
+        first = batch["rows"][0]
+        similar_index.add(
+            first["generatedid"],
+            first["template"],
+            first["tone"],
+            first["recipient"],
+            first["seasonal_greeting"],
+            first["user_message"],
+            batch["rows"],
+        )
+
+
+def _drop_replayed_rows(table_name: str, rows: List[Dict]) -> List[Dict]:
+    """
+    rows のうち、同じ (generatedid, pattern_index) の行がまだ DB に無いものを返す。
+    既にある行の中身が違えば、別のグループと generatedid が重複しているので
+    GeneratedIdCollisionError を投げる。
+    """
+    ids = sorted({row["generatedid"] for row in rows})
+    res = (
+        supabase.table(table_name)
+        .select("generatedid, pattern_index, " + ", ".join(_EMAIL_ROW_FIELDS))
+        .in_("generatedid", ids)
+        .execute()
+    )
+    existing = {(r["generatedid"], r["pattern_index"]): r for r in res.data or []}
+
+    remaining = []
+    for row in rows:
+        old = existing.get((row["generatedid"], row["pattern_index"]))
+        if old is None:
+            remaining.append(row)
+        elif any((old.get(f) or "") != (row.get(f) or "") for f in _EMAIL_ROW_FIELDS):
+            print(
+                f"[save_email_batch] generatedid={row['generatedid']} が別の生成グループと重複しました。"
+                "プロセスごとに別の ARKY_NODE_ID を設定してください。"
+            )
+            raise GeneratedIdCollisionError(
+                f"generatedid={row['generatedid']} pattern_index={row['pattern_index']} "
+                "が別の生成グループと重複しています"
+            )
+    return remaining
+
+
+# ============================================
+# 類似リクエスト用インデックスの読み込み
+# ============================================
+def load_similar_index(
+    table_name: str = TABLE_NAME,
+    limit: int = SIMILAR_INDEX_LOAD_LIMIT,
+) -> int:
+    """
+    test_arky_patterns の直近 limit 行を読み込み、類似リクエスト用の
+    MinHash/LSH インデックスを作る。プロセスで1回だけ実行され、
+    2回目以降は何もせずにインデックス内のグループ数を返す。
+
+    失敗したら例外を投げ、SIMILAR_INDEX_RETRY_SEC（失敗が続くたびに倍、上限
+    SIMILAR_INDEX_MAX_RETRY_SEC）経つまでは問い合わせずに今のグループ数を返す。
+    app.py は再実行のたびに呼ぶので、DB が落ちている間に毎回ブロックしないようにする。
+    """
+    global _similar_index_failures, _similar_index_retry_at
+
+    with _similar_index_lock:
+        if similar_index.loaded or time.monotonic() < _similar_index_retry_at:
+            return len(similar_index)
+
+        try:
+            _assert_client()
+            res = (
+                supabase.table(table_name)
+                .select(
+                    "generatedid, pattern_index, template, tone, recipient, "
+                    "seasonal_greeting, user_message, subject, body"
+                )
+                .order("generatedid", desc=True)
+                .limit(limit)
+                .execute()
+            )
+        except Exception:
+            delay = min(
+                SIMILAR_INDEX_RETRY_SEC * (2 ** _similar_index_failures),
+                SIMILAR_INDEX_MAX_RETRY_SEC,
+            )
+            _similar_index_failures += 1
+            _similar_index_retry_at = time.monotonic() + delay
+            raise
+        _similar_index_failures = 0
+        loaded = similar_index.load_rows(res.data or [])
+        print(f"[load_similar_index] loaded {loaded} groups")
+        return len(similar_index)
 
 
 # ============================================
@@ -175,13 +346,21 @@ def log_copy_click(
         pattern_index integer not null
       );
 
-    1クリック = 1行INSERT するだけ。
+    クリックはプロセス内で (template, tone, recipient, pattern_index, 時間バケット)
+    ごとに数え、定期的に email_copy_rollup へ upsert する。
+    email_copy_log への1クリック1行の生ログは COPY_LOG_RAW_SAMPLE_RATE の割合で
+    サンプリングしたものだけを残す（既定 0 = 残さない）。
     """
     _assert_client()
 
     if pattern_index < 1:
         raise ValueError("pattern_index は 1 以上である必要があります。")
 
+    copy_rollup.record(template, tone, recipient, int(pattern_index))
+
+    if random.random() >= COPY_LOG_RAW_SAMPLE_RATE:
+        return
+
     row = {
         "template": template,
         "tone": tone,
@@ -189,11 +368,162 @@ def log_copy_click(
         "pattern_index": int(pattern_index),
     }
 
+    if WRITE_BEHIND:
+        _get_write_behind().enqueue("copy_click", table_name, row)
+        return
+
     try:
-        res = supabase.table(table_name).insert(row).execute()
-        print("[log_copy_click] inserted row:", res.data)
+        _flush_copy_clicks(table_name, [row])
     except Exception as e:
         # コピーのログ取得に失敗してもアプリ本体は止めたくない場合、
         # ここで例外を握りつぶす選択肢もあるが、
         # いったん RuntimeError として投げておく。
         raise RuntimeError(f"Supabase 挿入エラー（コピークリックログ）: {e}")
+
+
+def _flush_copy_clicks(table_name: str, rows: List[Dict]) -> None:
+    """コピークリックのログをまとめて INSERT する。"""
+    _assert_client()
+    res = supabase.table(table_name).insert(rows).execute()
+    print("[log_copy_click] inserted rows:", len(res.data or []))
+
+
+def _upsert_copy_rollup(table_name: str, payloads: List[Dict]) -> None:
+    """
+    コピークリックの集計行を upsert する。
+    同じキーの行が複数あれば累積値の大きい方（新しい方）を使う。
+    """
+    _assert_client()
+    latest: Dict[tuple, Dict] = {}
+    for payload in payloads:
+        for row in payload["rows"]:
+            key = (row["bucket_start"], row["writer_id"]) + tuple(
+                row[f] for f in COPY_ROLLUP_KEY_FIELDS
+            )
+            if key not in latest or row["copy_count"] > latest[key]["copy_count"]:
+                latest[key] = row
+
+    res = (
+        supabase.table(table_name)
+        .upsert(
+            list(latest.values()),
+            on_conflict="bucket_start,writer_id," + ",".join(COPY_ROLLUP_KEY_FIELDS),
+        )
+        .execute()
+    )
+    print("[copy_rollup] upserted rows:", len(res.data or []))
+
+
+def _flush_copy_rollup(rows: List[Dict]) -> None:
+    """CounterRollup から定期的に呼ばれる。write-behind 有効時はアウトボックス経由で送る。"""
+    payload = {"rows": rows}
+    if WRITE_BEHIND:
+        _get_write_behind().enqueue("copy_rollup", COPY_ROLLUP_TABLE_NAME, payload)
+    else:
+        _upsert_copy_rollup(COPY_ROLLUP_TABLE_NAME, [payload])
+
+
+# コピークリックの集計（全セッションで共有）
+copy_rollup = CounterRollup(
+    COPY_ROLLUP_KEY_FIELDS,
+    flush_fn=_flush_copy_rollup,
+    bucket_sec=COPY_ROLLUP_BUCKET_SEC,
+    flush_interval_sec=COPY_ROLLUP_FLUSH_INTERVAL_SEC,
+)
+# プロセス終了時に未送信の集計を送る（write-behind 有効時はアウトボックスに残る）
+atexit.register(copy_rollup.flush)
+
+
+# ============================================
+# write-behind キュー（バックグラウンド書き込み）
+# ============================================
+_write_behind: WriteBehindQueue | None = None
+_write_behind_lock = threading.Lock()
+
+
+def _get_write_behind() -> WriteBehindQueue:
+    """
+    write-behind キューを返す（初回呼び出し時に作成し、
+    前回のプロセスで送りきれなかったアウトボックスの再送も始める）。
+    """
+    global _write_behind
+    with _write_behind_lock:
+        if _write_behind is None:
+            _write_behind = WriteBehindQueue(
+                OUTBOX_DB_PATH,
+                handlers={
+                    "email_batch": _flush_email_batches,
+                    "copy_click": _flush_copy_clicks,
+                    "copy_rollup": _upsert_copy_rollup,
+                },
+                batch_size=WRITE_BEHIND_BATCH_SIZE,
+                flush_interval_sec=WRITE_BEHIND_FLUSH_INTERVAL_SEC,
+                is_permanent=_is_permanent_db_error,
+            )
+            _write_behind.start()
+            _register_write_behind_gauges(_write_behind)
+        return _write_behind
+
+
+def _is_permanent_db_error(e: Exception) -> bool:
+    """
+    送り直しても通らないエラーか（write-behind で dead_letter に移すかどうか）。
+    PostgREST が返した制約違反・型の不一致・存在しない列などは恒久的、
+    タイムアウト・接続エラー・5xx などは一時的とみなして、直るまで送り直す。
+    """
+    if isinstance(e, APIError):
+        code = str(e.code or "")
+        # SQLSTATE 22（データ）・23（制約違反）・42（構文・存在しない列・権限）と、
+        # PostgREST 自身のリクエストエラー（PGRST1xx / PGRST2xx）
+        return code[:2] in ("22", "23", "42") or code.startswith(("PGRST1", "PGRST2"))
+    return isinstance(e, (ValueError, TypeError, KeyError))
+
+
+def _register_write_behind_gauges(queue: WriteBehindQueue) -> None:
+    """アウトボックスの深さ・一番古い行の待ち時間・dead_letter の件数を /metrics に出す。"""
+    registry.gauge(
+        "arky_outbox_depth",
+        "Rows waiting in the write-behind outbox.",
+        lambda: {(): queue.depth()},
+    )
+    registry.gauge(
+        "arky_outbox_oldest_pending_age_seconds",
+        "Age of the oldest unsent row in the write-behind outbox.",
+        lambda: {(): queue.oldest_pending_age_sec()},
+    )
+    registry.gauge(
+        "arky_outbox_dead_letters",
+        "Rows moved to the outbox dead_letter table after a permanent error.",
+        lambda: {(): queue.dead_letter_depth()},
+    )
+
+
+def get_write_behind_stats() -> Dict:
+    """キューの深さ・フラッシュ回数・フラッシュ時間などを返す。"""
+    if not WRITE_BEHIND:
+        return {}
+    return _get_write_behind().stats()
+
+
+def requeue_write_behind_dead_letters() -> int:
+    """
+    dead_letter に移した行をアウトボックスに戻して送り直す。戻した件数を返す。
+    恒久的なエラーの原因（テーブル定義など）を直した後に、手で1回実行する:
+        python -c "import db_logic; print(db_logic.requeue_write_behind_dead_letters())"
+    """
+    if not WRITE_BEHIND:
+        return 0
+    return _get_write_behind().requeue_dead_letters()
+
+
+def flush_write_behind() -> None:
+    """アウトボックスの残りを今すぐ送る（終了処理やテスト用）。"""
+    if WRITE_BEHIND:
+        queue = _get_write_behind()
+        while queue.flush_once():
+            pass
+
+
+# 前回のプロセスで送りきれなかったアウトボックスがあれば、起動時から再送を始める
+if supabase is not None and WRITE_BEHIND:
+    _get_write_behind()
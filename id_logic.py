@@ -0,0 +1,90 @@
+# id_logic.py
+import hashlib
+import os
+import socket
+import threading
+import time
+
+# ============================================
+# 時刻順の 64bit ID（Snowflake 方式）
+# ============================================
+# ビット構成（符号ビットは常に 0 なので Postgres の bigint に収まる）
+#   41bit: ID_EPOCH_MS からの経過ミリ秒（約69年分）
+#   10bit: ノードID（プロセスごとに異なる値。複数プロセスで動かすなら ARKY_NODE_ID で割り当てる）
+#   12bit: 同一ミリ秒内の連番
+ID_EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+NODE_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE_ID = (1 << NODE_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def _default_node_id() -> int:
+    """
+    環境変数 ARKY_NODE_ID（0〜1023。プロセスごとに別の値）を使う。
+
+    無ければホスト名＋PID のハッシュで決めるが、10bit しかないので
+    別のプロセスと同じ値になりうる（同じミリ秒・同じ連番なら ID が重複する）。
+    1プロセスで動かす場合以外は ARKY_NODE_ID を必ず設定すること。
+    """
+    env = os.getenv("ARKY_NODE_ID")
+    if env:
+        node_id = int(env)
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f"ARKY_NODE_ID は 0〜{MAX_NODE_ID} で指定してください: {env}")
+        return node_id
+    seed = f"{socket.gethostname()}:{os.getpid()}".encode("utf-8")
+    node_id = int.from_bytes(hashlib.blake2b(seed, digest_size=2).digest(), "big") & MAX_NODE_ID
+    print(
+        f"[id] ARKY_NODE_ID が未設定のため、ホスト名＋PID からノードID {node_id} を決めました。"
+        "複数プロセスで動かす場合は、プロセスごとに別の ARKY_NODE_ID を設定してください"
+        "（設定しないと generatedid が重複することがあります）。"
+    )
+    return node_id
+
+
+class IdGenerator:
+    """
+    DB への問い合わせなしで、時刻順の 64bit ID を発行する。
+
+    - 同じプロセス内ではロックで連番を守る。
+    - 別プロセス同士は、ノードIDが異なれば下位ビットが異なるので衝突しない
+      （ノードIDの割り当ては ARKY_NODE_ID で行う。_default_node_id を参照）。
+    - 時計が巻き戻っても、最後に使った時刻から進め続けるので重複しない。
+    """
+
+    def __init__(self, node_id: int | None = None):
+        self.node_id = _default_node_id() if node_id is None else node_id & MAX_NODE_ID
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _next_id_locked(self) -> int:
+        now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+        if now_ms > self._last_ms:
+            self._last_ms = now_ms
+            self._sequence = 0
+        else:
+            # 同じミリ秒内（または時計の巻き戻り）：連番を進める
+            self._sequence += 1
+            if self._sequence > MAX_SEQUENCE:
+                self._last_ms += 1
+                self._sequence = 0
+        return (
+            (self._last_ms << (NODE_ID_BITS + SEQUENCE_BITS))
+            | (self.node_id << SEQUENCE_BITS)
+            | self._sequence
+        )
+
+    def next_id(self) -> int:
+        with self._lock:
+            return self._next_id_locked()
+
+
+def id_timestamp(generated_id: int) -> float:
+    """ID に埋め込まれた発行時刻（UNIX 秒）を返す。"""
+    return ((generated_id >> (NODE_ID_BITS + SEQUENCE_BITS)) + ID_EPOCH_MS) / 1000
+
+
+# プロセス全体で共有する generatedid の発行器
+generatedid_generator = IdGenerator()
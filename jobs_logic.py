@@ -0,0 +1,299 @@
+# jobs_logic.py
+import contextvars
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict
+
+from metrics_logic import observe_span, registry
+from quota_logic import quota_tracker, set_current_user
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# 生成ジョブを実行するワーカースレッドの数（プロセス全体で共有）
+JOB_WORKERS = int(os.getenv("ARKY_JOB_WORKERS", "8"))
+
+# 実行待ちにできるジョブの数。これを超えると submit が JobQueueFull を投げる
+JOB_MAX_PENDING = int(os.getenv("ARKY_JOB_MAX_PENDING", "32"))
+
+# 終わったジョブを覚えておく秒数（画面を閉じて取りに来ないジョブはこの後に消える）
+JOB_TTL_SEC = float(os.getenv("ARKY_JOB_TTL_SEC", "600"))
+
+# 優先度の低いジョブでも、これ以上待ったら優先度の高いジョブと同じ扱いにする（飢餓を防ぐ）
+JOB_PRIORITY_AGING_SEC = float(os.getenv("ARKY_JOB_PRIORITY_AGING_SEC", "5"))
+
+# 優先度（小さいほど先）。初回生成はリライト（追加要望）より先に実行する
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class JobQueueFull(RuntimeError):
+    """実行待ちのジョブが多すぎて受け付けられない。"""
+
+
+class JobCancelled(Exception):
+    """ジョブの関数がキャンセルを検知して途中で終わるときに投げる。"""
+
+
+class Job:
+    """
+    ワーカースレッドで実行される1件のジョブ。セッションには id だけを持たせ、
+    画面の再実行をまたいで JobQueue.get(id) で状態を見に来る。
+
+    ワーカー側は update() で途中経過（progress）を書き、cancel_event を見て途中で止まる。
+    """
+
+    def __init__(self, kind: str, user: str = "", priority: int = PRIORITY_NORMAL):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.user = user
+        self.priority = priority
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.result: Any = None
+        self.error: BaseException | None = None
+        self.cancel_event = threading.Event()
+        self._progress: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._context: contextvars.Context | None = None
+        self._call: tuple = ()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def update(self, **progress: Any) -> None:
+        """途中経過を書く（ワーカースレッドから）。"""
+        with self._lock:
+            self._progress.update(progress)
+
+    def progress(self) -> Dict[str, Any]:
+        """途中経過のコピー（画面側から）。"""
+        with self._lock:
+            return dict(self._progress)
+
+    def _finish(self, status: str, result: Any = None, error: BaseException | None = None) -> None:
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.status = status
+
+
+class JobQueue:
+    """
+    上限付きのワーカーでジョブを実行し、ID で引けるようにしておく。
+    スクリプトスレッドは submit したらすぐ戻り、結果はポーリングで受け取る。
+
+    実行待ちのジョブはユーザーごとの列に並べ、空いたワーカーは次の順で1件取る。
+      1. 優先度（先頭のジョブの priority。JOB_PRIORITY_AGING_SEC 以上待ったものは PRIORITY_HIGH 扱い）
+      2. 同じ優先度のユーザーの間では、重み付きラウンドロビン（smooth WRR）
+         重みは weight_fn(user)（既定は quota_logic の残りの枠の割合）
+    一人がリライトを続けて送っても、ほかのユーザーの初回生成はその後ろに並ばない。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = JOB_WORKERS,
+        max_pending: int = JOB_MAX_PENDING,
+        ttl_sec: float = JOB_TTL_SEC,
+        aging_sec: float = JOB_PRIORITY_AGING_SEC,
+        weight_fn: Callable[[str], float] = quota_tracker.weight,
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.ttl_sec = ttl_sec
+        self.aging_sec = aging_sec
+        self.weight_fn = weight_fn
+        self._jobs: Dict[str, Job] = {}
+        # ユーザー -> 実行待ちのジョブ（submit 順）
+        self._pending: "OrderedDict[str, Deque[Job]]" = OrderedDict()
+        # smooth WRR の現在値（実行待ちのあるユーザーだけ）
+        self._current_weight: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._workers: list = []
+        self._counts = {"submitted": 0, "rejected": 0, DONE: 0, FAILED: 0, CANCELLED: 0}
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args: Any,
+        kind: str = "",
+        user: str = "",
+        priority: int = PRIORITY_NORMAL,
+        **kwargs: Any,
+    ) -> Job:
+        """
+        fn(job, *args, **kwargs) をワーカーで実行するジョブを作る。
+        実行中＋実行待ちが max_workers + max_pending を超えるなら JobQueueFull。
+        """
+        job = Job(kind, user=user, priority=priority)
+        # トレースのラベル（metrics_logic）をワーカーにも引き継ぐ
+        job._context = contextvars.copy_context()
+        job._call = (fn, args, kwargs)
+        with self._cond:
+            self._purge_expired()
+            active = sum(1 for j in self._jobs.values() if not j.finished)
+            if active >= self.max_workers + self.max_pending:
+                self._counts["rejected"] += 1
+                raise JobQueueFull(f"実行待ちのジョブが多すぎます（{active} 件）")
+            self._jobs[job.id] = job
+            self._pending.setdefault(user, deque()).append(job)
+            self._counts["submitted"] += 1
+            self._ensure_workers()
+            self._cond.notify()
+        return job
+
+    def _ensure_workers(self) -> None:
+        """ワーカースレッドを最初の submit で起動する（ロックを取ってから呼ぶ）。"""
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._worker_loop, name=f"arky-job-{len(self._workers)}", daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                job = self._next_job()
+            job._context.run(self._run, job)
+
+    def _next_job(self) -> Job:
+        """次に実行するジョブを実行待ちの列から取り出す（ロックを取ってから呼ぶ）。"""
+        now = time.time()
+
+        def effective_priority(job: Job) -> int:
+            return PRIORITY_HIGH if now - job.created_at >= self.aging_sec else job.priority
+
+        heads = {user: effective_priority(jobs[0]) for user, jobs in self._pending.items()}
+        top = min(heads.values())
+        candidates = [user for user, priority in heads.items() if priority == top]
+
+        # smooth WRR：重みを足して一番大きいユーザーを選び、選んだユーザーから合計を引く
+        total = 0.0
+        for user in candidates:
+            weight = self.weight_fn(user) if user else 1.0
+            self._current_weight[user] = self._current_weight.get(user, 0.0) + weight
+            total += weight
+        chosen = max(candidates, key=lambda user: self._current_weight[user])
+        self._current_weight[chosen] -= total
+
+        jobs = self._pending[chosen]
+        job = jobs.popleft()
+        if not jobs:
+            del self._pending[chosen]
+            self._current_weight.pop(chosen, None)
+        return job
+
+    def _run(self, job: Job) -> None:
+        fn, args, kwargs = job._call
+        job._call = ()
+        if job.cancel_requested:
+            job._finish(CANCELLED)
+            self._count(CANCELLED)
+            return
+        job.started_at = time.time()
+        job.status = RUNNING
+        observe_span("job_wait", job.started_at - job.created_at)
+        # OpenAI のトークン使用量をこのジョブのユーザーに付ける
+        set_current_user(job.user)
+        try:
+            result = fn(job, *args, **kwargs)
+        except JobCancelled:
+            job._finish(CANCELLED)
+        except Exception as e:
+            print(f"[jobs] ジョブ {job.id}（{job.kind}）が失敗しました: {e!r}")
+            job._finish(FAILED, error=e)
+        else:
+            job._finish(CANCELLED if job.cancel_requested else DONE, result=result)
+        observe_span("job_run", job.finished_at - job.started_at)
+        self._count(job.status)
+
+    def _count(self, status: str) -> None:
+        with self._lock:
+            self._counts[status] += 1
+
+    def get(self, job_id: str | None) -> Job | None:
+        if job_id is None:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str | None) -> bool:
+        """まだ始まっていなければ列から外す。実行中ならワーカーに止まるよう伝える。"""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_event.set()
+        with self._lock:
+            jobs = self._pending.get(job.user)
+            if jobs is not None and job in jobs:
+                jobs.remove(job)
+                if not jobs:
+                    del self._pending[job.user]
+                    self._current_weight.pop(job.user, None)
+                job._finish(CANCELLED)
+                self._counts[CANCELLED] += 1
+        return True
+
+    def _purge_expired(self) -> None:
+        cutoff = time.time() - self.ttl_sec
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counts)
+            stats["queued"] = sum(len(jobs) for jobs in self._pending.values())
+            stats["queued_users"] = len(self._pending)
+            stats["running"] = sum(1 for j in self._jobs.values() if j.status == RUNNING)
+            stats["kept"] = len(self._jobs)
+        return stats
+
+    def queued_by_user(self) -> Dict[str, int]:
+        """ユーザーごとの待っているジョブ数（待ちのあるユーザーだけ）。"""
+        with self._lock:
+            return {user: len(jobs) for user, jobs in self._pending.items()}
+
+
+def _register_job_queue_gauges(queue: JobQueue) -> None:
+    """待ち・実行中のジョブ数と、ユーザーごとの待ち件数を /metrics に出す。"""
+    registry.gauge(
+        "arky_jobs",
+        "Generation jobs by state (queued / running).",
+        lambda: {(state,): queue.stats()[state] for state in ("queued", "running")},
+        labelnames=("state",),
+    )
+    registry.gauge(
+        "arky_jobs_queued_by_user",
+        "Queued generation jobs per user (only users with queued jobs).",
+        lambda: {(user,): count for user, count in queue.queued_by_user().items()},
+        labelnames=("user",),
+    )
+
+
+# プロセス全体で共有するジョブキュー
+job_queue = JobQueue()
+_register_job_queue_gauges(job_queue)
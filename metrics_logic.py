@@ -0,0 +1,406 @@
+# metrics_logic.py
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# 0 にすると span / observe は何もしない
+METRICS_ENABLED = os.getenv("ARKY_METRICS", "1") == "1"
+
+# Prometheus テキスト形式の書き出し先（node_exporter の textfile collector 向け。空なら書かない）
+METRICS_FILE = os.getenv("ARKY_METRICS_FILE", "")
+METRICS_FILE_INTERVAL_SEC = float(os.getenv("ARKY_METRICS_FILE_INTERVAL_SEC", "15"))
+
+# /metrics を返す HTTP サーバのポート（0 なら起動しない）と待ち受けるアドレス。
+# 既定はローカルだけ（外から集めるときは ARKY_METRICS_HOST=0.0.0.0 などにする）
+METRICS_PORT = int(os.getenv("ARKY_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("ARKY_METRICS_HOST", "127.0.0.1")
+
+# 送信1回ぶんの span を1行の JSON で追記するファイル（空なら書かない）
+TRACE_LOG_PATH = os.getenv("ARKY_TRACE_LOG", "")
+
+# ヒストグラムのバケット
+LATENCY_BUCKETS_SEC = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+TOKEN_BUCKETS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+# span・トークン数に付けるラベル（trace() で設定し、その中の span すべてに付く）
+TRACE_LABELS = ("template", "tone", "recipient")
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_le(bound: float) -> str:
+    return repr(float(bound)) if bound != int(bound) else f"{int(bound)}.0"
+
+
+class Histogram:
+    """
+    Prometheus の histogram と同じ形（バケットごとの件数・合計・件数）の集計。
+    observe はロック1回と bisect だけなので、本番で常時有効にしても軽い。
+    """
+
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...], labelnames: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = labelnames
+        # ラベル値のタプル -> [バケットごとの件数（+Inf を含む）..., 合計, 件数]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: Tuple[str, ...]) -> None:
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[pos] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self) -> Dict[Tuple[str, ...], list]:
+        with self._lock:
+            return {labels: list(series) for labels, series in self._series.items()}
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bounds = [_format_le(b) for b in self.buckets] + ["+Inf"]
+        for labels, series in sorted(self.snapshot().items()):
+            pairs = ",".join(
+                f'{k}="{_escape_label(v)}"' for k, v in zip(self.labelnames, labels)
+            )
+            prefix = f"{pairs}," if pairs else ""
+            cumulative = 0
+            for le, count in zip(bounds, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{pairs}}}" if pairs else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-2]}")
+            lines.append(f"{self.name}_count{suffix} {series[-1]}")
+        return lines
+
+
+class Counter:
+    """Prometheus の counter（単調に増える件数）。"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.snapshot().items()):
+            pairs = ",".join(
+                f'{k}="{_escape_label(v)}"' for k, v in zip(self.labelnames, labels)
+            )
+            suffix = f"{{{pairs}}}" if pairs else ""
+            lines.append(f"{self.name}{suffix} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Prometheus の gauge。値は持たずに、書き出すたびに fn() から読む
+    （キューの深さなど、ほかのモジュールがすでに数えている値をそのまま出す）。
+    fn() は {ラベル値のタプル: 値} を返す。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...],
+        fn: Callable[[], Dict[Tuple[str, ...], float]],
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.fn = fn
+
+    def collect(self) -> List[str]:
+        try:
+            values = self.fn()
+        except Exception as e:
+            print(f"[metrics] {self.name} を読めませんでした: {e}")
+            return []
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(values.items()):
+            pairs = ",".join(
+                f'{k}="{_escape_label(v)}"' for k, v in zip(self.labelnames, labels)
+            )
+            suffix = f"{{{pairs}}}" if pairs else ""
+            lines.append(f"{self.name}{suffix} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """プロセス全体のヒストグラム・カウンタの一覧。"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Histogram | Counter | Gauge] = {}
+        self._lock = threading.Lock()
+
+    def histogram(
+        self, name: str, help_text: str, buckets: Tuple[float, ...], labelnames: Tuple[str, ...]
+    ) -> Histogram:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help_text, buckets, labelnames)
+            return self._metrics[name]
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...]) -> Counter:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Counter(name, help_text, labelnames)
+            return self._metrics[name]
+
+    def gauge(
+        self,
+        name: str,
+        help_text: str,
+        fn: Callable[[], Dict[Tuple[str, ...], float]],
+        labelnames: Tuple[str, ...] = (),
+    ) -> Gauge:
+        """同じ名前で登録し直したら、新しい fn で置き換える（作り直したキューなど）。"""
+        with self._lock:
+            self._metrics[name] = Gauge(name, help_text, labelnames, fn)
+            return self._metrics[name]
+
+    def render(self) -> str:
+        """Prometheus テキスト形式（exposition format 0.0.4）。"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+span_seconds = registry.histogram(
+    "arky_span_seconds",
+    "Latency of each stage of a submit (prompt build, OpenAI call, parse, DB, render).",
+    LATENCY_BUCKETS_SEC,
+    ("span",) + TRACE_LABELS,
+)
+openai_tokens = registry.histogram(
+    "arky_openai_tokens",
+    "Tokens per OpenAI call (kind=prompt|cached|completion).",
+    TOKEN_BUCKETS,
+    ("kind",) + TRACE_LABELS,
+)
+openai_coalesced = registry.counter(
+    "arky_openai_coalesced_total",
+    "OpenAI calls that shared an identical in-flight request instead of calling upstream.",
+    ("kind",),
+)
+openai_rate_limit_rejected = registry.counter(
+    "arky_openai_rate_limit_rejected_total",
+    "OpenAI calls dropped because the rate limiter wait exceeded its maximum.",
+    (),
+)
+
+
+# ============================================
+# トレース（送信1回ぶん）と span
+# ============================================
+_EMPTY_LABELS = ("",) * len(TRACE_LABELS)
+_labels: contextvars.ContextVar = contextvars.ContextVar("arky_trace_labels", default=_EMPTY_LABELS)
+_spans: contextvars.ContextVar = contextvars.ContextVar("arky_trace_spans", default=None)
+
+
+def observe_span(name: str, seconds: float) -> None:
+    """計測済みの時間を span として記録する（ストリームの最初のチャンクまでの時間など）。"""
+    if not METRICS_ENABLED:
+        return
+    span_seconds.observe(seconds, (name,) + _labels.get())
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+def observe_tokens(kind: str, count: int) -> None:
+    if METRICS_ENABLED:
+        openai_tokens.observe(count, (kind,) + _labels.get())
+
+
+def count_coalesced(kind: str) -> None:
+    if METRICS_ENABLED:
+        openai_coalesced.inc((kind,))
+
+
+def count_rate_limit_rejected() -> None:
+    if METRICS_ENABLED:
+        openai_rate_limit_rejected.inc(())
+
+
+class span:
+    """
+    with span("openai_request"): ... の中の経過時間を記録する。
+    @contextmanager（ジェネレータ）より軽いので、ホットパスに置いてもよい。
+    """
+
+    __slots__ = ("name", "_start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> None:
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        observe_span(self.name, time.perf_counter() - self._start)
+
+
+def timed(name: str):
+    """関数全体を span として記録するデコレータ。"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace(name: str, **labels: str) -> Iterator[str]:
+    """
+    送信1回ぶんのトレース。中の span には template / tone / recipient のラベルが付き、
+    全体の時間も name の span として記録する。ARKY_TRACE_LOG があれば span の一覧を1行で書く。
+    別スレッドに処理を渡すときは contextvars.copy_context().run で包むとラベルが引き継がれる。
+    """
+    trace_id = uuid.uuid4().hex[:12]
+    label_token = _labels.set(tuple(str(labels.get(k, "")) for k in TRACE_LABELS))
+    spans: List[Tuple[str, float]] = []
+    spans_token = _spans.set(spans)
+    start = time.perf_counter()
+    try:
+        yield trace_id
+    finally:
+        total = time.perf_counter() - start
+        observe_span(name, total)
+        _spans.reset(spans_token)
+        _labels.reset(label_token)
+        if TRACE_LOG_PATH:
+            _write_trace(trace_id, name, labels, total, spans)
+
+
+_trace_log_lock = threading.Lock()
+
+
+def _write_trace(trace_id: str, name: str, labels: dict, total: float, spans: list) -> None:
+    line = json.dumps(
+        {
+            "ts": time.time(),
+            "trace_id": trace_id,
+            "name": name,
+            "labels": labels,
+            "total_sec": round(total, 6),
+            # 別スレッドから追加された span も含む（並列生成の各パターンなど）
+            "spans": [[span_name, round(sec, 6)] for span_name, sec in list(spans)],
+        },
+        ensure_ascii=False,
+    )
+    with _trace_log_lock:
+        try:
+            with open(TRACE_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"[metrics] トレースログを書き込めませんでした: {e}")
+
+
+# ============================================
+# 書き出し（ファイル / HTTP）
+# ============================================
+def render_prometheus() -> str:
+    return registry.render()
+
+
+def write_metrics_file(path: str = METRICS_FILE) -> None:
+    """textfile collector が途中の内容を読まないように、一時ファイルに書いてから置き換える。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        # スクレイプのたびにアクセスログを出さない
+        pass
+
+
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def start_exporters() -> None:
+    """ARKY_METRICS_FILE / ARKY_METRICS_PORT（／HOST）に応じて書き出しを始める（何度呼んでも1回だけ）。"""
+    global _exporters_started
+    with _exporters_lock:
+        if _exporters_started or not METRICS_ENABLED:
+            return
+        _exporters_started = True
+
+    if METRICS_FILE:
+
+        def _file_loop() -> None:
+            while True:
+                try:
+                    write_metrics_file(METRICS_FILE)
+                except OSError as e:
+                    print(f"[metrics] {METRICS_FILE} に書き出せませんでした: {e}")
+                time.sleep(METRICS_FILE_INTERVAL_SEC)
+
+        threading.Thread(target=_file_loop, name="arky-metrics-file", daemon=True).start()
+
+    if METRICS_PORT:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+        except OSError as e:
+            print(f"[metrics] {METRICS_HOST}:{METRICS_PORT} で /metrics を開けませんでした: {e}")
+        else:
+            threading.Thread(
+                target=server.serve_forever, name="arky-metrics-http", daemon=True
+            ).start()
+            print(f"[metrics] http://{METRICS_HOST}:{METRICS_PORT}/metrics")
@@ -1,7 +1,45 @@
 # openai_logic.py
+import contextvars
+import copy
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterator, List, Tuple
+import httpx
+import openai
 from openai import OpenAI
 
+from cache_logic import make_cache_key, response_cache
+from metrics_logic import (
+    count_coalesced,
+    count_rate_limit_rejected,
+    observe_span,
+    observe_tokens,
+    registry,
+    span,
+    timed,
+)
+from pattern_parser import (
+    PatternRecord,
+    normalize_pattern_block,
+    splice_pattern_blocks,
+    split_pattern_blocks,
+    validate_pattern_json,
+    validate_patterns_json,
+)
+from quota_logic import current_user, quota_tracker
+from resilience_logic import (
+    CircuitBreaker,
+    Counters,
+    RateLimiter,
+    RateLimitExceeded,
+    SingleFlight,
+    call_with_retry,
+)
+from usage_logic import UsageLedger, new_generation_id, usage_record_from
+
 # ローカルでは .env から、Streamlit Cloud では Secrets から環境変数を読む想定
 try:
     from dotenv import load_dotenv
@@ -11,79 +49,292 @@ except Exception:
     pass
 
 
+# ============================================
+# OpenAI クライアント（プロセス全体で1つを共有）
+# ============================================
+# タイムアウト（秒）とコネクションプールの大きさ
+OPENAI_CONNECT_TIMEOUT_SEC = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SEC", "5"))
+OPENAI_READ_TIMEOUT_SEC = float(os.getenv("OPENAI_READ_TIMEOUT_SEC", "60"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "10"))
+
+# リトライ（429 / 5xx / タイムアウト / 接続エラー）
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE_SEC = float(os.getenv("OPENAI_BACKOFF_BASE_SEC", "0.5"))
+OPENAI_BACKOFF_MAX_SEC = float(os.getenv("OPENAI_BACKOFF_MAX_SEC", "8"))
+
+# サーキットブレーカー
+OPENAI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("OPENAI_BREAKER_FAILURE_THRESHOLD", "5"))
+OPENAI_BREAKER_RESET_SEC = float(os.getenv("OPENAI_BREAKER_RESET_SEC", "30"))
+
+# レート制限（プロセス全体で共有。0 ならその枠は見ない）
+# 既定値はアカウントの上限（Tier 1 の gpt-4o-mini）に合わせる。429 を受けてから待つのではなく、
+# 上限を超えそうなら送る前にここで待つ
+OPENAI_RATE_LIMIT_RPM = float(os.getenv("OPENAI_RATE_LIMIT_RPM", "500"))
+OPENAI_RATE_LIMIT_TPM = float(os.getenv("OPENAI_RATE_LIMIT_TPM", "200000"))
+# まとめて送ってよい量（何秒分の枠か）と、枠が空くのを待つ上限（超えたら RateLimitExceeded）
+OPENAI_RATE_LIMIT_BURST_SEC = float(os.getenv("OPENAI_RATE_LIMIT_BURST_SEC", "10"))
+OPENAI_RATE_LIMIT_MAX_WAIT_SEC = float(os.getenv("OPENAI_RATE_LIMIT_MAX_WAIT_SEC", "30"))
+# 送る前に見積もる出力トークン数（max_tokens を指定しない呼び出し用。3パターン分の目安）
+OPENAI_EXPECTED_COMPLETION_TOKENS = int(os.getenv("OPENAI_EXPECTED_COMPLETION_TOKENS", "1200"))
+
+# 同じリクエストが同時に来たら上流への呼び出しを1回にまとめる（シングルフライト）
+OPENAI_SINGLE_FLIGHT = os.getenv("OPENAI_SINGLE_FLIGHT", "1") == "1"
+
+_client = None
+_client_lock = threading.Lock()
+
+openai_breaker = CircuitBreaker(
+    failure_threshold=OPENAI_BREAKER_FAILURE_THRESHOLD,
+    reset_timeout_sec=OPENAI_BREAKER_RESET_SEC,
+)
+openai_counters = Counters(
+    "clients_created",
+    "requests",
+    "successes",
+    "retries",
+    "retries_exhausted",
+    "retryable_errors",
+    "non_retryable_errors",
+    "timeouts",
+    "rate_limited",
+    "breaker_opened",
+    "breaker_rejected",
+    "rate_limit_waits",
+    "rate_limit_rejected",
+    "coalesced",
+)
+openai_limiter = RateLimiter(
+    requests_per_min=OPENAI_RATE_LIMIT_RPM,
+    tokens_per_min=OPENAI_RATE_LIMIT_TPM,
+    burst_sec=OPENAI_RATE_LIMIT_BURST_SEC,
+    max_wait_sec=OPENAI_RATE_LIMIT_MAX_WAIT_SEC,
+)
+openai_flights = SingleFlight()
+
+# トークン使用量（入力・キャッシュ済み入力・出力）の記録
+usage_ledger = UsageLedger()
+
+
 def _get_client():
     """
     OpenAIクライアントを返すヘルパー。
     APIキーが設定されていない場合は None を返す。
+
+    クライアントは最初の呼び出しで1回だけ作り、全セッションで共有する
+    （HTTP の keep-alive コネクションを使い回し、毎回の TLS ハンドシェイクを避ける）。
+    リトライは _create_completion 側で行うので SDK の自動リトライは切っておく。
     """
+    global _client
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         return None
-    return OpenAI(api_key=api_key)
 
+    with _client_lock:
+        if _client is None:
+            http_client = httpx.Client(
+                timeout=httpx.Timeout(
+                    OPENAI_READ_TIMEOUT_SEC, connect=OPENAI_CONNECT_TIMEOUT_SEC
+                ),
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                ),
+            )
+            _client = OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            openai_counters.inc("clients_created")
+        return _client
 
-def generate_email_with_openai(
-    template: str,
-    tone: str,
-    recipient: str,
-    message: str,
-    seasonal_text: str | None = None,
-    previous_suggestions: str | None = None,
-    is_refine: bool = False,
-) -> str:
+
+def _is_retryable(e: Exception) -> bool:
+    """429 / 5xx / タイムアウト / 接続エラーなら再試行する。"""
+    if isinstance(e, openai.APITimeoutError):
+        openai_counters.inc("timeouts")
+        return True
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 429:
+            openai_counters.inc("rate_limited")
+            return True
+        return e.status_code >= 500
+    return False
+
+
+def _retry_after(e: Exception) -> float | None:
+    """429 などで Retry-After ヘッダが付いていれば、その秒数を返す。"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _estimate_tokens(kwargs: dict) -> int:
     """
-    ビジネスメッセージ案を3パターン生成するラッパー関数。
+    レート制限用のトークン数の見積もり（入力＋出力）。
+    日本語は1文字がおおむね1トークン以下なので、入力は文字数で多めに見積もる。
+    """
+    prompt = sum(len(str(m.get("content") or "")) for m in kwargs.get("messages", []))
+    return prompt + (kwargs.get("max_tokens") or OPENAI_EXPECTED_COMPLETION_TOKENS)
 
-    - 初回生成:
-        is_refine=False または previous_suggestions が None の場合。
-        ユーザーの要望をもとに、3パターンのメール案を新規に生成する。
 
-    - 再生成（リライト）:
-        is_refine=True かつ previous_suggestions が存在する場合。
-        既存の3パターン＋追加要望 message をもとに、
-        3パターンすべてを書き直したMarkdownを生成する。
+def _wait_for_rate_limit(kwargs: dict) -> None:
+    """上流に送る前（再試行のたびに）レート制限の枠を取る。"""
+    if not openai_limiter.enabled:
+        return
+    try:
+        waited = openai_limiter.acquire(_estimate_tokens(kwargs))
+    except RateLimitExceeded:
+        openai_counters.inc("rate_limit_rejected")
+        count_rate_limit_rejected()
+        raise
+    observe_span("openai_rate_limit_wait", waited)
+    if waited > 0:
+        openai_counters.inc("rate_limit_waits")
+
+
+def _call_upstream(client, kwargs: dict):
+    return call_with_retry(
+        lambda: client.chat.completions.create(**kwargs),
+        breaker=openai_breaker,
+        counters=openai_counters,
+        is_retryable=_is_retryable,
+        retry_after=_retry_after,
+        max_retries=OPENAI_MAX_RETRIES,
+        backoff_base_sec=OPENAI_BACKOFF_BASE_SEC,
+        backoff_max_sec=OPENAI_BACKOFF_MAX_SEC,
+        before_attempt=lambda: _wait_for_rate_limit(kwargs),
+    )
+
+
+def _count_coalesced(kind: str) -> None:
+    openai_counters.inc("coalesced")
+    count_coalesced(kind)
+
+
+def _create_completion(client, **kwargs):
     """
+    chat.completions.create をレート制限＋リトライ＋サーキットブレーカー越しに呼ぶ。
+    ブレーカーが open の場合は CircuitOpenError、レート制限の待ちが長すぎる場合は
+    RateLimitExceeded を投げる。
+    stream=True の場合は、ストリームの開始（レスポンスヘッダ受信）までが対象。
 
-    client = _get_client()
+    stream でない呼び出しは、まったく同じリクエストが実行中ならその応答を共有する
+    （ストリームの相乗りは stream_email_with_openai 側で行う）。
+    """
+    with span("openai_request"):
+        if kwargs.get("stream") or not OPENAI_SINGLE_FLIGHT:
+            return _call_upstream(client, kwargs)
+
+        key = json.dumps(kwargs, ensure_ascii=False, sort_keys=True, default=str)
+        response, shared = openai_flights.do(key, lambda: _call_upstream(client, kwargs))
+        if shared:
+            _count_coalesced("completion")
+            # トークン使用量は上流を呼んだ側だけが記録する
+            response = copy.copy(response)
+            response.usage = None
+        return response
+
+
+def get_client_stats() -> dict:
+    """OpenAI 呼び出しのカウンタとブレーカーの状態を返す。"""
+    stats = openai_counters.snapshot()
+    stats["breaker_state"] = openai_breaker.state
+    stats.update(openai_limiter.snapshot())
+    return stats
+
+
+def get_pool_stats() -> dict:
+    """共有クライアントの HTTP コネクションプールの使用状況（クライアント未作成なら空）。"""
+    with _client_lock:
+        client = _client
     if client is None:
-        return "⚠️ OpenAI APIキーが設定されていません。（環境変数 OPENAI_API_KEY を確認してください）"
+        return {}
+    # httpx は公開 API でプールを見せていないので、中の httpcore.ConnectionPool を読む
+    connections = client._client._transport._pool.connections
+    idle = sum(1 for conn in connections if conn.is_idle())
+    return {
+        "active": len(connections) - idle,
+        "idle": idle,
+        "max_connections": OPENAI_MAX_CONNECTIONS,
+    }
 
-    # 共通情報
-    seasonal_info = seasonal_text or "なし"
 
-    # --------------------------------------------------
-    # プロンプト組み立て：初回生成 / リライトで分岐
-    # --------------------------------------------------
-    if is_refine and previous_suggestions:
-        # 既存3パターンをベースに「追加要望」を反映してリライト
-        main_prompt = f"""
-あなたはビジネスメールのプロ編集者です。
+def _register_client_gauges() -> None:
+    """コネクションプール・レート制限の残高・ブレーカーの状態を /metrics に出す。"""
+    registry.gauge(
+        "arky_openai_pool_connections",
+        "Connections in the shared OpenAI HTTP pool (active / idle / max_connections).",
+        lambda: {(state,): value for state, value in get_pool_stats().items()},
+        labelnames=("state",),
+    )
 
-以下に、すでに生成済みの3パターンのメール案があります。
-これらをベースに、追加要望を反映した新しい3パターンを作成してください。
+    def _limiter_levels() -> dict:
+        snapshot = openai_limiter.snapshot()
+        return {
+            ("requests",): snapshot["requests_available"],
+            ("tokens",): snapshot["tokens_available"],
+        }
 
-【メールの種類】
-- テンプレート種別: {template}
-- トーン: {tone}
-- 宛先: {recipient}
-- 時候の挨拶: {seasonal_info}
+    registry.gauge(
+        "arky_openai_rate_limit_available",
+        "Remaining client-side rate limit budget (requests / tokens).",
+        _limiter_levels,
+        labelnames=("bucket",),
+    )
+    registry.gauge(
+        "arky_openai_breaker_open",
+        "1 if the OpenAI circuit breaker is open or half-open, 0 if closed.",
+        lambda: {(): 0 if openai_breaker.state == CircuitBreaker.CLOSED else 1},
+    )
 
-【既存の3パターン（そのまま引用）】
-{previous_suggestions}
 
-【追加要望】
-{message}
+_register_client_gauges()
 
-【出力タスク】
-- 既存の3パターンそれぞれについて、追加要望を反映した新しい文案に書き直してください。
-- 元の文案の構成・ニュアンスは可能な限り維持しつつ、必要な変更だけを行ってください。
-- 各パターンについて必ず以下を含めてください：
-  - 件名
-  - 本文
-  - 改善点
-  - 注意点
 
-【出力フォーマット（絶対にこの構造を守る）】
+def get_usage_stats() -> dict:
+    """トークン使用量の集計（キャッシュヒット率・生成1回あたりのコストなど）を返す。"""
+    return usage_ledger.summary()
+
+
+def _record_usage(usage, generation_id: str, kind: str) -> None:
+    record = usage_record_from(usage, generation_id, kind, MODEL_NAME)
+    usage_ledger.record(record)
+    if record is not None:
+        observe_tokens("prompt", record.prompt_tokens)
+        observe_tokens("cached", record.cached_tokens)
+        observe_tokens("completion", record.completion_tokens)
+        # ユーザーごとの使用量（jobs_logic のジョブから呼ばれた場合だけユーザーが分かる）
+        quota_tracker.record(current_user(), record.prompt_tokens + record.completion_tokens)
+
+
+def openai_available() -> bool:
+    """
+    API キーがあり、ブレーカーが open でなければ True。
+    ブレーカーの状態を見るだけで、half_open の試行枠は消費しない。
+    """
+    return bool(os.getenv("OPENAI_API_KEY")) and openai_breaker.state != CircuitBreaker.OPEN
+
+
+# 使用するモデルとシステムプロンプト
+MODEL_NAME = "gpt-4o-mini"
+SYSTEM_PROMPT = "あなたはビジネス文書を最適化するプロ編集者です。"
+
+NO_API_KEY_MESSAGE = "⚠️ OpenAI APIキーが設定されていません。（環境変数 OPENAI_API_KEY を確認してください）"
+PATTERN_FAILED_MARK = "⚠️ このパターンの生成に失敗しました"
+
+
+# --------------------------------------------------
+# プロンプトの並べ方（プロバイダ側のプレフィックスキャッシュを効かせる）
+# --------------------------------------------------
+# 長い固定の指示・出力フォーマットは system メッセージにまとめ、すべてのリクエストで
+# 1文字も変わらない先頭部分（プレフィックス）にする。テンプレート・トーン・宛先・要望など
+# リクエストごとに変わる値は user メッセージに入れ、変わりやすいものほど後ろに置く。
+_MARKDOWN_FORMAT = """【出力フォーマット（絶対にこの構造を守る）】
 
 ## パターン1
 件名: ...
@@ -118,55 +369,329 @@ def generate_email_with_openai(
 【厳守事項】
 - 「もちろんです」「では早速作成します」などの前置き文は一切書かないこと。
 - 上記の「## パターン1」「## パターン2」「## パターン3」以外の見出しやテキストは書かないこと。
-- 3パターンより多く（4パターン目以降）を出力しないこと。
-"""
-    else:
-        # 初回：ユーザー要望から3パターンを新規生成
-        main_prompt = f"""
+- 3パターンより多く（4パターン目以降）を出力しないこと。"""
+
+# 初回生成・リライトで共通の system メッセージ（3パターンを1回で書かせる）
+MARKDOWN_SYSTEM_PROMPT = f"""{SYSTEM_PROMPT}
+
 あなたはビジネスメールのプロ編集者です。
+ユーザーのメッセージで【メールの種類】と、新規作成なら【ユーザーの要望（概要）】、
+リライトなら【既存の3パターン（そのまま引用）】と【追加要望】が渡されます。
+
+【出力タスク】
+- 新規作成：要望に対して適切なビジネスメール文案を3パターン作成してください。
+- リライト：既存の3パターンそれぞれについて、追加要望を反映した新しい文案に書き直してください。
+  元の文案の構成・ニュアンスは可能な限り維持しつつ、必要な変更だけを行ってください。
+- 各パターンについて必ず以下を含めてください：
+  - 件名
+  - 本文
+  - 改善点（そのパターンをさらに良くするための視点）
+  - 注意点（相手に誤解や不快感を与えないための注意点）
+
+{_MARKDOWN_FORMAT}
+"""
 
-以下の条件に基づき、ビジネスメールの文案を3パターン生成してください。
 
-【メールの種類】
+def _mail_kind_block(template: str, tone: str, recipient: str, seasonal_text: str | None) -> str:
+    return f"""【メールの種類】
 - テンプレート種別: {template}
 - トーン: {tone}
 - 宛先: {recipient}
-- 時候の挨拶: {seasonal_info}
+- 時候の挨拶: {seasonal_text or "なし"}"""
+
+
+@timed("prompt_build")
+def _build_messages(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+) -> List[dict]:
+    """
+    初回生成／リライトのプロンプトを組み立て、chat.completions 用の messages を返す。
+    system は固定（MARKDOWN_SYSTEM_PROMPT）、user にリクエストごとの値を入れる。
+    """
+    kind = _mail_kind_block(template, tone, recipient, seasonal_text)
+
+    if is_refine and previous_suggestions:
+        # 既存3パターンをベースに「追加要望」を反映してリライト
+        user_prompt = f"""既存の3パターンをベースに、追加要望を反映した新しい3パターンを作成してください。
+
+{kind}
+
+【既存の3パターン（そのまま引用）】
+{previous_suggestions}
+
+【追加要望】
+{message}
+"""
+    else:
+        # 初回：ユーザー要望から3パターンを新規生成
+        user_prompt = f"""以下の条件に基づき、ビジネスメールの文案を3パターン生成してください。
+
+{kind}
 
 【ユーザーの要望（概要）】
 {message}
+"""
 
-【出力タスク】
-- 上記の要望に対して適切なビジネスメール文案を3パターン作成してください。
-- 各パターンについて必ず以下を含めてください：
-  - 件名
-  - 本文
-  - 改善点（そのパターンをさらに良くするための視点）
-  - 注意点（相手に誤解や不快感を与えないための注意点）
+    return [
+        {"role": "system", "content": MARKDOWN_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
 
-【出力フォーマット（絶対にこの構造を守る）】
 
-## パターン1
-件名: ...
-本文:
-...
+def _cache_key(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    pattern_index: int | None = None,
+) -> str:
+    return make_cache_key(
+        MODEL_NAME,
+        template,
+        tone,
+        recipient,
+        message,
+        seasonal_text=seasonal_text,
+        previous_suggestions=previous_suggestions,
+        is_refine=is_refine,
+        pattern_index=pattern_index,
+    )
 
-- 改善点:
-  - ...
-- 注意点:
-  - ...
 
-## パターン2
-件名: ...
-本文:
-...
+def get_cached_email(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    pattern_index: int | None = None,
+) -> str | None:
+    """
+    同じ入力（正規化後）の生成結果がキャッシュにあれば返す。無ければ None。
+    app.py はヒットした場合スピナーを出さずに即表示する。
+    pattern_index はパターン単位のリライト結果（1ブロック）を引くときに渡す。
+    """
+    with span("cache_lookup"):
+        return response_cache.get(
+            _cache_key(
+                template,
+                tone,
+                recipient,
+                message,
+                seasonal_text=seasonal_text,
+                previous_suggestions=previous_suggestions,
+                is_refine=is_refine,
+                pattern_index=pattern_index,
+            )
+        )
 
-- 改善点:
-  - ...
-- 注意点:
-  - ...
 
-## パターン3
+def _store_cached_email(text: str, **request) -> None:
+    """正常に生成できた結果だけをキャッシュに保存する。"""
+    if not text or text == NO_API_KEY_MESSAGE or PATTERN_FAILED_MARK in text:
+        return
+    response_cache.put(_cache_key(**request), text)
+
+
+def generate_email_with_openai(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    structured: bool | None = None,
+) -> str:
+    """
+    ビジネスメッセージ案を3パターン生成するラッパー関数。
+
+    - 初回生成:
+        is_refine=False または previous_suggestions が None の場合。
+        ユーザーの要望をもとに、3パターンのメール案を新規に生成する。
+
+    - 再生成（リライト）:
+        is_refine=True かつ previous_suggestions が存在する場合。
+        既存の3パターン＋追加要望 message をもとに、
+        3パターンすべてを書き直したMarkdownを生成する。
+
+    - structured=True（既定は環境変数 ARKY_STRUCTURED_OUTPUT）の場合は
+      JSON スキーマで生成・検証し、壊れたパターンだけを再生成する。
+      戻り値は同じ「## パターンN」形式の Markdown。
+    """
+
+    request = dict(
+        template=template,
+        tone=tone,
+        recipient=recipient,
+        message=message,
+        seasonal_text=seasonal_text,
+        previous_suggestions=previous_suggestions,
+        is_refine=is_refine,
+    )
+    if structured is None:
+        structured = STRUCTURED_OUTPUT
+    if structured:
+        blocks = dict(iter_patterns_structured(**request))
+        return "\n\n".join(blocks[i] for i in sorted(blocks))
+
+    cached = get_cached_email(**request)
+    if cached is not None:
+        return cached
+
+    client = _get_client()
+    if client is None:
+        return NO_API_KEY_MESSAGE
+
+    messages = _build_messages(**request)
+
+    # --------------------------------------------------
+    # 実際の文章生成（1回の呼び出しで3パターン）
+    # --------------------------------------------------
+    response = _create_completion(
+        client,
+        model=MODEL_NAME,
+        messages=messages,
+    )
+    _record_usage(getattr(response, "usage", None), new_generation_id(), "full")
+
+    generated_text = response.choices[0].message.content
+    _store_cached_email(generated_text, **request)
+    return generated_text  # Markdown形式のテキスト（3パターン分）
+
+
+def stream_email_with_openai(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+) -> Iterator[str]:
+    """
+    generate_email_with_openai のストリーミング版。
+
+    生成されたテキストを届いた順にチャンク（文字列）で yield する。
+    すべてのチャンクを連結すると generate_email_with_openai の戻り値と同じ
+    Markdown になるので、呼び出し側は pattern_parser.PatternStreamParser で
+    「## パターンN」ごとに途中経過を表示できる。
+    """
+    request = dict(
+        template=template,
+        tone=tone,
+        recipient=recipient,
+        message=message,
+        seasonal_text=seasonal_text,
+        previous_suggestions=previous_suggestions,
+        is_refine=is_refine,
+    )
+    cached = get_cached_email(**request)
+    if cached is not None:
+        yield cached
+        return
+
+    client = _get_client()
+    if client is None:
+        yield NO_API_KEY_MESSAGE
+        return
+
+    if not OPENAI_SINGLE_FLIGHT:
+        yield from _stream_completion(client, request)
+        return
+    # 同じ入力のストリームが実行中なら、届いた分から同じチャンクを受け取る
+    yield from openai_flights.iterate(
+        f"stream:{_cache_key(**request)}",
+        lambda: _stream_completion(client, request),
+        on_shared=lambda: _count_coalesced("stream"),
+    )
+
+
+def _stream_completion(client, request: dict) -> Iterator[str]:
+    """stream_email_with_openai の上流呼び出し部分（キャッシュに無かった場合）。"""
+    messages = _build_messages(**request)
+
+    # include_usage：最後に choices が空で usage だけのチャンクが届く
+    stream_start = time.perf_counter()
+    stream = _create_completion(
+        client,
+        model=MODEL_NAME,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    generation_id = new_generation_id()
+    chunks: List[str] = []
+    try:
+        for event in stream:
+            if getattr(event, "usage", None) is not None:
+                _record_usage(event.usage, generation_id, "stream")
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                if not chunks:
+                    # 最初のチャンクまで（TTFT）
+                    observe_span("openai_ttft", time.perf_counter() - stream_start)
+                chunks.append(delta)
+                yield delta
+    finally:
+        # 途中で打ち切られた（close された）場合も接続を閉じ、上流に生成をやめさせる
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    observe_span("openai_stream", time.perf_counter() - stream_start)
+
+    # 最後まで受信できた場合だけキャッシュする
+    _store_cached_email("".join(chunks), **request)
+
+
+# ============================================
+# 並列生成エンジン（1パターン＝1リクエストを同時に投げる）
+# ============================================
+# 環境変数 ARKY_PARALLEL_GENERATION=1 で app.py 側が並列生成を使う
+PARALLEL_GENERATION = os.getenv("ARKY_PARALLEL_GENERATION", "0") == "1"
+
+# 1パターンあたり、空・不正な応答を投げ直す最大回数。
+# 通信エラー・429・5xx の再試行は _create_completion（call_with_retry）だけが行う
+PATTERN_MAX_RETRIES = 2
+
+# パターンごとの書き分け指示（3パターンが似通わないようにする）
+PATTERN_VARIANTS = [
+    "最も標準的で、誰に送っても無難な構成にしてください。",
+    "要点を絞り、短く簡潔にまとめてください。",
+    "背景説明や相手への配慮を厚めにし、より丁寧な表現にしてください。",
+]
+
+
+# 並列生成（1パターン＝1リクエスト）で共通の system メッセージ
+SINGLE_PATTERN_SYSTEM_PROMPT = f"""{SYSTEM_PROMPT}
+
+あなたはビジネスメールのプロ編集者です。
+ユーザーのメッセージで【メールの種類】と、新規作成なら【ユーザーの要望（概要）】と【書き分けの方針】、
+リライトなら【既存のメール案（そのまま引用）】と【追加要望】、最後に【パターン番号】が渡されます。
+
+【出力タスク】
+- 新規作成：要望に対して適切なビジネスメール文案を1パターン作成してください。書き分けの方針に従うこと。
+- リライト：既存のメール案を、追加要望を反映した新しい文案に書き直してください。
+  元の文案の構成・ニュアンスは可能な限り維持しつつ、必要な変更だけを行ってください。
+- 必ず件名・本文・改善点・注意点を含めてください。
+
+【出力フォーマット（絶対にこの構造を守る。N は【パターン番号】の数字）】
+
+## パターンN
 件名: ...
 本文:
 ...
@@ -178,23 +703,548 @@ def generate_email_with_openai(
 
 【厳守事項】
 - 「もちろんです」「では早速作成します」などの前置き文は一切書かないこと。
-- 上記の「## パターン1」「## パターン2」「## パターン3」以外の見出しやテキストは書かないこと。
-- 3パターンより多く（4パターン目以降）を出力しないこと。
+- 「## パターンN」以外の見出しやテキストは書かないこと。
+- 1パターンだけを出力すること。
 """
 
-    # --------------------------------------------------
-    # 実際の文章生成（1回の呼び出しで3パターン）
-    # --------------------------------------------------
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": "あなたはビジネス文書を最適化するプロ編集者です。",
-            },
-            {"role": "user", "content": main_prompt},
-        ],
+
+@timed("prompt_build")
+def _build_single_pattern_messages(
+    pattern_index: int,
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_block: str | None = None,
+) -> List[dict]:
+    """
+    並列生成用：1パターン分だけを書かせるプロンプトを組み立てる。
+    previous_block がある場合は、そのパターンを追加要望に沿ってリライトさせる。
+    パターンごとに違う値（番号・書き分けの方針）は user メッセージの最後に置く。
+    """
+    kind = _mail_kind_block(template, tone, recipient, seasonal_text)
+
+    if previous_block:
+        user_prompt = f"""{kind}
+
+【既存のメール案（そのまま引用）】
+{previous_block}
+
+【追加要望】
+{message}
+
+【パターン番号】
+{pattern_index}
+"""
+    else:
+        variant = PATTERN_VARIANTS[(pattern_index - 1) % len(PATTERN_VARIANTS)]
+        user_prompt = f"""{kind}
+
+【ユーザーの要望（概要）】
+{message}
+
+【書き分けの方針】
+{variant}
+
+【パターン番号】
+{pattern_index}
+"""
+    return [
+        {"role": "system", "content": SINGLE_PATTERN_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _generate_single_pattern(
+    client,
+    pattern_index: int,
+    messages: List[dict],
+    generation_id: str,
+    max_retries: int = PATTERN_MAX_RETRIES,
+) -> str:
+    """
+    1パターン分を生成する。空の応答だった場合だけ、このパターンを投げ直す。
+    例外（再試行し尽くした通信エラー・ブレーカー・レート制限）はここでは投げ直さない。
+    """
+    last_error: Exception | None = None
+    for attempt in range(max_retries + 1):
+        try:
+            response = _create_completion(
+                client,
+                model=MODEL_NAME,
+                messages=messages,
+            )
+        except Exception as e:
+            last_error = e
+            print(f"[parallel] パターン{pattern_index} 生成失敗: {e}")
+            break
+        _record_usage(getattr(response, "usage", None), generation_id, "pattern")
+        content = response.choices[0].message.content or ""
+        if content.strip():
+            return normalize_pattern_block(pattern_index, content)
+        last_error = RuntimeError("空の応答が返されました。")
+        print(f"[parallel] パターン{pattern_index} 空の応答（{attempt + 1}回目）")
+
+    return (
+        f"## パターン{pattern_index}\n"
+        f"件名: \n本文:\n{PATTERN_FAILED_MARK}。（{last_error}）"
     )
 
-    generated_text = response.choices[0].message.content
-    return generated_text  # Markdown形式のテキスト（3パターン分）
+
+def iter_patterns_parallel(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    num_patterns: int = 3,
+) -> Iterator[Tuple[int, str]]:
+    """
+    3パターンを別々のリクエストとしてスレッドプールで同時に生成し、
+    書き終わった順に (0始まりのインデックス, 「## パターンN」ブロック) を yield する。
+
+    リライト時は previous_suggestions を分割し、各パターンに自分の既存案だけを渡す。
+    """
+    request = dict(
+        template=template,
+        tone=tone,
+        recipient=recipient,
+        message=message,
+        seasonal_text=seasonal_text,
+        previous_suggestions=previous_suggestions,
+        is_refine=is_refine,
+    )
+    cached = get_cached_email(**request)
+    if cached is not None:
+        for i, block in enumerate(split_pattern_blocks(cached)[:num_patterns]):
+            yield i, block
+        return
+
+    client = _get_client()
+    if client is None:
+        yield 0, NO_API_KEY_MESSAGE
+        return
+
+    previous_blocks: List[str] = []
+    if is_refine and previous_suggestions:
+        previous_blocks = split_pattern_blocks(previous_suggestions)
+
+    generation_id = new_generation_id()
+    with ThreadPoolExecutor(max_workers=num_patterns) as pool:
+        futures = {}
+        for i in range(num_patterns):
+            messages = _build_single_pattern_messages(
+                i + 1,
+                template,
+                tone,
+                recipient,
+                message,
+                seasonal_text=seasonal_text,
+                previous_block=previous_blocks[i] if i < len(previous_blocks) else None,
+            )
+            # span のラベル（template / tone / recipient）をワーカースレッドにも引き継ぐ
+            future = pool.submit(
+                contextvars.copy_context().run,
+                _generate_single_pattern,
+                client,
+                i + 1,
+                messages,
+                generation_id,
+            )
+            futures[future] = i
+
+        done: dict = {}
+        for future in as_completed(futures):
+            idx = futures[future]
+            done[idx] = future.result()
+            yield idx, done[idx]
+
+    _store_cached_email("\n\n".join(done[i] for i in sorted(done)), **request)
+
+
+def generate_email_parallel(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+) -> str:
+    """
+    iter_patterns_parallel の結果を「## パターン1..3」の順に並べ、
+    generate_email_with_openai と同じ形式の Markdown にして返す。
+    """
+    blocks: dict = {}
+    for idx, block in iter_patterns_parallel(
+        template,
+        tone,
+        recipient,
+        message,
+        seasonal_text=seasonal_text,
+        previous_suggestions=previous_suggestions,
+        is_refine=is_refine,
+    ):
+        blocks[idx] = block
+    return "\n\n".join(blocks[i] for i in sorted(blocks))
+
+
+# ============================================
+# 構造化出力（JSON スキーマ）モード
+# ============================================
+# 環境変数 ARKY_STRUCTURED_OUTPUT=1 で app.py 側が JSON モードを使う
+STRUCTURED_OUTPUT = os.getenv("ARKY_STRUCTURED_OUTPUT", "0") == "1"
+
+_PATTERN_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "subject": {"type": "string", "description": "件名"},
+        "body": {"type": "string", "description": "本文（改行は \\n）"},
+        "improve": {"type": "string", "description": "改善点（1行1項目、先頭に「- 」）"},
+        "caution": {"type": "string", "description": "注意点（1行1項目、先頭に「- 」）"},
+    },
+    "required": ["subject", "body", "improve", "caution"],
+    "additionalProperties": False,
+}
+
+_PATTERNS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "email_patterns",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"patterns": {"type": "array", "items": _PATTERN_JSON_SCHEMA}},
+            "required": ["patterns"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+_SINGLE_PATTERN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "email_pattern", "strict": True, "schema": _PATTERN_JSON_SCHEMA},
+}
+
+
+# JSON モードで共通の system メッセージ
+STRUCTURED_SYSTEM_PROMPT = f"""{SYSTEM_PROMPT}
+
+あなたはビジネスメールのプロ編集者です。
+ユーザーのメッセージで【メールの種類】と、新規作成なら【ユーザーの要望（概要）】、
+リライトなら【既存のメール案（そのまま引用）】と【追加要望】、最後に【出力件数】が渡されます。
+
+【出力タスク】
+- 新規作成：要望に対して適切なビジネスメール文案を作成してください。
+- リライト：既存の文案を、追加要望を反映した新しい文案に書き直してください。
+  元の文案の構成・ニュアンスは可能な限り維持しつつ、必要な変更だけを行ってください。
+
+【出力ルール】
+- 指定された JSON スキーマに従って出力すること。
+- subject に件名、body に本文、improve に改善点、caution に注意点を入れること。
+- improve と caution は、1行1項目で先頭に「- 」を付けること。
+- 【出力件数】に従うこと。
+"""
+
+
+@timed("prompt_build")
+def _build_structured_messages(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    pattern_index: int | None = None,
+) -> List[dict]:
+    """
+    JSON モード用のプロンプト。
+    pattern_index を指定すると、そのパターンだけを1件（オブジェクト1つ）で書かせる。
+    """
+    kind = _mail_kind_block(template, tone, recipient, seasonal_text)
+
+    if is_refine and previous_suggestions:
+        source = f"""【既存のメール案（そのまま引用）】
+{previous_suggestions}
+
+【追加要望】
+{message}"""
+    else:
+        source = f"""【ユーザーの要望（概要）】
+{message}"""
+
+    if pattern_index is None:
+        count_rule = "patterns 配列にちょうど3件のメール案を入れること。"
+    else:
+        variant = PATTERN_VARIANTS[(pattern_index - 1) % len(PATTERN_VARIANTS)]
+        count_rule = f"メール案を1件だけ出力すること。書き分けの方針: {variant}"
+
+    user_prompt = f"""{kind}
+
+{source}
+
+【出力件数】
+{count_rule}
+"""
+    return [
+        {"role": "system", "content": STRUCTURED_SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+def _request_json(
+    client, messages: List[dict], response_format: dict, generation_id: str, kind: str
+):
+    """JSON モードで1回呼び出し、パース済みのオブジェクトを返す（壊れていれば None）。"""
+    response = _create_completion(
+        client,
+        model=MODEL_NAME,
+        messages=messages,
+        response_format=response_format,
+    )
+    _record_usage(getattr(response, "usage", None), generation_id, kind)
+    content = response.choices[0].message.content or ""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        print("[structured] JSON として読めない応答:", content[:200])
+        return None
+
+
+def _repair_pattern(
+    client,
+    pattern_index: int,
+    request: dict,
+    previous_block: str | None,
+    generation_id: str,
+) -> str:
+    """
+    不正・欠落していた1パターンだけを再生成する。スキーマに合わない応答だった場合だけ
+    投げ直し、例外（再試行し尽くした通信エラーなど）ではそこでやめる。
+    """
+    last_error: Exception | None = None
+    messages = _build_structured_messages(
+        request["template"],
+        request["tone"],
+        request["recipient"],
+        request["message"],
+        seasonal_text=request["seasonal_text"],
+        previous_suggestions=previous_block,
+        is_refine=bool(previous_block),
+        pattern_index=pattern_index,
+    )
+    for attempt in range(PATTERN_MAX_RETRIES + 1):
+        try:
+            data = _request_json(
+                client, messages, _SINGLE_PATTERN_RESPONSE_FORMAT, generation_id, "repair"
+            )
+        except Exception as e:
+            last_error = e
+            print(f"[structured] パターン{pattern_index} 修復失敗: {e}")
+            break
+        record = validate_pattern_json(data, pattern_index)
+        if record is not None:
+            return record.raw
+        last_error = RuntimeError("スキーマに合わない応答が返されました。")
+        print(f"[structured] パターン{pattern_index} 修復失敗（{attempt + 1}回目）: {last_error}")
+
+    return (
+        f"## パターン{pattern_index}\n"
+        f"件名: \n本文:\n{PATTERN_FAILED_MARK}。（{last_error}）"
+    )
+
+
+def iter_patterns_structured(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    seasonal_text: str | None = None,
+    previous_suggestions: str | None = None,
+    is_refine: bool = False,
+    num_patterns: int = 3,
+) -> Iterator[Tuple[int, str]]:
+    """
+    response_format（JSON スキーマ）で3パターンを一度に生成し、
+    パターンごとに検証してから (0始まりのインデックス, 「## パターンN」ブロック) を yield する。
+
+    不正・欠落していたパターンは、そのパターンだけを1件用のスキーマで再生成する
+    （3パターンすべてを作り直さない）。戻り値の形式は iter_patterns_parallel と同じ。
+    """
+    request = dict(
+        template=template,
+        tone=tone,
+        recipient=recipient,
+        message=message,
+        seasonal_text=seasonal_text,
+        previous_suggestions=previous_suggestions,
+        is_refine=is_refine,
+    )
+    cached = get_cached_email(**request)
+    if cached is not None:
+        for i, block in enumerate(split_pattern_blocks(cached)[:num_patterns]):
+            yield i, block
+        return
+
+    client = _get_client()
+    if client is None:
+        yield 0, NO_API_KEY_MESSAGE
+        return
+
+    generation_id = new_generation_id()
+    data = _request_json(
+        client,
+        _build_structured_messages(**request),
+        _PATTERNS_RESPONSE_FORMAT,
+        generation_id,
+        "structured",
+    )
+    records: List[PatternRecord | None] = validate_patterns_json(data, num_patterns)
+
+    done: dict = {}
+    for i, record in enumerate(records):
+        if record is not None:
+            done[i] = record.raw
+            yield i, done[i]
+
+    missing = [i for i, record in enumerate(records) if record is None]
+    if missing:
+        print(f"[structured] 再生成するパターン: {[i + 1 for i in missing]}")
+        previous_blocks: List[str] = []
+        if is_refine and previous_suggestions:
+            previous_blocks = split_pattern_blocks(previous_suggestions)
+        for i in missing:
+            done[i] = _repair_pattern(
+                client,
+                i + 1,
+                request,
+                previous_blocks[i] if i < len(previous_blocks) else None,
+                generation_id,
+            )
+            yield i, done[i]
+
+    _store_cached_email("\n\n".join(done[i] for i in sorted(done)), **request)
+
+
+# ============================================
+# パターン単位のリライト
+# ============================================
+def _refine_one_pattern(
+    client,
+    pattern_index: int,
+    request: dict,
+    previous_block: str,
+    generation_id: str,
+) -> str:
+    """既存の1パターンだけを追加要望に沿って書き直す（成功したものはブロック単位でキャッシュ）。"""
+    # 全パターンのリライトと同じキーにならないよう、パターン番号もキーに入れる
+    block_request = dict(
+        request, previous_suggestions=previous_block, is_refine=True, pattern_index=pattern_index
+    )
+    cached = get_cached_email(**block_request)
+    if cached is not None:
+        return normalize_pattern_block(pattern_index, cached)
+
+    if STRUCTURED_OUTPUT:
+        block = _repair_pattern(client, pattern_index, request, previous_block, generation_id)
+    else:
+        messages = _build_single_pattern_messages(
+            pattern_index,
+            request["template"],
+            request["tone"],
+            request["recipient"],
+            request["message"],
+            seasonal_text=request["seasonal_text"],
+            previous_block=previous_block,
+        )
+        block = _generate_single_pattern(client, pattern_index, messages, generation_id)
+
+    _store_cached_email(block, **block_request)
+    return block
+
+
+def iter_refine_patterns(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    previous_suggestions: str,
+    pattern_indexes: List[int],
+    seasonal_text: str | None = None,
+) -> Iterator[Tuple[int, str]]:
+    """
+    既存のパターンのうち pattern_indexes（0始まり）のものだけを追加要望で書き直し、
+    書き終わった順に (0始まりのインデックス, 「## パターンN」ブロック) を yield する。
+
+    選んだパターンのブロックだけを送るので、入力・出力とも選んだ数に比例する
+    （1パターンなら3パターン全体のリライトのおよそ 1/3）。
+    複数選んだ場合は iter_patterns_parallel と同じく同時に投げる。
+    """
+    request = dict(
+        template=template,
+        tone=tone,
+        recipient=recipient,
+        message=message,
+        seasonal_text=seasonal_text,
+    )
+    previous_blocks = split_pattern_blocks(previous_suggestions or "")
+    targets = sorted({i for i in pattern_indexes if 0 <= i < len(previous_blocks)})
+    if not targets:
+        return
+
+    client = _get_client()
+    if client is None:
+        yield targets[0], NO_API_KEY_MESSAGE
+        return
+
+    generation_id = new_generation_id()
+    with ThreadPoolExecutor(max_workers=len(targets)) as pool:
+        futures = {
+            pool.submit(
+                contextvars.copy_context().run,
+                _refine_one_pattern,
+                client,
+                i + 1,
+                request,
+                previous_blocks[i],
+                generation_id,
+            ): i
+            for i in targets
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            yield idx, future.result()
+
+
+def refine_email_patterns(
+    template: str,
+    tone: str,
+    recipient: str,
+    message: str,
+    previous_suggestions: str,
+    pattern_indexes: List[int],
+    seasonal_text: str | None = None,
+) -> str:
+    """
+    iter_refine_patterns の結果を previous_suggestions に差し戻した Markdown を返す。
+    失敗したパターン（PATTERN_FAILED_MARK 入り）は差し替えずに元のまま残す。
+    """
+    replacements = {
+        idx: block
+        for idx, block in iter_refine_patterns(
+            template,
+            tone,
+            recipient,
+            message,
+            previous_suggestions,
+            pattern_indexes,
+            seasonal_text=seasonal_text,
+        )
+        if block != NO_API_KEY_MESSAGE and PATTERN_FAILED_MARK not in block
+    }
+    return splice_pattern_blocks(previous_suggestions, replacements)
+
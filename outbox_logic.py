@@ -0,0 +1,279 @@
+# outbox_logic.py
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+# kind ごとのフラッシュ関数：(テーブル名, payload のリスト) を受け取り、まとめて書き込む
+FlushHandler = Callable[[str, List[dict]], None]
+
+
+class WriteBehindQueue:
+    """
+    DB 書き込みをバックグラウンドで行う write-behind キュー。
+
+    - enqueue() はローカルの SQLite（WAL）アウトボックスに1行書くだけで即座に戻る。
+    - ワーカースレッドが件数（batch_size）または時間（flush_interval_sec）で
+      アウトボックスを読み出し、(kind, テーブル) ごとにまとめて handler に渡す。
+    - handler が失敗した行はアウトボックスに残し、指数バックオフで再送する。
+      プロセスが落ちても、次回起動時に残りを再送する。
+    - 一時的なエラー（タイムアウト・接続エラー・5xx など）は、何回失敗しても
+      あきらめずにバックオフしながら同じバッチのまま送り直す（DB の障害が直れば全部届く）。
+    - is_permanent(e) が True のエラー（4xx・制約違反など、送り直しても通らないもの）は、
+      バッチを半分ずつに分けて送り直し、原因の行だけを dead_letter テーブルへ移す
+      （ほかの行はまとめて送れる）。原因を直したら requeue_dead_letters() で戻せる。
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        handlers: Dict[str, FlushHandler],
+        batch_size: int = 50,
+        flush_interval_sec: float = 2.0,
+        max_backoff_sec: float = 60.0,
+        is_permanent: Callable[[Exception], bool] = lambda e: False,
+    ):
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.is_permanent = is_permanent
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "create table if not exists outbox ("
+            " id integer primary key autoincrement,"
+            " kind text not null,"
+            " table_name text not null,"
+            " payload text not null,"
+            " created_at real not null,"
+            " attempts integer not null default 0)"
+        )
+        self._conn.execute(
+            "create table if not exists dead_letter ("
+            " id integer primary key,"
+            " kind text not null,"
+            " table_name text not null,"
+            " payload text not null,"
+            " created_at real not null,"
+            " attempts integer not null,"
+            " failed_at real not null,"
+            " last_error text)"
+        )
+        self._conn.commit()
+        self._db_lock = threading.Lock()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._thread_lock = threading.Lock()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "flushed_rows": 0,
+            "flushes": 0,
+            "flush_failures": 0,
+            "dead_lettered": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+        self._consecutive_failures = 0
+
+    # ---------- 公開API ----------
+    def enqueue(self, kind: str, table_name: str, payload: dict) -> None:
+        """アウトボックスに1件追加する（ネットワークには触れない）。"""
+        if kind not in self.handlers:
+            raise ValueError(f"未登録の kind です: {kind}")
+        with self._db_lock:
+            self._conn.execute(
+                "insert into outbox (kind, table_name, payload, created_at) values (?, ?, ?, ?)",
+                (kind, table_name, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+        with self._stats_lock:
+            self._stats["enqueued"] += 1
+        self.start()
+        if self.depth() >= self.batch_size:
+            self._wake.set()
+
+    def depth(self) -> int:
+        """アウトボックスに残っている（未送信の）件数。"""
+        with self._db_lock:
+            return self._conn.execute("select count(*) from outbox").fetchone()[0]
+
+    def oldest_pending_age_sec(self) -> float:
+        """アウトボックスで一番古い未送信の行が待っている秒数（空なら 0）。"""
+        with self._db_lock:
+            oldest = self._conn.execute("select min(created_at) from outbox").fetchone()[0]
+        return max(time.time() - oldest, 0.0) if oldest is not None else 0.0
+
+    def dead_letter_depth(self) -> int:
+        """送信をあきらめて dead_letter に移した件数。"""
+        with self._db_lock:
+            return self._conn.execute("select count(*) from dead_letter").fetchone()[0]
+
+    def requeue_dead_letters(self) -> int:
+        """
+        dead_letter の行を（試行回数を 0 に戻して）アウトボックスに戻す。戻した件数を返す。
+        テーブル定義を直したなど、恒久的なエラーの原因を取り除いた後に手で呼ぶ。
+        """
+        with self._db_lock:
+            moved = self._conn.execute(
+                "insert into outbox (kind, table_name, payload, created_at)"
+                " select kind, table_name, payload, created_at from dead_letter order by id"
+            ).rowcount
+            self._conn.execute("delete from dead_letter")
+            self._conn.commit()
+        if moved:
+            self._wake.set()
+        return moved
+
+    def start(self) -> None:
+        """ワーカースレッドを起動する（起動済みなら何もしない）。"""
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="write-behind", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self, flush: bool = True) -> None:
+        """ワーカーを止める。flush=True なら残りを1回送ってから止める。"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        if flush:
+            self.flush_once()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.depth()
+        stats["oldest_pending_age_sec"] = self.oldest_pending_age_sec()
+        stats["dead_letter_depth"] = self.dead_letter_depth()
+        stats["avg_flush_ms"] = (
+            stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+        )
+        return stats
+
+    # ---------- ワーカー ----------
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            if self._consecutive_failures:
+                wait = min(
+                    self.max_backoff_sec,
+                    self.flush_interval_sec * (2 ** self._consecutive_failures),
+                )
+            else:
+                wait = self.flush_interval_sec
+            self._wake.wait(timeout=wait)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                # 溜まっている分は batch_size ずつ続けて送る
+                while self.flush_once() >= self.batch_size:
+                    pass
+            except Exception as e:
+                print("[write-behind] flush エラー:", e)
+
+    def _read_pending(self) -> List[Tuple[int, str, str, str, int]]:
+        with self._db_lock:
+            return self._conn.execute(
+                "select id, kind, table_name, payload, attempts from outbox order by id limit ?",
+                (self.batch_size,),
+            ).fetchall()
+
+    def _record_failure(self, ids: List[int]) -> None:
+        """一時的なエラーで送れなかった行の試行回数を増やす（行はアウトボックスに残る）。"""
+        with self._db_lock:
+            self._conn.executemany(
+                "update outbox set attempts = attempts + 1 where id = ?", [(i,) for i in ids]
+            )
+            self._conn.commit()
+        with self._stats_lock:
+            self._stats["flush_failures"] += 1
+
+    def _dead_letter(self, row_id: int, kind: str, table_name: str, error: Exception) -> None:
+        """恒久的なエラーで送れない行を dead_letter に移す。"""
+        with self._db_lock:
+            self._conn.execute(
+                "insert into dead_letter"
+                " (id, kind, table_name, payload, created_at, attempts, failed_at, last_error)"
+                " select id, kind, table_name, payload, created_at, attempts + 1, ?, ?"
+                " from outbox where id = ?",
+                (time.time(), str(error), row_id),
+            )
+            self._conn.execute("delete from outbox where id = ?", (row_id,))
+            self._conn.commit()
+        print(f"[write-behind] {kind} → {table_name} の行 {row_id} を dead_letter に移しました: {error}")
+        with self._stats_lock:
+            self._stats["flush_failures"] += 1
+            self._stats["dead_lettered"] += 1
+
+    def flush_once(self) -> int:
+        """
+        アウトボックスの先頭から最大 batch_size 件を (kind, テーブル) ごとにまとめて送る。
+        送信できた件数を返す（一時的なエラーで失敗した分はアウトボックスに残る）。
+        """
+        pending = self._read_pending()
+        if not pending:
+            return 0
+
+        groups: Dict[Tuple[str, str], List[Tuple[int, dict]]] = {}
+        for row_id, kind, table_name, payload, _ in pending:
+            groups.setdefault((kind, table_name), []).append((row_id, json.loads(payload)))
+
+        sent = 0
+        for (kind, table_name), items in groups.items():
+            group_sent, ok = self._send(kind, table_name, items)
+            sent += group_sent
+            if not ok:
+                # 一時的なエラー：ほかのグループも届かない可能性が高いので、バックオフを待つ
+                break
+        return sent
+
+    def _send(self, kind: str, table_name: str, items: List[Tuple[int, dict]]) -> Tuple[int, bool]:
+        """
+        items をまとめて送る。(送れた件数, 一時的なエラーが無かったか) を返す。
+        恒久的なエラーなら半分ずつに分けて送り直し、1行まで絞れたらその行を dead_letter に移す。
+        """
+        ids = [row_id for row_id, _ in items]
+        started = time.perf_counter()
+        try:
+            self.handlers[kind](table_name, [p for _, p in items])
+        except Exception as e:
+            if not self.is_permanent(e):
+                print(f"[write-behind] {kind} → {table_name} の送信に失敗（{len(ids)}件、後で再送）:", e)
+                self._record_failure(ids)
+                self._consecutive_failures += 1
+                return 0, False
+            if len(items) == 1:
+                self._dead_letter(ids[0], kind, table_name, e)
+                return 0, True
+            mid = len(items) // 2
+            first_sent, ok = self._send(kind, table_name, items[:mid])
+            if not ok:
+                return first_sent, False
+            rest_sent, ok = self._send(kind, table_name, items[mid:])
+            return first_sent + rest_sent, ok
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._db_lock:
+            self._conn.executemany("delete from outbox where id = ?", [(i,) for i in ids])
+            self._conn.commit()
+        with self._stats_lock:
+            self._stats["flushes"] += 1
+            self._stats["flushed_rows"] += len(ids)
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+            self._stats["total_flush_ms"] += elapsed_ms
+        self._consecutive_failures = 0
+        return len(ids), True
@@ -0,0 +1,266 @@
+# pattern_parser.py
+import re
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+# ============================================
+# AI 出力（「## パターンN」形式の Markdown）のパーサ
+# ============================================
+# 正規表現はすべてここで1回だけコンパイルする
+_HEADER_RE = re.compile(r"##\s*パターン\s*(\d+)")
+_HEADER_LINE_RE = re.compile(r"^\s*##\s*パターン[^\n]*\n?")
+_SPLIT_RE = re.compile(r"(?=^##\s*パターン\s*\d+)", re.MULTILINE)
+_SUBJECT_RE = re.compile(r"\s*(?:\*\*)?件名(?:\*\*)?\s*[:：]\s*(?:\*\*)?\s*(.*?)\s*$")
+_BODY_RE = re.compile(r"\s*(?:\*\*)?本文(?:\*\*)?\s*[:：]\s*(?:\*\*)?\s*(.*)$")
+_IMPROVE_RE = re.compile(r"\s*-+\s*(?:\*\*)?改善点(?:\*\*)?\s*[:：]?\s*(?:\*\*)?\s*(.*)$")
+_CAUTION_RE = re.compile(r"\s*-+\s*(?:\*\*)?注意点(?:\*\*)?\s*[:：]?\s*(?:\*\*)?\s*(.*)$")
+
+# 3パターンに満たない場合の埋め草
+MISSING_PATTERN_TEXT = "このパターンはまだ生成されていません。"
+
+
+@dataclass
+class PatternRecord:
+    """1パターン分の解析結果。raw はコピー用の元 Markdown。"""
+
+    index: int
+    subject: str = ""
+    body: str = ""
+    improve: str = ""
+    caution: str = ""
+    raw: str = ""
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    def to_markdown(self) -> str:
+        """generate_email_with_openai と同じ「## パターンN」形式の Markdown にする。"""
+        parts = [f"## パターン{self.index}", f"件名: {self.subject}", "本文:", self.body, ""]
+        parts.append("- 改善点:")
+        parts.extend(f"  {line}" for line in self.improve.splitlines())
+        parts.append("- 注意点:")
+        parts.extend(f"  {line}" for line in self.caution.splitlines())
+        return "\n".join(parts)
+
+
+def _finish(index: int, sections: dict, raw_lines: List[str]) -> PatternRecord:
+    return PatternRecord(
+        index=index,
+        subject=sections["subject"],
+        body="\n".join(sections["body"]).strip(),
+        improve="\n".join(sections["improve"]).strip(),
+        caution="\n".join(sections["caution"]).strip(),
+        raw="\n".join(raw_lines).strip(),
+    )
+
+
+def parse_patterns(text: str | None, num_patterns: int = 3) -> List[PatternRecord]:
+    """
+    AI の出力全体を1回の走査で解析し、PatternRecord のリストを返す。
+
+    - 行頭の「## パターンN」でパターンを区切る（最初の見出しより前の前置き文は捨てる）。
+    - 見出しが1つも無い場合は、全文を1パターン目の本文として扱う。
+    - 「件名:」「本文:」「- 改善点」「- 注意点」のラベル行でセクションを切り替える。
+      本文ラベルが無い場合は、件名以外のセクション前の行を本文とみなす。
+    - num_patterns 件に満たない分は MISSING_PATTERN_TEXT で埋める。
+    """
+    records: List[PatternRecord] = []
+    text = text or ""
+    has_header = _HEADER_RE.search(text) is not None
+
+    sections: dict | None = None
+    raw_lines: List[str] = []
+    mode = "body"
+
+    if not has_header and text.strip():
+        sections = {"subject": "", "body": [], "improve": [], "caution": []}
+
+    for line in text.splitlines():
+        # 見出し行：新しいパターンを始める
+        if line.lstrip().startswith("##") and _HEADER_RE.match(line.lstrip()):
+            if sections is not None:
+                records.append(_finish(len(records) + 1, sections, raw_lines))
+                if len(records) >= num_patterns:
+                    sections = None
+                    break
+            sections = {"subject": "", "body": [], "improve": [], "caution": []}
+            raw_lines = [line]
+            mode = "body"
+            continue
+
+        if sections is None:
+            # 最初の見出しより前の前置き文
+            continue
+        raw_lines.append(line)
+
+        if "件名" in line and not sections["subject"]:
+            m = _SUBJECT_RE.match(line)
+            if m:
+                sections["subject"] = m.group(1)
+                continue
+        if "本文" in line and mode == "body" and not sections["body"]:
+            m = _BODY_RE.match(line)
+            if m:
+                if m.group(1):
+                    sections["body"].append(m.group(1))
+                continue
+        if "改善点" in line:
+            m = _IMPROVE_RE.match(line)
+            if m:
+                mode = "improve"
+                if m.group(1):
+                    sections["improve"].append(m.group(1))
+                continue
+        if "注意点" in line:
+            m = _CAUTION_RE.match(line)
+            if m:
+                mode = "caution"
+                if m.group(1):
+                    sections["caution"].append(m.group(1))
+                continue
+
+        sections[mode].append(line)
+
+    if sections is not None and len(records) < num_patterns:
+        records.append(_finish(len(records) + 1, sections, raw_lines))
+
+    while len(records) < num_patterns:
+        records.append(
+            PatternRecord(index=len(records) + 1, body=MISSING_PATTERN_TEXT, raw=MISSING_PATTERN_TEXT)
+        )
+    return records
+
+
+def validate_pattern_json(item, index: int) -> PatternRecord | None:
+    """
+    JSON 出力の1パターン分（{subject, body, improve, caution}）を検証する。
+    件名・本文が空でない文字列で、改善点・注意点が文字列なら PatternRecord を返す。
+    不正な場合は None を返す（呼び出し側でそのパターンだけを再生成する）。
+    """
+    if not isinstance(item, dict):
+        return None
+    fields = {}
+    for key in ("subject", "body", "improve", "caution"):
+        value = item.get(key)
+        if not isinstance(value, str):
+            return None
+        fields[key] = value.strip()
+    if not fields["subject"] or not fields["body"]:
+        return None
+    record = PatternRecord(index=index, **fields)
+    record.raw = record.to_markdown()
+    return record
+
+
+def validate_patterns_json(data, num_patterns: int = 3) -> List[PatternRecord | None]:
+    """
+    JSON 出力全体（{"patterns": [...]}）を検証し、長さ num_patterns のリストを返す。
+    不正・欠落しているパターンの位置は None になる。
+    """
+    items = data.get("patterns") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        items = []
+    results: List[PatternRecord | None] = []
+    for i in range(num_patterns):
+        item = items[i] if i < len(items) else None
+        results.append(validate_pattern_json(item, i + 1))
+    return results
+
+
+def parse_pattern_block(block: str) -> dict:
+    """
+    1 パターン分の Markdown テキストから、件名／本文／改善点／注意点を抽出する。
+    （ストリーミング途中のブロックなど、単体のブロックを解析するとき用）
+    """
+    record = parse_patterns(block, num_patterns=1)[0]
+    return {
+        "subject": record.subject,
+        "body": record.body,
+        "improve": record.improve,
+        "caution": record.caution,
+    }
+
+
+def split_pattern_blocks(text: str) -> List[str]:
+    """行頭の「## パターンN」で Markdown を分割し、空でないブロックを返す。"""
+    return [b.strip() for b in _SPLIT_RE.split(text) if b.strip()]
+
+
+def normalize_pattern_block(pattern_index: int, text: str) -> str:
+    """モデルが付けた見出しを外し、正しい「## パターンN」見出しを付け直す。"""
+    body = _HEADER_LINE_RE.sub("", text.strip(), count=1).strip()
+    return f"## パターン{pattern_index}\n{body}"
+
+
+def splice_pattern_blocks(text: str, replacements: Dict[int, str]) -> str:
+    """
+    「## パターンN」形式の Markdown のうち、replacements（0始まりの index → ブロック）の
+    パターンだけを差し替えた Markdown を返す。ほかのパターンは元のまま残す。
+    """
+    blocks = split_pattern_blocks(text)
+    for idx, block in replacements.items():
+        block = normalize_pattern_block(idx + 1, block)
+        if idx < len(blocks):
+            blocks[idx] = block
+        else:
+            blocks.append(block)
+    return "\n\n".join(blocks)
+
+
+# ============================================
+# ストリーミング用のインクリメンタルパーサ
+# ============================================
+class PatternStreamParser:
+    """
+    ストリーミング中のテキストを少しずつ受け取り、
+    行頭の「## パターンN」見出しを境界としてブロックに分ける。
+
+    - 見出しは改行まで届いた行だけで判定する（「## パ」「ターン2」のように
+      チャンクをまたいでも誤判定しない）。
+    - 走査済みの位置を覚えておくので、チャンクごとに全文を再スキャンしない。
+    - 最初の見出しより前の前置き文は捨てる。
+    """
+
+    def __init__(self, max_patterns: int = 3):
+        self.max_patterns = max_patterns
+        self.text = ""
+        self._scan_pos = 0
+        self._starts: List[int] = []
+        self._finished = False
+
+    def _scan_line(self, line_start: int, line_end: int) -> None:
+        if _HEADER_RE.match(self.text, line_start, line_end):
+            self._starts.append(line_start)
+
+    def feed(self, chunk: str) -> List[str]:
+        """チャンクを追加し、現時点のブロック一覧を返す。"""
+        self.text += chunk
+        while True:
+            nl = self.text.find("\n", self._scan_pos)
+            if nl == -1:
+                break
+            self._scan_line(self._scan_pos, nl)
+            self._scan_pos = nl + 1
+        return self.blocks
+
+    def finish(self) -> List[str]:
+        """ストリーム終了時に呼ぶ。改行で終わらない最終行も判定する。"""
+        if not self._finished and self._scan_pos < len(self.text):
+            self._scan_line(self._scan_pos, len(self.text))
+            self._scan_pos = len(self.text)
+        self._finished = True
+        return self.blocks
+
+    @property
+    def blocks(self) -> List[str]:
+        """見出しごとのブロック（途中のものも含む、最大 max_patterns 件）。"""
+        starts = self._starts[: self.max_patterns]
+        ends = self._starts[1 : self.max_patterns + 1] + [len(self.text)]
+        return [self.text[s:e].strip() for s, e in zip(starts, ends)]
+
+    @property
+    def completed_count(self) -> int:
+        """書き終わったブロックの数（次の見出しが来た or ストリーム終了）。"""
+        if self._finished:
+            return len(self.blocks)
+        return min(max(len(self._starts) - 1, 0), self.max_patterns)
@@ -0,0 +1,218 @@
+# quota_logic.py
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict
+
+from metrics_logic import registry
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# ユーザー（セッション）ごとに QUOTA_WINDOW_SEC の間に使ってよいトークン数（0 なら上限なし）
+USER_TOKEN_QUOTA = int(os.getenv("ARKY_USER_TOKEN_QUOTA", "200000"))
+QUOTA_WINDOW_SEC = int(os.getenv("ARKY_USER_QUOTA_WINDOW_SEC", "3600"))
+
+# 使用量を書き出すファイル（空なら書かない）と、書き出す間隔
+QUOTA_STATE_PATH = os.getenv("ARKY_QUOTA_STATE", ".arky_quota.json")
+QUOTA_FLUSH_INTERVAL_SEC = float(os.getenv("ARKY_QUOTA_FLUSH_INTERVAL_SEC", "30"))
+
+# 使用量を数える時間バケットの幅（秒）。窓はこの幅で少しずつずれていく
+QUOTA_BUCKET_SEC = 60
+
+# 上限近くまで使ったユーザーでも、ほかに待っている人がいなければ順番が回ってくるように
+MIN_WEIGHT = 0.1
+
+# いま実行中の呼び出しがどのユーザーのものか（jobs_logic がジョブごとに設定する）
+_current_user: contextvars.ContextVar = contextvars.ContextVar("arky_current_user", default="")
+
+
+def current_user() -> str:
+    return _current_user.get()
+
+
+def set_current_user(user: str) -> None:
+    """この contextvars のコンテキスト（ジョブ1件ぶん）の使用量を user に付ける。"""
+    _current_user.set(user)
+
+
+class QuotaTracker:
+    """
+    ユーザーごとのトークン使用量を (ユーザー, 時間バケット) ごとにメモリで数え、
+    直近 window_sec の合計を上限（quota_tokens）と比べる。
+
+    - 使用量は flush_interval_sec ごとに path へ書き出し、起動時に読み戻す
+      （再起動しても上限がリセットされないように）。
+    - weight() は残りの枠の割合で、jobs_logic の重み付きラウンドロビンに使う。
+      たくさん使ったユーザーほど、順番が回ってくる頻度が下がる。
+    """
+
+    def __init__(
+        self,
+        quota_tokens: int = USER_TOKEN_QUOTA,
+        window_sec: int = QUOTA_WINDOW_SEC,
+        path: str = QUOTA_STATE_PATH,
+        flush_interval_sec: float = QUOTA_FLUSH_INTERVAL_SEC,
+    ):
+        self.quota_tokens = quota_tokens
+        self.window_sec = window_sec
+        self.path = path
+        self.flush_interval_sec = flush_interval_sec
+        # ユーザー -> {バケットの開始時刻: トークン数}
+        self._usage: Dict[str, Dict[int, int]] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._stats = {"recorded_tokens": 0, "flushes": 0, "flush_failures": 0}
+        self._load()
+
+    def _bucket_start(self, ts: float) -> int:
+        return int(ts // QUOTA_BUCKET_SEC) * QUOTA_BUCKET_SEC
+
+    def record(self, user: str, tokens: int) -> None:
+        """user が tokens トークン使ったことを記録する（ユーザー不明・0 は数えない）。"""
+        if not user or tokens <= 0:
+            return
+        bucket = self._bucket_start(time.time())
+        with self._lock:
+            buckets = self._usage.setdefault(user, {})
+            buckets[bucket] = buckets.get(bucket, 0) + tokens
+            self._dirty = True
+            self._stats["recorded_tokens"] += tokens
+        self._ensure_thread()
+
+    def used(self, user: str) -> int:
+        """直近 window_sec に user が使ったトークン数。"""
+        cutoff = time.time() - self.window_sec
+        with self._lock:
+            buckets = self._usage.get(user)
+            if not buckets:
+                return 0
+            return sum(tokens for start, tokens in buckets.items() if start >= cutoff)
+
+    def remaining(self, user: str) -> int | None:
+        """残りのトークン数。上限なしなら None。"""
+        if self.quota_tokens <= 0:
+            return None
+        return max(self.quota_tokens - self.used(user), 0)
+
+    def exceeded(self, user: str) -> bool:
+        remaining = self.remaining(user)
+        return remaining is not None and remaining <= 0
+
+    def weight(self, user: str) -> float:
+        """スケジューラの重み（MIN_WEIGHT〜1.0）。上限なしなら常に 1.0。"""
+        remaining = self.remaining(user)
+        if remaining is None:
+            return 1.0
+        return max(MIN_WEIGHT, remaining / self.quota_tokens)
+
+    def _expire(self) -> None:
+        """窓から外れたバケットを捨てる（ロックを取ってから呼ぶ）。"""
+        cutoff = self._bucket_start(time.time() - self.window_sec)
+        for user in list(self._usage):
+            buckets = self._usage[user]
+            for start in [start for start in buckets if start < cutoff]:
+                del buckets[start]
+            if not buckets:
+                del self._usage[user]
+
+    # ---------- 書き出し・読み戻し ----------
+    def flush(self) -> bool:
+        """変更があれば path に書き出す。書き出したら True。"""
+        if not self.path:
+            return False
+        with self._lock:
+            if not self._dirty:
+                return False
+            self._expire()
+            snapshot = {
+                user: {str(start): tokens for start, tokens in buckets.items()}
+                for user, buckets in self._usage.items()
+            }
+            self._dirty = False
+
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"window_sec": self.window_sec, "usage": snapshot}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[quota] {self.path} に書き出せませんでした（次回再送）: {e}")
+            with self._lock:
+                self._dirty = True
+                self._stats["flush_failures"] += 1
+            return False
+        with self._lock:
+            self._stats["flushes"] += 1
+        return True
+
+    def _load(self) -> None:
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                usage = json.load(f).get("usage", {})
+            self._usage = {
+                user: {int(start): int(tokens) for start, tokens in buckets.items()}
+                for user, buckets in usage.items()
+            }
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"[quota] {self.path} を読み込めませんでした（空の状態で始めます）: {e}")
+            self._usage = {}
+        self._expire()
+
+    def usage_by_user(self) -> Dict[str, int]:
+        """直近 window_sec に使ったトークン数（使ったユーザーだけ）。"""
+        cutoff = time.time() - self.window_sec
+        with self._lock:
+            usage = {
+                user: sum(tokens for start, tokens in buckets.items() if start >= cutoff)
+                for user, buckets in self._usage.items()
+            }
+        return {user: tokens for user, tokens in usage.items() if tokens > 0}
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["users"] = len(self._usage)
+        return stats
+
+    # ---------- 定期フラッシュ ----------
+    def _ensure_thread(self) -> None:
+        if not self.path or (self._thread is not None and self._thread.is_alive()):
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="quota-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval_sec)
+            self.flush()
+
+
+# プロセス全体で共有する使用量の記録
+quota_tracker = QuotaTracker()
+
+
+def _register_quota_gauges(tracker: QuotaTracker) -> None:
+    """ユーザーごとの使用量と、上限に達したユーザー数を /metrics に出す。"""
+    registry.gauge(
+        "arky_user_tokens_used",
+        "Tokens used per user within the quota window (only users with usage).",
+        lambda: {(user,): tokens for user, tokens in tracker.usage_by_user().items()},
+        labelnames=("user",),
+    )
+    registry.gauge(
+        "arky_users_over_quota",
+        "Users who have used up their token quota for the current window.",
+        lambda: {(): sum(1 for user in tracker.usage_by_user() if tracker.exceeded(user))},
+    )
+
+
+_register_quota_gauges(quota_tracker)
@@ -0,0 +1,557 @@
+# resilience_logic.py
+import contextvars
+import queue
+import random
+import threading
+import time
+from typing import Callable, Dict, Generic, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(RuntimeError):
+    """サーキットブレーカーが開いている（上流が不調）ため、呼び出しを即座に打ち切った。"""
+
+
+# ============================================
+# サーキットブレーカー
+# ============================================
+class CircuitBreaker:
+    """
+    連続失敗が failure_threshold 回に達したら「open」にし、
+    reset_timeout_sec の間はすべての呼び出しを即座に失敗させる。
+    時間が経ったら「half_open」で1件だけ試し、成功すれば「closed」に戻す。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_sec: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_sec = reset_timeout_sec
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_sec:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        """呼び出してよければ True。open 中（または half_open の試行中）は False。"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout_sec:
+                    return False
+                self._state = self.HALF_OPEN
+                self._half_open_in_flight = False
+            # HALF_OPEN：試行は同時に1件だけ
+            if self._half_open_in_flight:
+                return False
+            self._half_open_in_flight = True
+            return True
+
+    def release(self) -> None:
+        """
+        allow_request() で取った half_open の試行枠を、成功・失敗を記録せずに返す
+        （呼び出す前にやめた場合や、上流の不調とは関係ないエラーの場合）。
+        """
+        with self._lock:
+            self._half_open_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._half_open_in_flight = False
+
+    def record_failure(self) -> bool:
+        """失敗を記録する。このタイミングで open に遷移した場合は True を返す。"""
+        with self._lock:
+            self._failures += 1
+            self._half_open_in_flight = False
+            if self._state == self.HALF_OPEN or (
+                self._state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+# ============================================
+# カウンタ
+# ============================================
+class Counters:
+    """スレッドセーフな名前付きカウンタ。"""
+
+    def __init__(self, *names: str):
+        self._values: Dict[str, int] = {name: 0 for name in names}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+
+
+# ============================================
+# リトライ（指数バックオフ＋ジッター）
+# ============================================
+def backoff_delay(attempt: int, base_sec: float, max_sec: float) -> float:
+    """attempt 回目（0始まり）の待ち時間。full jitter 方式で 0〜上限の一様乱数。"""
+    return random.uniform(0, min(max_sec, base_sec * (2 ** attempt)))
+
+
+def call_with_retry(
+    fn: Callable[[], T],
+    breaker: CircuitBreaker,
+    counters: Counters,
+    is_retryable: Callable[[Exception], bool],
+    retry_after: Callable[[Exception], float | None] = lambda e: None,
+    max_retries: int = 3,
+    backoff_base_sec: float = 0.5,
+    backoff_max_sec: float = 8.0,
+    before_attempt: Callable[[], None] | None = None,
+) -> T:
+    """
+    fn() をサーキットブレーカー越しに呼び出し、再試行可能なエラーなら
+    指数バックオフ＋ジッターで投げ直す。
+
+    - ブレーカーが open なら CircuitOpenError を投げる（上流には投げない）。
+    - retry_after が秒数を返した場合（429 の Retry-After など）はそれを優先する。
+    - before_attempt は再試行を含む毎回の呼び出しの前（ブレーカーの確認の後）に呼ぶ
+      （レート制限の待ちなど）。ブレーカーが open なら呼ばないので、枠を無駄に取らない。
+      ここで投げた例外はブレーカーに数えずにそのまま投げる。
+    - 再試行不可のエラー（400 など）は上流の不調ではないので、ブレーカーの状態を変えない
+      （成功としても数えない。half_open の試行枠だけ返す）。
+    """
+    attempt = 0
+    while True:
+        if not breaker.allow_request():
+            counters.inc("breaker_rejected")
+            raise CircuitOpenError("上流APIが不調のため、一時的にリクエストを停止しています。")
+        if before_attempt is not None:
+            try:
+                before_attempt()
+            except BaseException:
+                breaker.release()
+                raise
+
+        counters.inc("requests")
+        try:
+            result = fn()
+        except Exception as e:
+            retryable = is_retryable(e)
+            # 再試行不可のエラー（400 など）は上流の不調ではないのでブレーカーに数えない
+            if retryable:
+                counters.inc("retryable_errors")
+                if breaker.record_failure():
+                    counters.inc("breaker_opened")
+            else:
+                counters.inc("non_retryable_errors")
+                breaker.release()
+                raise
+
+            if attempt >= max_retries:
+                counters.inc("retries_exhausted")
+                raise
+
+            delay = retry_after(e)
+            if delay is None:
+                delay = backoff_delay(attempt, backoff_base_sec, backoff_max_sec)
+            counters.inc("retries")
+            time.sleep(min(delay, backoff_max_sec))
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        counters.inc("successes")
+        return result
+
+
+# ============================================
+# レート制限（トークンバケット：リクエスト数／分とトークン数／分）
+# ============================================
+class RateLimitExceeded(RuntimeError):
+    """レート制限の枠が空くまでの待ち時間が上限を超えるため、呼び出しを打ち切った。"""
+
+
+class RateLimiter:
+    """
+    プロセス全体で共有するトークンバケット。requests_per_min と tokens_per_min の
+    両方の枠が空くまで acquire() が待つ（どちらかが 0 ならその枠は見ない）。
+
+    枠は先に予約して（残高がマイナスになってよい）、足りない分が貯まるまで眠る方式なので、
+    同時に待っている呼び出しは到着順に通る。バケットの大きさは burst_sec 秒分。
+    待ち時間が max_wait_sec を超える場合は予約せずに RateLimitExceeded を投げる。
+    """
+
+    def __init__(
+        self,
+        requests_per_min: float,
+        tokens_per_min: float,
+        burst_sec: float = 10.0,
+        max_wait_sec: float = 30.0,
+    ):
+        self.max_wait_sec = max_wait_sec
+        # [1秒あたりの補充量, 容量, 残高]
+        self._buckets = [
+            [per_min / 60.0, max(1.0, per_min * burst_sec / 60.0), 0.0]
+            for per_min in (requests_per_min, tokens_per_min)
+        ]
+        for bucket in self._buckets:
+            bucket[2] = bucket[1]
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        for bucket in self._buckets:
+            bucket[2] = min(bucket[1], bucket[2] + elapsed * bucket[0])
+
+    @property
+    def enabled(self) -> bool:
+        return any(rate > 0 for rate, _, _ in self._buckets)
+
+    def acquire(self, tokens: int = 0) -> float:
+        """1リクエスト分（と tokens 分）の枠を取る。待った秒数を返す。"""
+        # 1回で容量を超える分は容量までに切り詰める（永久に通らなくならないように）
+        amounts = [
+            min(amount, capacity) for amount, (_, capacity, _) in zip((1.0, tokens), self._buckets)
+        ]
+        with self._lock:
+            self._refill()
+            wait = 0.0
+            for amount, (rate, _, level) in zip(amounts, self._buckets):
+                if rate > 0 and amount > level:
+                    wait = max(wait, (amount - level) / rate)
+            if wait > self.max_wait_sec:
+                raise RateLimitExceeded(
+                    f"レート制限の枠が空くまで {wait:.1f} 秒かかるため、リクエストを送りませんでした。"
+                )
+            for bucket, amount in zip(self._buckets, amounts):
+                if bucket[0] > 0:
+                    bucket[2] -= amount
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def snapshot(self) -> Dict[str, float]:
+        """現在の残高（リクエスト数・トークン数）。"""
+        with self._lock:
+            self._refill()
+            levels = [level for _, _, level in self._buckets]
+        return {"requests_available": round(levels[0], 2), "tokens_available": round(levels[1], 1)}
+
+
+# ============================================
+# シングルフライト（同じキーの同時呼び出しを上流1回にまとめる）
+# ============================================
+class _Flight:
+    def __init__(self):
+        self.items: list = []
+        self.result = None
+        self.error: BaseException | None = None
+        self.done = False
+        self.cond = threading.Condition()
+        # iterate で相乗りしている呼び出しの数と、最初の呼び出し側が途中でやめたときに
+        # 引き継ぐ上流の iterator
+        self.followers = 0
+        self.upstream: Iterator | None = None
+
+
+class SingleFlight:
+    """
+    同じキーの呼び出しが実行中なら、新しく呼ばずにその結果を待って受け取る。
+    終わった呼び出しは覚えておかない（結果の再利用はキャッシュの役目）。
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: str) -> tuple:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def _land(self, key: str, flight: _Flight) -> None:
+        with self._lock:
+            self._flights.pop(key, None)
+        with flight.cond:
+            flight.done = True
+            flight.cond.notify_all()
+
+    def do(self, key: str, fn: Callable[[], T]) -> tuple:
+        """(fn() の結果, ほかの呼び出しの結果を共有したか) を返す。例外も共有する。"""
+        flight, leader = self._join(key)
+        if not leader:
+            with flight.cond:
+                flight.cond.wait_for(lambda: flight.done)
+                flight.followers -= 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.result, False
+
+    def iterate(
+        self,
+        key: str,
+        factory: Callable[[], Iterable[T]],
+        on_shared: Callable[[], None] = lambda: None,
+    ) -> Iterator[T]:
+        """
+        iterator 版。最初の呼び出しだけが factory() を回し、後から来た呼び出しは
+        それまでに届いた要素から順に同じ要素を受け取る（ストリームの相乗り）。
+        相乗りした場合は on_shared() を1回呼ぶ。
+
+        回している側が途中で読むのをやめたら、上流は閉じずに相乗りしている側の1つに
+        引き継ぐ（_hand_off）。相乗りしている側がいなければ上流を閉じる。
+        """
+        flight, leader = self._join(key)
+        if leader:
+            yield from self._lead(key, flight, iter(factory()))
+            return
+
+        on_shared()
+        index = 0
+        following = True
+        try:
+            while True:
+                with self._lock, flight.cond:
+                    upstream = None
+                    if index >= len(flight.items) and flight.upstream is not None:
+                        # 回していた側がやめた：ここから先はこの呼び出しが上流を回す
+                        upstream, flight.upstream = flight.upstream, None
+                        flight.followers -= 1
+                        following = False
+                if upstream is not None:
+                    yield from self._lead(key, flight, upstream)
+                    return
+
+                with flight.cond:
+                    flight.cond.wait_for(
+                        lambda: index < len(flight.items)
+                        or flight.done
+                        or flight.upstream is not None
+                    )
+                    items = flight.items[index:]
+                    done = flight.done
+                for item in items:
+                    yield item
+                index += len(items)
+                if done and index >= len(flight.items):
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+        finally:
+            if following:
+                self._leave(key, flight)
+
+    def _lead(self, key: str, flight: _Flight, upstream: Iterator[T]) -> Iterator[T]:
+        """上流を回して、要素を相乗りしている側にも渡す。"""
+        try:
+            for item in upstream:
+                with flight.cond:
+                    flight.items.append(item)
+                    flight.cond.notify_all()
+                yield item
+        except GeneratorExit:
+            if self._hand_off(flight, upstream):
+                raise
+            _close(upstream)
+            flight.error = RuntimeError("共有していた上流の呼び出しが途中で打ち切られました。")
+            self._land(key, flight)
+            raise
+        except BaseException as e:
+            flight.error = e
+            self._land(key, flight)
+            raise
+        self._land(key, flight)
+
+    def _hand_off(self, flight: _Flight, upstream: Iterator) -> bool:
+        """相乗りしている側がいれば、上流をそちらに渡して True を返す。"""
+        with self._lock, flight.cond:
+            if flight.followers == 0:
+                return False
+            flight.upstream = upstream
+            flight.cond.notify_all()
+            return True
+
+    def _leave(self, key: str, flight: _Flight) -> None:
+        """
+        相乗りしていた呼び出しが終わった（途中でやめた）。引き継ぐはずだった上流が
+        残っていて、ほかに相乗りしている側もいなければ、上流を閉じて終わらせる。
+        """
+        orphan = None
+        with self._lock, flight.cond:
+            flight.followers -= 1
+            if flight.followers == 0 and flight.upstream is not None:
+                orphan, flight.upstream = flight.upstream, None
+        if orphan is not None:
+            _close(orphan)
+            flight.error = RuntimeError("共有していた上流の呼び出しが途中で打ち切られました。")
+            self._land(key, flight)
+
+
+def _close(iterator: Iterator) -> None:
+    # list_iterator など close() を持たない iterator もある
+    close = getattr(iterator, "close", None)
+    if close is not None:
+        close()
+
+
+# ============================================
+# ヘッジ（待ち時間の上限を決めて、超えたら手元の代替を先に出す）
+# ============================================
+_ITEM = "item"
+_DONE = "done"
+_ERROR = "error"
+
+
+class HedgedIterator(Generic[T]):
+    """
+    遅いかもしれない iterator（OpenAI のストリームなど）を別スレッドで回し、
+    呼び出し側では待ち時間に上限を付けて要素を受け取る。
+
+    - 最初の要素が budget_sec 以内に届かなかったら（あるいはその前に失敗したら）
+      on_budget_exceeded() を1回だけ呼ぶ。呼び出し側はここで代替の結果を表示する。
+    - 開始から deadline_sec を過ぎたら、上流を待つのをやめて反復を終える（timed_out=True）。
+    - 上流で起きた例外は投げずに error に入れて反復を終える。
+    - cancel_event がセットされたら、上流を待つのをやめて反復を終える（cancelled=True）。
+
+    締め切り・キャンセル・呼び出し側が途中でやめた場合は、別スレッドも次の要素で読むのをやめ、
+    上流の iterator を close() する（ジェネレータなら finally でストリームを閉じられる）。
+    打ち切った後も上流を読み続けてトークンを使ったり、ジョブの数を超えて
+    上流への接続が残ったりしないように。
+
+    budget_sec <= 0 ならヘッジしない（on_budget_exceeded は失敗・締め切り時だけ呼ぶ）。
+    """
+
+    # cancel_event を確認する間隔（秒）
+    CANCEL_POLL_SEC = 0.1
+
+    def __init__(
+        self,
+        factory: Callable[[], Iterable[T]],
+        budget_sec: float,
+        deadline_sec: float,
+        on_budget_exceeded: Callable[[], None] = lambda: None,
+        cancel_event: threading.Event | None = None,
+    ):
+        self.budget_sec = budget_sec
+        self.deadline_sec = deadline_sec
+        self._on_budget_exceeded = on_budget_exceeded
+        self._cancel_event = cancel_event
+        self._stop = threading.Event()
+        self._start = time.monotonic()
+        self.hedged = False
+        self.timed_out = False
+        self.cancelled = False
+        self.error: Exception | None = None
+        self._queue: "queue.Queue[tuple]" = queue.Queue()
+        # contextvars（トレースのラベルなど）を別スレッドにも引き継ぐ
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=context.run, args=(self._pump, factory), daemon=True
+        )
+        self._thread.start()
+
+    def _should_stop(self) -> bool:
+        return (
+            self._stop.is_set()
+            or (self._cancel_event is not None and self._cancel_event.is_set())
+            or time.monotonic() - self._start >= self.deadline_sec
+        )
+
+    def _pump(self, factory: Callable[[], Iterable[T]]) -> None:
+        iterator = None
+        try:
+            iterator = iter(factory())
+            for item in iterator:
+                if self._should_stop():
+                    break
+                self._queue.put((_ITEM, item))
+        except Exception as e:
+            self._queue.put((_ERROR, e))
+        else:
+            self._queue.put((_DONE, None))
+        finally:
+            # 打ち切った場合も、上流（ストリームなど）を閉じる
+            _close(iterator)
+
+    def close(self) -> None:
+        """上流の読み込みをやめさせる（別スレッドは次の要素を受け取った時点で終わる）。"""
+        self._stop.set()
+
+    def _hedge(self) -> None:
+        if not self.hedged:
+            self.hedged = True
+            self._on_budget_exceeded()
+
+    def __iter__(self) -> Iterator[T]:
+        try:
+            yield from self._receive()
+        finally:
+            # 締め切り・キャンセル・途中でやめた場合は上流も止める（最後まで届いた後なら何も起きない）
+            self.close()
+
+    def _receive(self) -> Iterator[T]:
+        received = False
+        while True:
+            if self._cancel_event is not None and self._cancel_event.is_set():
+                self.cancelled = True
+                return
+            elapsed = time.monotonic() - self._start
+            if not received and not self.hedged and self.budget_sec > 0:
+                wait = self.budget_sec - elapsed
+                if wait <= 0:
+                    self._hedge()
+                    continue
+            else:
+                wait = self.deadline_sec - elapsed
+                if wait <= 0:
+                    self.timed_out = True
+                    self._hedge()
+                    return
+
+            if self._cancel_event is not None:
+                wait = min(wait, self.CANCEL_POLL_SEC)
+            try:
+                kind, value = self._queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                self.error = value
+                self._hedge()
+                return
+            received = True
+            yield value
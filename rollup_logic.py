@@ -0,0 +1,110 @@
+# rollup_logic.py
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Tuple
+
+# 集計キー（バケットの開始時刻を除く）
+RollupKey = Tuple[str, ...]
+
+
+class CounterRollup:
+    """
+    イベントを1件ずつ書き込む代わりに、(キー, 時間バケット) ごとの件数を
+    プロセス内で数えておき、定期的に flush_fn へまとめて渡す。
+
+    - 件数はバケットごとの累積値で渡すので、flush_fn 側は upsert（上書き）でよい。
+      再送しても同じ値になるため、二重計上は起きない。
+    - プロセスごとに writer_id を持たせ、複数プロセスの行が上書きし合わないようにする
+      （集計時は writer_id をまたいで合計する）。
+    - 送信済みで、かつ現在より前のバケットはメモリから捨てる。
+    """
+
+    def __init__(
+        self,
+        key_fields: List[str],
+        flush_fn: Callable[[List[Dict]], None],
+        bucket_sec: int = 3600,
+        flush_interval_sec: float = 30.0,
+    ):
+        self.key_fields = key_fields
+        self.flush_fn = flush_fn
+        self.bucket_sec = bucket_sec
+        self.flush_interval_sec = flush_interval_sec
+        self.writer_id = secrets.randbits(62)
+
+        self._counts: Dict[Tuple[int, RollupKey], int] = {}
+        self._dirty: set = set()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._stats = {"recorded": 0, "flushes": 0, "flushed_rows": 0, "flush_failures": 0}
+
+    def _bucket_start(self, ts: float) -> int:
+        return int(ts // self.bucket_sec) * self.bucket_sec
+
+    def record(self, *key: str, ts: float | None = None) -> None:
+        """イベントを1件数える（ネットワークには触れない）。"""
+        bucket = self._bucket_start(time.time() if ts is None else ts)
+        item = (bucket, tuple(key))
+        with self._lock:
+            self._counts[item] = self._counts.get(item, 0) + 1
+            self._dirty.add(item)
+            self._stats["recorded"] += 1
+        self._ensure_thread()
+
+    def flush(self) -> int:
+        """変更のあったバケットを flush_fn に渡す。渡した行数を返す。"""
+        with self._lock:
+            dirty = list(self._dirty)
+            rows = [
+                {
+                    "bucket_start": datetime.fromtimestamp(bucket, tz=timezone.utc).isoformat(),
+                    "writer_id": self.writer_id,
+                    **dict(zip(self.key_fields, key)),
+                    "copy_count": self._counts[(bucket, key)],
+                }
+                for bucket, key in dirty
+            ]
+            self._dirty.clear()
+        if not rows:
+            return 0
+
+        try:
+            self.flush_fn(rows)
+        except Exception as e:
+            print("[rollup] flush エラー（次回再送）:", e)
+            with self._lock:
+                self._dirty.update(dirty)
+                self._stats["flush_failures"] += 1
+            return 0
+
+        current = self._bucket_start(time.time())
+        with self._lock:
+            for item in dirty:
+                if item[0] < current and item not in self._dirty:
+                    self._counts.pop(item, None)
+            self._stats["flushes"] += 1
+            self._stats["flushed_rows"] += len(rows)
+        return len(rows)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending_buckets"] = len(self._dirty)
+        return stats
+
+    # ---------- 定期フラッシュ ----------
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="rollup-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval_sec):
+            self.flush()
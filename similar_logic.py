@@ -0,0 +1,309 @@
+# similar_logic.py
+import hashlib
+import heapq
+import os
+import random
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Set, Tuple
+
+from cache_logic import normalize_text
+from id_logic import id_timestamp
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# 類似リクエストの使い方
+#   "draft" : OpenAI の生成を待つ間、過去の生成結果を下書きとして先に表示する
+#   "reuse" : 類似リクエストが見つかったら OpenAI を呼ばずにそのまま使う
+#   "off"   : 使わない
+SIMILAR_MODE = os.getenv("ARKY_SIMILAR_MODE", "draft")
+
+# 類似とみなす Jaccard 類似度のしきい値
+SIMILAR_THRESHOLD = float(os.getenv("ARKY_SIMILAR_THRESHOLD", "0.7"))
+
+# 文字 n-gram の n（日本語の短文は 2-gram が一番安定する）
+SIMILAR_NGRAM = int(os.getenv("ARKY_SIMILAR_NGRAM", "2"))
+
+# インデックスに保持するグループ数の上限（超えたら generatedid の古いものから捨てる）
+# 既定は起動時に読み込む行数（ARKY_SIMILAR_INDEX_LOAD_LIMIT=3000、1グループ3行）に合わせる
+SIMILAR_INDEX_MAX_GROUPS = int(os.getenv("ARKY_SIMILAR_INDEX_MAX_GROUPS", "1000"))
+
+# MinHash の順列数と、LSH の 1 バンドあたりの行数（バンド数 = 順列数 / 行数）
+MINHASH_NUM_PERM = 64
+LSH_ROWS_PER_BAND = 4
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text: str, n: int = SIMILAR_NGRAM) -> FrozenSet[str]:
+    """
+    正規化したテキストから句読点・空白を除き、文字 n-gram の集合を返す。
+    助詞や句読点1つの違いでは集合がほとんど変わらないようにする。
+    """
+    text = normalize_text(text)
+    chars = "".join(
+        ch for ch in text
+        if not ch.isspace() and not unicodedata.category(ch).startswith("P")
+    )
+    if not chars:
+        return frozenset()
+    if len(chars) <= n:
+        return frozenset([chars])
+    return frozenset(chars[i : i + n] for i in range(len(chars) - n + 1))
+
+
+def season_key(seasonal: bool, at: float | None = None) -> str:
+    """
+    時候の挨拶を入れたかどうかの区別。挨拶は月ごとに変わるので（app.py の
+    get_seasonal_greeting）、入れた場合は生成した月も区別する。
+    """
+    if not seasonal:
+        return ""
+    return str(time.localtime(at).tm_mon)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """固定シードの (a*x + b) mod p 族で MinHash 署名を作る。"""
+
+    def __init__(self, num_perm: int = MINHASH_NUM_PERM, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self._params = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, items: FrozenSet[str]) -> Tuple[int, ...]:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+            for s in items
+        ]
+        if not hashes:
+            return tuple([_MAX_HASH] * self.num_perm)
+        return tuple(
+            min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._params
+        )
+
+
+# ============================================
+# 過去の生成グループ
+# ============================================
+@dataclass
+class SimilarMatch:
+    """類似リクエストとして見つかった過去の生成グループ。"""
+
+    generatedid: int
+    similarity: float
+    user_message: str
+    patterns: List[Dict[str, str]] = field(default_factory=list)
+
+    def to_markdown(self) -> str:
+        """generate_email_with_openai と同じ「## パターンN」形式に組み立てる。"""
+        parts = []
+        for idx, p in enumerate(self.patterns, start=1):
+            parts.append(
+                f"## パターン{idx}\n件名: {p.get('subject', '')}\n本文:\n{p.get('body', '')}"
+            )
+        return "\n\n".join(parts)
+
+
+@dataclass
+class _Entry:
+    generatedid: int
+    group_key: Tuple[str, str, str, str]
+    user_message: str
+    shingles: FrozenSet[str]
+    band_keys: List[Tuple[int, ...]]
+    patterns: List[Dict[str, str]]
+
+
+class SimilarRequestIndex:
+    """
+    test_arky_patterns の user_message に対する MinHash/LSH インデックス。
+
+    - 候補は LSH のバンド一致で絞り込み、最終判定は n-gram 集合の Jaccard で行う。
+    - テンプレート・トーン・相手・時候の挨拶の有無（と月）が一致するグループだけを返す。
+    - グループ数が max_groups を超えたら generatedid の古いものから捨てる。
+    - 全セッションから参照されるのでロックで保護する。
+    """
+
+    def __init__(
+        self,
+        threshold: float = SIMILAR_THRESHOLD,
+        num_perm: int = MINHASH_NUM_PERM,
+        rows_per_band: int = LSH_ROWS_PER_BAND,
+        max_groups: int = SIMILAR_INDEX_MAX_GROUPS,
+    ):
+        self.threshold = threshold
+        self.max_groups = max_groups
+        self.rows_per_band = rows_per_band
+        self.num_bands = num_perm // rows_per_band
+        self._hasher = MinHasher(num_perm=num_perm)
+        self._entries: Dict[int, _Entry] = {}
+        self._buckets: List[Dict[Tuple[int, ...], Set[int]]] = [
+            {} for _ in range(self.num_bands)
+        ]
+        # generatedid の最小ヒープ（捨てる順番）
+        self._order: List[int] = []
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, ...]]:
+        r = self.rows_per_band
+        return [signature[i * r : (i + 1) * r] for i in range(self.num_bands)]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_locked(self) -> None:
+        gid = heapq.heappop(self._order)
+        entry = self._entries.pop(gid)
+        for band, key in zip(self._buckets, entry.band_keys):
+            bucket = band.get(key)
+            if bucket is None:
+                continue
+            bucket.discard(gid)
+            if not bucket:
+                del band[key]
+
+    def add(
+        self,
+        generatedid: int,
+        template: str,
+        tone: str,
+        recipient: str,
+        seasonal: bool,
+        user_message: str,
+        patterns: List[Dict[str, str]],
+    ) -> None:
+        """生成グループを1件追加する（同じ generatedid は無視）。"""
+        items = shingles(user_message)
+        if not items:
+            return
+        generatedid = int(generatedid)
+        entry = _Entry(
+            generatedid=generatedid,
+            group_key=(
+                template or "",
+                tone or "",
+                recipient or "",
+                season_key(seasonal, id_timestamp(generatedid)),
+            ),
+            user_message=user_message,
+            shingles=items,
+            band_keys=self._band_keys(self._hasher.signature(items)),
+            patterns=[
+                {"subject": p.get("subject", "") or "", "body": p.get("body", "") or ""}
+                for p in patterns
+            ],
+        )
+        with self._lock:
+            if generatedid in self._entries:
+                return
+            if len(self._entries) >= self.max_groups:
+                # 上限に達していて、手元のどれよりも古いなら入れない
+                if not self._order or generatedid < self._order[0]:
+                    return
+                self._evict_locked()
+            self._entries[generatedid] = entry
+            heapq.heappush(self._order, generatedid)
+            for band, key in zip(self._buckets, entry.band_keys):
+                band.setdefault(key, set()).add(generatedid)
+
+    def find_similar(
+        self,
+        template: str,
+        tone: str,
+        recipient: str,
+        seasonal: bool,
+        user_message: str,
+        threshold: float | None = None,
+    ) -> SimilarMatch | None:
+        """しきい値以上で最も似ている過去の生成グループを返す。無ければ None。"""
+        threshold = self.threshold if threshold is None else threshold
+        items = shingles(user_message)
+        if not items:
+            return None
+        signature = self._hasher.signature(items)
+        group_key = (template or "", tone or "", recipient or "", season_key(seasonal))
+
+        with self._lock:
+            candidates: Set[int] = set()
+            for band, key in zip(self._buckets, self._band_keys(signature)):
+                candidates |= band.get(key, set())
+
+            best: _Entry | None = None
+            best_score = 0.0
+            for gid in candidates:
+                entry = self._entries[gid]
+                if entry.group_key != group_key:
+                    continue
+                score = jaccard(items, entry.shingles)
+                # 同点なら新しいグループ（generatedid が大きい方）を優先
+                if score > best_score or (
+                    best is not None and score == best_score and gid > best.generatedid
+                ):
+                    best, best_score = entry, score
+
+        if best is None or best_score < threshold:
+            return None
+        return SimilarMatch(
+            generatedid=best.generatedid,
+            similarity=best_score,
+            user_message=best.user_message,
+            patterns=[dict(p) for p in best.patterns],
+        )
+
+    def load_rows(self, rows: List[Dict]) -> int:
+        """
+        test_arky_patterns の行（1パターン1行）をグループにまとめて追加する。
+        追加したグループ数を返す。
+        """
+        groups: Dict[int, Dict] = {}
+        for row in rows:
+            gid = row.get("generatedid")
+            if gid is None:
+                continue
+            g = groups.setdefault(
+                int(gid),
+                {
+                    "template": row.get("template") or "",
+                    "tone": row.get("tone") or "",
+                    "recipient": row.get("recipient") or "",
+                    "seasonal": bool(row.get("seasonal_greeting")),
+                    "user_message": row.get("user_message") or "",
+                    "patterns": {},
+                },
+            )
+            g["patterns"][int(row.get("pattern_index") or 0)] = {
+                "subject": row.get("subject") or "",
+                "body": row.get("body") or "",
+            }
+
+        for gid, g in groups.items():
+            self.add(
+                gid,
+                g["template"],
+                g["tone"],
+                g["recipient"],
+                g["seasonal"],
+                g["user_message"],
+                [g["patterns"][i] for i in sorted(g["patterns"])],
+            )
+        self.loaded = True
+        return len(groups)
+
+
+# アプリ全体（全セッション）で共有するインデックス
+similar_index = SimilarRequestIndex()
@@ -0,0 +1,458 @@
+# static_assets.py
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List
+
+try:
+    from PIL import Image
+    from PIL import features as pil_features
+except ImportError:  # Pillow が無い環境では元の PNG をそのまま配信する
+    Image = None
+    pil_features = None
+
+# ============================================
+# 静的アセット（CSS / JS / 画像）の配信
+# ============================================
+# assets/ にある元ファイルを起動時に1回だけ縮小し、内容ハッシュ付きの名前で
+# static/ に書き出す（.streamlit/config.toml の enableStaticServing で配信される）。
+# 画像はリポジトリ直下の PNG を AVIF / WebP と縮小版に変換して同じく static/ に置く。
+# ページには数百バイトの読み込みスクリプトをセッションごとに1回だけ送る。
+BASE_DIR = Path(__file__).resolve().parent
+ASSETS_DIR = BASE_DIR / "assets"
+STATIC_DIR = BASE_DIR / "static"
+
+# 環境変数 ARKY_INLINE_ASSETS=1 で従来どおり毎回 <style> / <script> を埋め込む
+INLINE_ASSETS = os.getenv("ARKY_INLINE_ASSETS", "0") == "1"
+
+# 配信するアセット（名前 → assets/ 内のファイル名）
+ASSET_SOURCES = {
+    "css": "arky.css",
+    "buttons_js": "arky_buttons.js",
+    "identity_js": "arky_identity.js",
+}
+
+# 配信する画像（名前 → (リポジトリ直下の PNG, 作る幅 px)）
+# 元の幅以上の指定は元の幅で作る。アバターは 130px 表示の 1x / 2x / 3x
+IMAGE_SOURCES = {
+    "background": ("ARKYappbackgroundimage.png", (640, 1280)),
+    "avatar": ("AIhontai.png", (130, 260, 390)),
+}
+# 背景画像は .stApp::before の left: 450px から右端までに表示される（arky.css）
+BACKGROUND_OFFSET_PX = 450
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+# 起動時に変換するので速度寄り（既定の 6 に比べ約3倍速く、サイズは数 % 増える）
+AVIF_SPEED = 8
+
+# 優先順（先頭ほど小さい）。png は常に元ファイルを置くフォールバック
+_IMAGE_MIME = {"avif": "image/avif", "webp": "image/webp", "png": "image/png"}
+
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+_CSS_SPACE_RE = re.compile(r"\s+")
+_CSS_PUNCT_RE = re.compile(r"\s*([{};,>])\s*")
+
+
+def minify_css(text: str) -> str:
+    """コメントと余分な空白を取り除く（セレクタの意味が変わる : の前後は触らない）。"""
+    text = _CSS_COMMENT_RE.sub("", text)
+    text = _CSS_SPACE_RE.sub(" ", text)
+    text = _CSS_PUNCT_RE.sub(r"\1", text)
+    return text.replace(";}", "}").strip()
+
+
+def minify_js(text: str) -> str:
+    """
+    行頭の // コメント・空行・インデントを取り除く。
+    改行は残すので、セミコロン自動挿入の挙動は変わらない。
+    """
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("//"):
+            continue
+        lines.append(stripped)
+    return "\n".join(lines)
+
+
+_MINIFIERS = {".css": minify_css, ".js": minify_js}
+
+
+@dataclass
+class BuiltAsset:
+    """縮小・ハッシュ付けした静的ファイル。"""
+
+    name: str
+    filename: str
+    content: str
+    digest: str
+
+    @property
+    def size(self) -> int:
+        return len(self.content.encode("utf-8"))
+
+
+@dataclass
+class ImageVariant:
+    """1つの形式・幅の画像ファイル。"""
+
+    fmt: str
+    width: int
+    filename: str
+    size: int
+
+
+@dataclass
+class BuiltImage:
+    """変換済みの画像（形式ごと・幅ごとの variants を持つ）。"""
+
+    name: str
+    width: int
+    height: int
+    variants: List[ImageVariant] = field(default_factory=list)
+
+    @property
+    def formats(self) -> List[str]:
+        """作られた形式（_IMAGE_MIME の優先順）。"""
+        present = {v.fmt for v in self.variants}
+        return [fmt for fmt in _IMAGE_MIME if fmt in present]
+
+    @property
+    def widths(self) -> List[int]:
+        return sorted({v.width for v in self.variants})
+
+    def pick(self, fmt: str, width: int) -> ImageVariant:
+        """fmt の variant のうち、width 以上で最小のもの（無ければ最大のもの）。"""
+        candidates = sorted((v for v in self.variants if v.fmt == fmt), key=lambda v: v.width)
+        for v in candidates:
+            if v.width >= width:
+                return v
+        return candidates[-1]
+
+    def srcset(self, fmt: str, base_url_path: str = "") -> str:
+        return ", ".join(
+            f"{static_url(v.filename, base_url_path)} {v.width}w"
+            for v in sorted(self.variants, key=lambda v: v.width)
+            if v.fmt == fmt
+        )
+
+
+def _png_size(path: Path) -> tuple[int, int]:
+    """PNG の IHDR から (幅, 高さ) を読む（Pillow が無くても使える）。"""
+    with path.open("rb") as f:
+        header = f.read(24)
+    return struct.unpack(">II", header[16:24])
+
+
+def _image_encoders() -> Dict[str, dict]:
+    """この環境の Pillow で書き出せる形式と保存オプション。"""
+    if Image is None:
+        return {}
+    encoders = {}
+    if pil_features.check("avif"):
+        encoders["avif"] = {"quality": AVIF_QUALITY, "speed": AVIF_SPEED}
+    if pil_features.check("webp"):
+        encoders["webp"] = {"quality": WEBP_QUALITY}
+    return encoders
+
+
+def _build_image(name: str, source: str, widths: tuple) -> BuiltImage:
+    src_path = BASE_DIR / source
+    data = src_path.read_bytes()
+    encoders = _image_encoders()
+    settings = f"{widths}|{sorted(encoders.items())}"
+    digest = hashlib.sha256(data + settings.encode("utf-8")).hexdigest()[:12]
+    stem = src_path.stem
+
+    width, height = _png_size(src_path)
+    targets = sorted({min(w, width) for w in widths})
+    built = BuiltImage(name=name, width=width, height=height)
+    keep = set()
+
+    def add(fmt: str, w: int, filename: str) -> None:
+        keep.add(filename)
+        built.variants.append(
+            ImageVariant(fmt=fmt, width=w, filename=filename, size=(STATIC_DIR / filename).stat().st_size)
+        )
+
+    # フォールバック用に元の PNG をそのまま置く
+    png_name = f"{stem}.{digest}.{width}w.png"
+    if not (STATIC_DIR / png_name).exists():
+        shutil.copyfile(src_path, STATIC_DIR / png_name)
+    add("png", width, png_name)
+
+    if encoders:
+        with Image.open(src_path) as original:
+            original.load()
+            for w in targets:
+                pending = {
+                    fmt: f"{stem}.{digest}.{w}w.{fmt}"
+                    for fmt in encoders
+                    if not (STATIC_DIR / f"{stem}.{digest}.{w}w.{fmt}").exists()
+                }
+                if pending:
+                    h = max(1, round(height * w / width))
+                    img = original if w == width else original.resize((w, h), Image.Resampling.LANCZOS)
+                    for fmt, filename in pending.items():
+                        img.save(STATIC_DIR / filename, format=fmt.upper(), **encoders[fmt])
+                for fmt in encoders:
+                    add(fmt, w, f"{stem}.{digest}.{w}w.{fmt}")
+
+    for old in STATIC_DIR.glob(f"{stem}.*"):
+        if old.name not in keep:
+            old.unlink(missing_ok=True)
+    return built
+
+
+_images: Dict[str, BuiltImage] | None = None
+_images_lock = threading.Lock()
+
+
+def build_images() -> Dict[str, BuiltImage]:
+    """
+    リポジトリ直下の PNG を AVIF / WebP と縮小版に変換して static/ に書き出す。
+    ファイル名に元画像と設定のハッシュを含めるので、2回目以降の起動では変換しない。
+    Pillow が無い（または AVIF / WebP 非対応の）環境では、元の PNG だけを配信する。
+    """
+    global _images
+    with _images_lock:
+        if _images is None:
+            STATIC_DIR.mkdir(exist_ok=True)
+            _images = {
+                name: _build_image(name, source, widths)
+                for name, (source, widths) in IMAGE_SOURCES.items()
+            }
+        return _images
+
+
+def _image_set(image: BuiltImage, width: int, base_url_path: str) -> str:
+    return ", ".join(
+        f'url("{static_url(image.pick(fmt, width).filename, base_url_path)}") type("{_IMAGE_MIME[fmt]}")'
+        for fmt in image.formats
+    )
+
+
+def _background_media(image: BuiltImage) -> List[tuple[str, int]]:
+    """
+    背景画像の (メディアクエリ, 使う幅) の一覧。範囲は重ならない。
+    表示幅（画面幅 - BACKGROUND_OFFSET_PX）に収まる最小の幅を選ぶ。
+    """
+    widths = image.widths
+    rules = []
+    lower = 0
+    for w in widths:
+        conds = []
+        if lower:
+            conds.append(f"(min-width: {lower + 1}px)")
+        if w != widths[-1]:
+            conds.append(f"(max-width: {w + BACKGROUND_OFFSET_PX}px)")
+        rules.append((" and ".join(conds) or "all", w))
+        lower = w + BACKGROUND_OFFSET_PX
+    return rules
+
+
+def background_css(image: BuiltImage, base_url_path: str = "") -> str:
+    """arky.css の末尾に足す背景画像のルール（image-set で AVIF → WebP → PNG）。"""
+    fallback = static_url(image.pick("png", image.width).filename, base_url_path)
+    rules = []
+    for media, w in _background_media(image):
+        rule = f".stApp::before{{background-image:image-set({_image_set(image, w, base_url_path)})}}"
+        rules.append(f"@media {media}{{{rule}}}" if media != "all" else rule)
+    return f'.stApp::before{{background-image:url("{fallback}")}}' + "".join(rules)
+
+
+def picture_html(name: str, alt: str = "", sizes: str = "100vw", base_url_path: str = "") -> str:
+    """<picture> で AVIF / WebP を出し分ける <img> の HTML（アバター用）。"""
+    image = build_images()[name]
+    sources = "".join(
+        f'<source type="{_IMAGE_MIME[fmt]}" srcset="{image.srcset(fmt, base_url_path)}" sizes="{sizes}">'
+        for fmt in image.formats
+        if fmt != "png"
+    )
+    fallback = image.pick("png", image.width)
+    return (
+        f"<picture>{sources}"
+        f'<img src="{static_url(fallback.filename, base_url_path)}" alt="{alt}" '
+        f'width="{image.width}" height="{image.height}" decoding="async">'
+        "</picture>"
+    )
+
+
+_built: Dict[str, BuiltAsset] | None = None
+_build_lock = threading.Lock()
+
+
+def build_assets(base_url_path: str = "") -> Dict[str, BuiltAsset]:
+    """
+    assets/ の元ファイルを縮小し、static/<名前>.<ハッシュ>.min.<拡張子> に書き出す。
+    CSS の末尾には build_images() で作った背景画像のルールを足す。
+    プロセスで1回だけ実行し、古いハッシュのファイルは削除する。
+    """
+    global _built
+    with _build_lock:
+        if _built is not None:
+            return _built
+
+        images = build_images()
+        built: Dict[str, BuiltAsset] = {}
+        for name, source in ASSET_SOURCES.items():
+            src_path = ASSETS_DIR / source
+            content = _MINIFIERS[src_path.suffix](src_path.read_text(encoding="utf-8"))
+            if name == "css":
+                content += background_css(images["background"], base_url_path)
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+            filename = f"{src_path.stem}.{digest}.min{src_path.suffix}"
+
+            out_path = STATIC_DIR / filename
+            if not out_path.exists():
+                out_path.write_text(content, encoding="utf-8")
+            for old in STATIC_DIR.glob(f"{src_path.stem}.*.min{src_path.suffix}"):
+                if old.name != filename:
+                    old.unlink(missing_ok=True)
+
+            built[name] = BuiltAsset(name=name, filename=filename, content=content, digest=digest)
+
+        _built = built
+        return _built
+
+
+def static_url(filename: str, base_url_path: str = "") -> str:
+    """Streamlit の静的配信（/app/static/）上の絶対パスを返す。"""
+    base = base_url_path.strip("/")
+    prefix = f"/{base}" if base else ""
+    return f"{prefix}/app/static/{filename}"
+
+
+def preload_links(base_url_path: str = "") -> List[dict]:
+    """
+    背景画像の <link rel="preload"> 属性（CSS の取得を待たずに画像を取りに行く）。
+    CSS と同じメディアクエリ・同じ形式（最優先のもの）を指定して二重取得を避ける。
+    """
+    image = build_images()["background"]
+    fmt = image.formats[0]
+    return [
+        {
+            "href": static_url(image.pick(fmt, w).filename, base_url_path),
+            "type": _IMAGE_MIME[fmt],
+            "media": media,
+        }
+        for media, w in _background_media(image)
+    ]
+
+
+def _preload_js(base_url_path: str) -> str:
+    return f"""  {json.dumps(preload_links(base_url_path))}.forEach(function(p) {{
+    if (d.querySelector('link[rel="preload"][href="' + p.href + '"]')) return;
+    const l = d.createElement("link");
+    l.rel = "preload"; l.as = "image"; l.href = p.href; l.type = p.type; l.media = p.media;
+    d.head.prepend(l);
+  }});
+"""
+
+
+def _user_cookie_js(user_cookie: str | None) -> str:
+    """arky_identity.js に、サーバ側で決めたクッキーの値を渡す（無ければ何もしない）。"""
+    if not user_cookie:
+        return ""
+    return f"  parent.__arkyUserId = {json.dumps(user_cookie)};\n"
+
+
+def loader_html(
+    assets: Dict[str, BuiltAsset], base_url_path: str = "", user_cookie: str | None = None
+) -> str:
+    """
+    ページ本体（iframe の外）に CSS / JS を1回だけ読み込む小さなスクリプト。
+    背景画像の preload を先に差し込み、CSS の取得と並行して画像を取りに行かせる。
+
+    Streamlit の静的配信は .css / .js を text/plain で返すため <link> / <script src>
+    では読めない。fetch で取得して <style> / <script> の中身として差し込む。
+    URL は内容ハッシュ付きなので、cache: "force-cache" でブラウザのキャッシュを使い回す。
+    同じハッシュの要素が既にあれば何もしない。
+    user_cookie を渡すと、arky_identity.js がその値をクッキーに付ける。
+    """
+    css = assets["css"]
+    js = assets["buttons_js"]
+    identity = assets["identity_js"]
+    return f"""<script>
+(function() {{
+  const d = parent.document;
+{_preload_js(base_url_path)}{_user_cookie_js(user_cookie)}  function load(id, url, tag, target) {{
+    if (d.getElementById(id)) return;
+    fetch(url, {{ cache: "force-cache" }})
+      .then(function(r) {{ if (!r.ok) throw new Error(r.status); return r.text(); }})
+      .then(function(text) {{
+        if (d.getElementById(id)) return;
+        const el = d.createElement(tag);
+        el.id = id;
+        el.textContent = text;
+        target.appendChild(el);
+      }})
+      .catch(function(e) {{ console.warn("ARKY asset load failed:", url, e); }});
+  }}
+  load("arky-css-{css.digest}", "{static_url(css.filename, base_url_path)}", "style", d.head);
+  load("arky-js-{js.digest}", "{static_url(js.filename, base_url_path)}", "script", d.body);
+  load("arky-id-{identity.digest}", "{static_url(identity.filename, base_url_path)}", "script", d.body);
+}})();
+</script>"""
+
+
+def inline_html(
+    assets: Dict[str, BuiltAsset], base_url_path: str = "", user_cookie: str | None = None
+) -> tuple[str, str]:
+    """ARKY_INLINE_ASSETS=1 のとき用：(<style> の Markdown, iframe に入れる <script>)。"""
+    css = f"<style>\n{assets['css'].content}\n</style>"
+    scripts = ", ".join(
+        json.dumps(assets[name].content, ensure_ascii=False) for name in ("buttons_js", "identity_js")
+    )
+    js = (
+        "<script>\n(function() {\n"
+        "  const d = parent.document;\n"
+        f"{_preload_js(base_url_path)}"
+        f"{_user_cookie_js(user_cookie)}"
+        f"  [{scripts}].forEach(function(text) {{\n"
+        "    const s = d.createElement('script');\n"
+        "    s.textContent = text;\n"
+        "    d.body.appendChild(s);\n"
+        "  });\n"
+        "})();\n</script>"
+    )
+    return css, js
+
+
+def inject_assets(user_cookie: str | None = None) -> None:
+    """
+    app.py から毎回呼ぶ。
+    通常はセッションの最初の1回だけ読み込みスクリプトを送り、以降の再実行では何も送らない
+    （差し込んだ <style> / <script> は親ページに残る）。
+    user_cookie はブラウザにまだ識別用のクッキーが無いときに、付けてもらう値。
+    """
+    import streamlit as st
+
+    base_url_path = st.get_option("server.baseUrlPath") or ""
+    assets = build_assets(base_url_path)
+
+    if INLINE_ASSETS:
+        css, js = inline_html(assets, base_url_path, user_cookie)
+        st.markdown(css, unsafe_allow_html=True)
+        st.components.v1.html(js, height=0)
+        return
+
+    if st.session_state.get("assets_injected"):
+        return
+    st.components.v1.html(loader_html(assets, base_url_path, user_cookie), height=0)
+    st.session_state.assets_injected = True
+
+
+if __name__ == "__main__":
+    # デプロイ時に事前に変換しておく場合: python static_assets.py
+    for image in build_images().values():
+        for v in image.variants:
+            print(f"{v.filename:<52}{v.size:>10}")
+    for asset in build_assets().values():
+        print(f"{asset.filename:<52}{asset.size:>10}")
@@ -0,0 +1,209 @@
+# template_registry.py
+import json
+import math
+import os
+import string
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# ============================================
+# ローカル下書き（generate_email）用テンプレート
+# ============================================
+# 件名・挨拶・本文・結び・アドバイスは templates/email_templates.json に書き、
+# 起動時に1回だけ読み込んで (template, recipient, variation) をキーにした索引へ展開する。
+# テンプレートや相手を増やすときは JSON に追記するだけでよい（サイドバーの選択肢にも出る）。
+TEMPLATES_PATH = Path(
+    os.getenv(
+        "ARKY_EMAIL_TEMPLATES",
+        str(Path(__file__).resolve().parent / "templates" / "email_templates.json"),
+    )
+)
+
+# 各項目で使えるプレースホルダ（{message:.20} のように書式指定で文字数を切れる）
+_SUBJECT_FIELDS = {"message", "template", "recipient"}
+_BODY_FIELDS = {"greeting", "message", "template", "recipient"}
+
+_formatter = string.Formatter()
+
+
+class TemplateError(ValueError):
+    """テンプレートファイルの書式エラー。"""
+
+
+@dataclass(frozen=True)
+class CompiledDraft:
+    """1つの (template, recipient, variation) の組に対する展開済みの下書き。"""
+
+    subject: str
+    greeting: str
+    # 本文の書き出し＋結び。{greeting} / {message} などを埋めるだけで本文になる
+    body: str
+    advice: str
+
+
+def _check_fields(text: str, allowed: set, where: str) -> str:
+    try:
+        fields = {name for _, name, _, _ in _formatter.parse(text) if name is not None}
+    except ValueError as e:
+        raise TemplateError(f"{where}: {e}") from e
+    unknown = fields - allowed
+    if unknown:
+        raise TemplateError(
+            f"{where}: 使えないプレースホルダ {sorted(unknown)}（使えるもの: {sorted(allowed)}）"
+        )
+    return text
+
+
+def _literal(text: str) -> str:
+    """書式文字列の中にそのまま埋め込めるように { } をエスケープする。"""
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def _string_list(value, where: str) -> List[str]:
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not value or not all(isinstance(v, str) for v in value):
+        raise TemplateError(f"{where}: 文字列（または文字列のリスト）が必要です")
+    return value
+
+
+class TemplateRegistry:
+    """
+    templates/email_templates.json を展開した索引。
+
+    テンプレート・相手がファイルに無いとき（「その他」で自由入力されたときなど）は
+    fallback の値を使う。索引には template / recipient を None にした組も入れておくので、
+    render() は辞書を1回引いて format するだけになる。
+    """
+
+    def __init__(self, data: dict, source: str = "<dict>"):
+        self.source = source
+        fallback = data.get("fallback") or {}
+        templates: Dict[str, dict] = data.get("templates") or {}
+        recipients: Dict[str, dict] = data.get("recipients") or {}
+
+        raw_bodies = data.get("bodies")
+        if not isinstance(raw_bodies, list) or not raw_bodies:
+            raise TemplateError(f"{source}: bodies が必要です")
+        bodies = []
+        for i, body in enumerate(raw_bodies):
+            where = f"{source}: bodies[{i}]"
+            # 本文は1つの文字列でも、行のリストでも書ける
+            text = "\n".join(_string_list(body, where)) if isinstance(body, list) else body
+            if not isinstance(text, str):
+                raise TemplateError(f"{where}: 文字列（または行のリスト）が必要です")
+            bodies.append(_check_fields(text, _BODY_FIELDS, where))
+
+        def template_entry(name: str | None) -> Tuple[List[str], str]:
+            spec = templates.get(name) or {} if name is not None else {}
+            where = f"{source}: templates.{name or 'fallback'}"
+            subjects = _string_list(spec.get("subjects") or fallback.get("subjects"), where)
+            subjects = [_check_fields(s, _SUBJECT_FIELDS, where) for s in subjects]
+            advice = spec.get("advice") or fallback.get("advice") or ""
+            return subjects, advice
+
+        def recipient_entry(name: str | None) -> Tuple[List[str], List[str]]:
+            spec = recipients.get(name) or {} if name is not None else {}
+            where = f"{source}: recipients.{name or 'fallback'}"
+            greetings = _string_list(spec.get("greetings") or fallback.get("greetings"), where)
+            closings = _string_list(spec.get("closings") or fallback.get("closings"), where)
+            return greetings, closings
+
+        self.template_labels: Dict[str, str] = {
+            name: spec.get("label") or name for name, spec in templates.items()
+        }
+        self.recipient_labels: Dict[str, str] = {
+            name: spec.get("label") or name for name, spec in recipients.items()
+        }
+
+        # (template, recipient) -> 周期（各リストの長さの最小公倍数）
+        self._periods: Dict[Tuple[str | None, str | None], int] = {}
+        self._index: Dict[Tuple[str | None, str | None, int], CompiledDraft] = {}
+        for t_name in [*templates, None]:
+            subjects, advice = template_entry(t_name)
+            for r_name in [*recipients, None]:
+                greetings, closings = recipient_entry(r_name)
+                period = math.lcm(len(subjects), len(greetings), len(bodies), len(closings))
+                self._periods[(t_name, r_name)] = period
+                for v in range(period):
+                    self._index[(t_name, r_name, v)] = CompiledDraft(
+                        subject=subjects[v % len(subjects)],
+                        greeting=greetings[v % len(greetings)],
+                        body=bodies[v % len(bodies)] + _literal(closings[v % len(closings)]),
+                        advice=advice,
+                    )
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def lookup(self, template: str, recipient: str, variation: int = 0) -> CompiledDraft:
+        t_key = template if template in self.template_labels else None
+        r_key = recipient if recipient in self.recipient_labels else None
+        period = self._periods[(t_key, r_key)]
+        return self._index[(t_key, r_key, variation % period)]
+
+    def render(
+        self,
+        template: str,
+        recipient: str,
+        message: str,
+        variation: int = 0,
+        seasonal_text: str | None = None,
+    ) -> dict:
+        """generate_email と同じ形の dict（subject / body / advice / variation）を返す。"""
+        draft = self.lookup(template, recipient, variation)
+        greeting = f"{seasonal_text}、{draft.greeting}" if seasonal_text else draft.greeting
+        fields = {
+            "message": message,
+            "template": template,
+            "recipient": recipient,
+            "greeting": greeting,
+        }
+        return {
+            "subject": draft.subject.format_map(fields),
+            "body": draft.body.format_map(fields),
+            "advice": draft.advice,
+            "variation": variation,
+        }
+
+
+def load_registry(path: Path = TEMPLATES_PATH) -> TemplateRegistry:
+    """テンプレートファイルを読み込んで索引を作る（書式エラーは TemplateError）。"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except json.JSONDecodeError as e:
+        raise TemplateError(f"{path}: JSON として読めません: {e}") from e
+    return TemplateRegistry(data, source=str(path))
+
+
+_registry: TemplateRegistry | None = None
+_registry_mtime: float | None = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> TemplateRegistry:
+    """
+    プロセス共通の索引。ファイルが更新されていたら読み直す（再起動不要）。
+    読み直しに失敗したときは、エラーを表示して前回の索引を使い続ける。
+    """
+    global _registry, _registry_mtime
+    try:
+        mtime = TEMPLATES_PATH.stat().st_mtime
+    except OSError:
+        mtime = None
+    if _registry is not None and mtime == _registry_mtime:
+        return _registry
+
+    with _registry_lock:
+        if _registry is None or mtime != _registry_mtime:
+            try:
+                _registry = load_registry(TEMPLATES_PATH)
+            except (OSError, TemplateError) as e:
+                if _registry is None:
+                    raise
+                print(f"[template_registry] テンプレートの再読み込みに失敗しました: {e}")
+            _registry_mtime = mtime
+        return _registry
@@ -0,0 +1,9 @@
+# tests/conftest.py
+# リポジトリのルート（*_logic.py など）と bench/（比較用の旧実装）を import できるようにする
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+for path in (ROOT, ROOT / "bench"):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
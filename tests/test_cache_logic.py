@@ -0,0 +1,30 @@
+# tests/test_cache_logic.py
+from cache_logic import ResponseCache
+
+
+def test_l2_keeps_at_most_max_entries(tmp_path, monkeypatch):
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr("cache_logic.time.time", lambda: float(next(clock)))
+    cache = ResponseCache(max_entries=1, db_path=str(tmp_path / "cache.sqlite3"), l2_max_entries=3)
+
+    for i in range(5):
+        cache.put(f"k{i}", f"v{i}")
+
+    stats = cache.stats()
+    assert stats["l2_size"] == 3
+    assert stats["l2_evictions"] == 2
+    # 古いものから消える（L1 には最後の1件しか無いので L2 から引く）
+    assert cache.get("k0") is None
+    assert cache.get("k2") == "v2"
+
+
+def test_l2_prunes_expired_rows_on_put(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("cache_logic.time.time", lambda: now[0])
+    cache = ResponseCache(db_path=str(tmp_path / "cache.sqlite3"), l2_ttl_sec=60)
+
+    cache.put("old", "v")
+    now[0] += 120
+    cache.put("new", "v")
+
+    assert cache.stats()["l2_size"] == 1
@@ -0,0 +1,84 @@
+# tests/test_db_logic.py
+import pytest
+from postgrest.exceptions import APIError
+
+import db_logic
+
+
+class FakeTable:
+    """test_arky_patterns の代わり。(generatedid, pattern_index) の一意制約だけ再現する。"""
+
+    def __init__(self):
+        self.rows = {}
+        self._op = None
+
+    def table(self, name):
+        return self
+
+    def insert(self, rows):
+        self._op = ("insert", rows)
+        return self
+
+    def select(self, columns):
+        self._op = ("select", None)
+        return self
+
+    def in_(self, column, values):
+        self._op = ("select", set(values))
+        return self
+
+    def execute(self):
+        op, arg = self._op
+        if op == "select":
+            return type("Res", (), {"data": [r for r in self.rows.values() if r["generatedid"] in arg]})
+        keys = [(r["generatedid"], r["pattern_index"]) for r in arg]
+        if any(key in self.rows for key in keys):
+            raise APIError({"code": "23505", "message": "duplicate key value"})
+        self.rows.update({key: dict(r) for key, r in zip(keys, arg)})
+        return type("Res", (), {"data": arg})
+
+
+def _batch(generatedid, message):
+    return {
+        "rows": [
+            {
+                "generatedid": generatedid,
+                "pattern_index": idx,
+                "template": "依頼",
+                "tone": "標準ビジネス",
+                "recipient": "社内",
+                "seasonal_greeting": False,
+                "user_message": message,
+                "subject": f"件名{idx}",
+                "body": f"本文{idx}",
+            }
+            for idx in (1, 2, 3)
+        ]
+    }
+
+
+@pytest.fixture
+def db(monkeypatch):
+    table = FakeTable()
+    monkeypatch.setattr(db_logic, "supabase", table)
+    return table
+
+
+def test_flush_replay_inserts_only_missing_groups(db):
+    db_logic._flush_email_batches("t", [_batch(1, "会議室の予約")])
+
+    # 1件目は前回書き込めていた（応答だけ失われた）送り直し
+    db_logic._flush_email_batches("t", [_batch(1, "会議室の予約"), _batch(2, "日程の調整")])
+
+    assert sorted(db.rows) == [(1, 1), (1, 2), (1, 3), (2, 1), (2, 2), (2, 3)]
+
+
+def test_flush_rejects_generatedid_collision(db):
+    db_logic._flush_email_batches("t", [_batch(1, "会議室の予約")])
+
+    with pytest.raises(db_logic.GeneratedIdCollisionError):
+        db_logic._flush_email_batches("t", [_batch(1, "別の依頼")])
+
+    assert db.rows[(1, 1)]["user_message"] == "会議室の予約"
+    # write-behind では送り直さずに dead_letter に移す
+    assert db_logic._is_permanent_db_error(db_logic.GeneratedIdCollisionError("x"))
@@ -0,0 +1,108 @@
+# tests/test_jobs_logic.py
+import threading
+import time
+
+from jobs_logic import DONE, PRIORITY_HIGH, PRIORITY_NORMAL, JobQueue
+from quota_logic import MIN_WEIGHT, QuotaTracker
+
+
+def _run_in_order(queue: JobQueue, submissions, sleep_between=0.0) -> list:
+    """
+    ワーカーを1つ塞いでから submissions（(名前, user, priority) のリスト）を並べ、
+    塞ぎを外したあとに実行された順の名前を返す。
+    """
+    gate = threading.Event()
+    order = []
+    queue.submit(lambda job: gate.wait(5), user="gate")
+    time.sleep(0.05)
+
+    jobs = []
+    for name, user, priority in submissions:
+        jobs.append(
+            queue.submit(lambda job, name=name: order.append(name), user=user, priority=priority)
+        )
+        time.sleep(sleep_between)
+    gate.set()
+
+    deadline = time.time() + 5
+    while not all(job.finished for job in jobs) and time.time() < deadline:
+        time.sleep(0.01)
+    assert all(job.status == DONE for job in jobs)
+    return order
+
+
+def test_light_user_is_not_queued_behind_heavy_user():
+    queue = JobQueue(max_workers=1, weight_fn=lambda user: 1.0)
+    submissions = [(f"heavy{i}", "heavy", PRIORITY_NORMAL) for i in range(5)]
+    submissions.append(("light", "light", PRIORITY_NORMAL))
+
+    order = _run_in_order(queue, submissions)
+    assert order.index("light") <= 1
+    # 同じユーザーのジョブは submit 順
+    assert [name for name in order if name.startswith("heavy")] == [f"heavy{i}" for i in range(5)]
+
+
+def test_weights_share_turns_between_users():
+    weights = {"a": 1.0, "b": 0.25}
+    queue = JobQueue(max_workers=1, weight_fn=lambda user: weights.get(user, 1.0))
+    submissions = []
+    for i in range(10):
+        submissions += [(f"a{i}", "a", PRIORITY_NORMAL), (f"b{i}", "b", PRIORITY_NORMAL)]
+
+    order = _run_in_order(queue, submissions)
+    first = order[:10]
+    # 重み 1 : 0.25 なので、最初の10件は a が8件・b が2件
+    assert sum(name.startswith("a") for name in first) == 8
+
+
+def test_high_priority_runs_first():
+    queue = JobQueue(max_workers=1, aging_sec=60, weight_fn=lambda user: 1.0)
+    order = _run_in_order(
+        queue,
+        [
+            ("refine1", "u1", PRIORITY_NORMAL),
+            ("refine2", "u2", PRIORITY_NORMAL),
+            ("first", "u3", PRIORITY_HIGH),
+        ],
+    )
+    assert order[0] == "first"
+
+
+def test_aged_normal_job_is_not_starved():
+    queue = JobQueue(max_workers=1, aging_sec=0.1, weight_fn=lambda user: 1.0)
+    order = _run_in_order(
+        queue,
+        [("refine", "u1", PRIORITY_NORMAL), ("first", "u2", PRIORITY_HIGH)],
+        sleep_between=0.15,
+    )
+    # refine は aging_sec 以上待ったので高優先度と同じ扱いになり、先に並んだ順で実行される
+    assert order == ["refine", "first"]
+
+
+def test_over_quota_user_gets_min_weight():
+    tracker = QuotaTracker(quota_tokens=1000, window_sec=3600, path="")
+    tracker.record("heavy", 5000)
+    queue = JobQueue(max_workers=1, weight_fn=tracker.weight)
+    submissions = []
+    for i in range(6):
+        submissions += [(f"heavy{i}", "heavy", PRIORITY_NORMAL), (f"light{i}", "light", PRIORITY_NORMAL)]
+
+    order = _run_in_order(queue, submissions)
+    assert tracker.weight("heavy") == MIN_WEIGHT
+    # 上限を使い切ったユーザーは、ほかのユーザーが待っている間はほとんど順番が回ってこない
+    assert all(name.startswith("light") for name in order[:5])
+
+
+def test_cancel_removes_queued_job():
+    queue = JobQueue(max_workers=1, weight_fn=lambda user: 1.0)
+    gate = threading.Event()
+    queue.submit(lambda job: gate.wait(5), user="gate")
+    time.sleep(0.05)
+    ran = []
+    job = queue.submit(lambda job: ran.append(1), user="u1")
+
+    assert queue.cancel(job.id)
+    assert queue.stats()["queued"] == 0
+    gate.set()
+    time.sleep(0.05)
+    assert ran == [] and job.finished
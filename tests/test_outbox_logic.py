@@ -0,0 +1,101 @@
+# tests/test_outbox_logic.py
+from outbox_logic import WriteBehindQueue
+
+
+class Outage(Exception):
+    pass
+
+
+class Constraint(Exception):
+    pass
+
+
+class FakeDB:
+    """handler の代わり。down の間は Outage、bad な行を含むバッチは Constraint で失敗する。"""
+
+    def __init__(self):
+        self.down = False
+        self.batches = []
+
+    def __call__(self, table_name, payloads):
+        if self.down:
+            raise Outage("connection refused")
+        if any(p.get("bad") for p in payloads):
+            raise Constraint("duplicate key value violates unique constraint")
+        self.batches.append([p["i"] for p in payloads])
+
+
+def _queue(tmp_path, db, batch_size=10):
+    queue = WriteBehindQueue(
+        str(tmp_path / "outbox.sqlite3"),
+        {"k": db},
+        batch_size=batch_size,
+        is_permanent=lambda e: isinstance(e, Constraint),
+    )
+    # ワーカーは使わず、flush_once を直接呼ぶ
+    queue._stop.set()
+    queue.start = lambda: None
+    return queue
+
+
+def test_outage_keeps_rows_and_replays_them_as_a_batch(tmp_path):
+    db = FakeDB()
+    queue = _queue(tmp_path, db)
+    for i in range(5):
+        queue.enqueue("k", "t", {"i": i})
+
+    db.down = True
+    for _ in range(50):
+        assert queue.flush_once() == 0
+    assert queue.depth() == 5
+    assert queue.dead_letter_depth() == 0
+
+    db.down = False
+    assert queue.flush_once() == 5
+    assert db.batches == [[0, 1, 2, 3, 4]]
+    assert queue.depth() == 0
+
+
+def test_permanent_error_dead_letters_only_the_bad_row(tmp_path):
+    db = FakeDB()
+    queue = _queue(tmp_path, db)
+    for i in range(8):
+        queue.enqueue("k", "t", {"i": i, "bad": i == 5})
+
+    assert queue.flush_once() == 7
+    assert queue.depth() == 0
+    assert queue.dead_letter_depth() == 1
+    assert sorted(i for batch in db.batches for i in batch) == [0, 1, 2, 3, 4, 6, 7]
+    # 半分ずつに分けて送るので、良い行はまとめて届く
+    assert len(db.batches) <= 4
+
+    assert queue.requeue_dead_letters() == 1
+    assert queue.depth() == 1
+
+
+def test_outage_during_bisect_keeps_the_rest(tmp_path):
+    db = FakeDB()
+    queue = _queue(tmp_path, db)
+    for i in range(4):
+        queue.enqueue("k", "t", {"i": i, "bad": i == 0})
+
+    calls = []
+    original = db.__call__
+
+    def flaky(table_name, payloads):
+        calls.append(len(payloads))
+        if len(calls) == 3:
+            db.down = True
+        return original(table_name, payloads)
+
+    queue.handlers["k"] = flaky
+    queue.flush_once()
+    # 一時的なエラーになった分は dead_letter に移さずに残す
+    assert queue.dead_letter_depth() == 0
+    assert queue.depth() == 4
+
+    db.down = False
+    queue.handlers["k"] = db
+    queue.flush_once()
+    assert queue.dead_letter_depth() == 1
+    assert queue.depth() == 0
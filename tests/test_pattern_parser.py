@@ -0,0 +1,66 @@
+# tests/test_pattern_parser.py
+import pytest
+
+from bench_parser import legacy_parse, load_corpus
+from pattern_parser import (
+    MISSING_PATTERN_TEXT,
+    PatternStreamParser,
+    parse_patterns,
+    split_pattern_blocks,
+)
+
+CORPUS = load_corpus()
+
+# 旧パーサでも正しく読めていた形式（前置き文・太字ラベル・全角コロンのラベルを含まないもの）
+WELL_FORMED = [name for name in CORPUS if name != "preamble_and_bold.md"]
+
+FIELDS = ("subject", "body", "improve", "caution")
+
+
+def _fields(records) -> list:
+    return [{k: r.as_dict()[k] for k in FIELDS} for r in records]
+
+
+@pytest.mark.parametrize("name", WELL_FORMED)
+def test_matches_legacy_parser(name):
+    text = CORPUS[name]
+    assert _fields(parse_patterns(text)) == legacy_parse(text)
+
+
+def test_preamble_and_bold_labels():
+    # 旧パーサは前置き文を1パターン目とみなし、**件名:** の太字も件名に残していた
+    records = parse_patterns(CORPUS["preamble_and_bold.md"])
+
+    assert [r.subject for r in records] == ["新商品のご提案", "新商品「ARKYノート」のご案内", ""]
+    assert records[0].body.startswith("いつもお世話になっております。")
+    assert records[0].improve == "- 商品のメリットを1つ具体的に書くと関心を引きやすくなります。"
+    assert records[1].caution == "- 添付ファイルの容量に注意してください。"
+    assert records[2].body == MISSING_PATTERN_TEXT
+
+
+def test_no_header_becomes_first_pattern_body():
+    records = parse_patterns("見出しのない本文です。")
+    assert records[0].body == "見出しのない本文です。"
+    assert [r.body for r in records[1:]] == [MISSING_PATTERN_TEXT, MISSING_PATTERN_TEXT]
+
+
+@pytest.mark.parametrize("name", sorted(CORPUS))
+@pytest.mark.parametrize("chunk_size", [1, 3, 16, 1024])
+def test_stream_parser_matches_full_parse(name, chunk_size):
+    text = CORPUS[name]
+    parser = PatternStreamParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i : i + chunk_size])
+    blocks = parser.finish()
+
+    assert blocks == split_pattern_blocks(text[text.index("## パターン") :])[:3]
+    assert parser.completed_count == len(blocks)
+
+
+def test_stream_parser_header_split_across_chunks():
+    parser = PatternStreamParser()
+    parser.feed("## パターン1\n件名: A\n本文:\nあ\n## パ")
+    assert parser.completed_count == 0
+    parser.feed("ターン2\n件名: B\n")
+    assert parser.completed_count == 1
+    assert len(parser.blocks) == 2
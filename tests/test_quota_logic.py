@@ -0,0 +1,50 @@
+# tests/test_quota_logic.py
+from quota_logic import MIN_WEIGHT, QuotaTracker
+
+
+def test_quota_exceeded_and_remaining():
+    tracker = QuotaTracker(quota_tokens=1000, window_sec=3600, path="")
+    tracker.record("u1", 400)
+    assert tracker.remaining("u1") == 600
+    assert not tracker.exceeded("u1")
+    assert tracker.weight("u1") == 0.6
+
+    tracker.record("u1", 700)
+    assert tracker.remaining("u1") == 0
+    assert tracker.exceeded("u1")
+    assert tracker.weight("u1") == MIN_WEIGHT
+    # ほかのユーザーの枠には影響しない
+    assert not tracker.exceeded("u2")
+    assert tracker.weight("u2") == 1.0
+
+
+def test_unknown_user_and_unlimited_quota():
+    tracker = QuotaTracker(quota_tokens=0, path="")
+    tracker.record("", 10_000)
+    tracker.record("u1", 10_000)
+    assert tracker.usage_by_user() == {"u1": 10_000}
+    assert tracker.remaining("u1") is None
+    assert not tracker.exceeded("u1")
+    assert tracker.weight("u1") == 1.0
+
+
+def test_usage_outside_window_is_not_counted():
+    tracker = QuotaTracker(quota_tokens=1000, window_sec=3600, path="")
+    tracker.record("u1", 900)
+    # 2時間前のバケットに移す
+    with tracker._lock:
+        bucket = next(iter(tracker._usage["u1"]))
+        tracker._usage["u1"] = {bucket - 7200: 900}
+    assert tracker.used("u1") == 0
+    assert not tracker.exceeded("u1")
+
+
+def test_usage_survives_restart(tmp_path):
+    path = str(tmp_path / "quota.json")
+    tracker = QuotaTracker(quota_tokens=1000, path=path, flush_interval_sec=3600)
+    tracker.record("cookie:abc", 1200)
+    assert tracker.flush()
+
+    restarted = QuotaTracker(quota_tokens=1000, path=path)
+    assert restarted.used("cookie:abc") == 1200
+    assert restarted.exceeded("cookie:abc")
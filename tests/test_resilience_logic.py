@@ -0,0 +1,392 @@
+# tests/test_resilience_logic.py
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from resilience_logic import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Counters,
+    HedgedIterator,
+    RateLimiter,
+    RateLimitExceeded,
+    SingleFlight,
+    call_with_retry,
+)
+
+
+class Retryable(Exception):
+    pass
+
+
+class Fatal(Exception):
+    pass
+
+
+def _call(fn, breaker, counters=None, **kwargs):
+    return call_with_retry(
+        fn,
+        breaker,
+        counters or Counters(),
+        is_retryable=lambda e: isinstance(e, Retryable),
+        backoff_base_sec=0,
+        backoff_max_sec=0,
+        **kwargs,
+    )
+
+
+def _failing(exc, times):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= times:
+            raise exc
+        return "ok"
+
+    return fn, calls
+
+
+# ============================================
+# サーキットブレーカー
+# ============================================
+def test_breaker_opens_after_threshold_and_half_opens():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout_sec=0.05)
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is True
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow_request() is False
+
+    time.sleep(0.06)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # half_open の試行は同時に1件だけ
+    assert breaker.allow_request() is True
+    assert breaker.allow_request() is False
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_half_open_failure_reopens():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow_request() is True
+    assert breaker.record_failure() is True
+    assert breaker.allow_request() is False
+
+
+def test_retry_until_success():
+    counters = Counters()
+    fn, calls = _failing(Retryable(), times=2)
+    assert _call(fn, CircuitBreaker(), counters) == "ok"
+    assert len(calls) == 3
+    assert counters.snapshot()["retries"] == 2
+
+
+def test_retries_exhausted_raises_last_error():
+    fn, calls = _failing(Retryable(), times=10)
+    with pytest.raises(Retryable):
+        _call(fn, CircuitBreaker(failure_threshold=100), max_retries=2)
+    assert len(calls) == 3
+
+
+def test_open_breaker_skips_call_and_before_attempt():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=60)
+    breaker.record_failure()
+    before = []
+    fn, calls = _failing(Retryable(), times=0)
+    with pytest.raises(CircuitOpenError):
+        _call(fn, breaker, before_attempt=lambda: before.append(1))
+    assert calls == [] and before == []
+
+
+def test_non_retryable_error_does_not_touch_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout_sec=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    fn, calls = _failing(Fatal(), times=1)
+    with pytest.raises(Fatal):
+        _call(fn, breaker)
+    assert len(calls) == 1
+    # 成功とも失敗とも数えず、half_open の試行枠だけ返している
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request() is True
+
+
+# ============================================
+# ヘッジ付きイテレータ
+# ============================================
+def _slow(items, first_delay=0.0, delay=0.0):
+    def factory():
+        time.sleep(first_delay)
+        for item in items:
+            yield item
+            time.sleep(delay)
+
+    return factory
+
+
+def test_hedge_passes_items_through_within_budget():
+    hedges = []
+    it = HedgedIterator(_slow(["a", "b"]), 1.0, 5.0, lambda: hedges.append(1))
+    assert list(it) == ["a", "b"]
+    assert hedges == [] and not it.hedged and not it.timed_out
+
+
+def test_hedge_fires_once_when_first_item_is_late():
+    hedges = []
+    it = HedgedIterator(_slow(["a", "b"], first_delay=0.1), 0.02, 5.0, lambda: hedges.append(1))
+    assert list(it) == ["a", "b"]
+    assert hedges == [1] and it.hedged
+
+
+def test_hedge_deadline_stops_iteration():
+    it = HedgedIterator(_slow(["a", "b", "c"], delay=0.2), 0, 0.1)
+    assert list(it) == ["a"]
+    assert it.timed_out and it.hedged
+
+
+def test_hedge_captures_upstream_error():
+    def factory():
+        yield "a"
+        raise RuntimeError("boom")
+
+    hedges = []
+    it = HedgedIterator(factory, 0, 5.0, lambda: hedges.append(1))
+    assert list(it) == ["a"]
+    assert isinstance(it.error, RuntimeError) and hedges == [1]
+
+
+def test_hedge_cancel_event_stops_iteration():
+    cancel = threading.Event()
+    it = HedgedIterator(_slow(["a", "b", "c"], delay=0.2), 0, 5.0, cancel_event=cancel)
+    received = []
+    for item in it:
+        received.append(item)
+        cancel.set()
+    assert received == ["a"] and it.cancelled
+
+
+class _Upstream:
+    """無限に要素を出すジェネレータ。何件読まれたか・close されたかを記録する。"""
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def __call__(self):
+        try:
+            while True:
+                time.sleep(self.delay)
+                self.produced += 1
+                yield self.produced
+        finally:
+            self.closed.set()
+
+
+def _assert_stopped(upstream):
+    assert upstream.closed.wait(1.0)
+    produced = upstream.produced
+    time.sleep(0.1)
+    assert upstream.produced == produced
+
+
+def test_hedge_cancel_closes_upstream():
+    upstream = _Upstream()
+    cancel = threading.Event()
+    it = HedgedIterator(upstream, 0, 5.0, cancel_event=cancel)
+    for item in it:
+        if item == 2:
+            cancel.set()
+    assert it.cancelled
+    _assert_stopped(upstream)
+
+
+def test_hedge_deadline_closes_upstream():
+    upstream = _Upstream()
+    it = HedgedIterator(upstream, 0, 0.1)
+    list(it)
+    assert it.timed_out
+    _assert_stopped(upstream)
+
+
+def test_hedge_consumer_break_closes_upstream():
+    upstream = _Upstream()
+    it = HedgedIterator(upstream, 0, 5.0)
+    for item in it:
+        if item == 2:
+            break
+    _assert_stopped(upstream)
+
+
+# ============================================
+# シングルフライト
+# ============================================
+def _run_concurrently(fn, n):
+    results = [None] * n
+    errors = [None] * n
+    start = threading.Barrier(n)
+
+    def worker(i):
+        start.wait()
+        try:
+            results[i] = fn()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results, errors
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        return "result"
+
+    results, errors = _run_concurrently(lambda: flights.do("k", fn), 5)
+    assert calls == [1]
+    assert errors == [None] * 5
+    assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+    assert {value for value, _ in results} == {"result"}
+
+
+def test_single_flight_shares_errors():
+    flights = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        time.sleep(0.1)
+        raise RuntimeError("upstream failed")
+
+    _, errors = _run_concurrently(lambda: flights.do("k", fn), 4)
+    assert calls == [1]
+    assert all(isinstance(e, RuntimeError) for e in errors)
+
+
+def test_single_flight_does_not_remember_finished_calls():
+    flights = SingleFlight()
+    assert flights.do("k", lambda: 1) == (1, False)
+    assert flights.do("k", lambda: 2) == (2, False)
+
+
+def _in_thread(fn) -> Future:
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(fn)
+    pool.shutdown(wait=False)
+    return future
+
+
+def _stream(items, delay, calls):
+    def factory():
+        calls.append(1)
+        for item in items:
+            time.sleep(delay)
+            yield item
+
+    return factory
+
+
+def test_single_flight_iterate_replays_items_to_late_joiner():
+    flights = SingleFlight()
+    calls = []
+    shared = []
+    factory = _stream(["a", "b", "c"], 0.05, calls)
+
+    leader = flights.iterate("k", factory)
+    assert next(leader) == "a"
+    follower = _in_thread(lambda: list(flights.iterate("k", factory, lambda: shared.append(1))))
+    assert list(leader) == ["b", "c"]
+    assert follower.result(2) == ["a", "b", "c"]
+    assert calls == [1] and shared == [1]
+
+
+def test_single_flight_iterate_leader_abort_hands_off_to_follower():
+    flights = SingleFlight()
+    calls = []
+    factory = _stream(["a", "b", "c"], 0.05, calls)
+
+    leader = flights.iterate("k", factory)
+    assert next(leader) == "a"
+    follower = _in_thread(lambda: list(flights.iterate("k", factory)))
+    time.sleep(0.05)
+    leader.close()
+    # 相乗りしていた側が同じ上流を最後まで読む（上流は1回しか呼ばない）
+    assert follower.result(2) == ["a", "b", "c"]
+    assert len(calls) == 1
+
+
+def test_single_flight_iterate_leader_abort_without_followers_closes_upstream():
+    flights = SingleFlight()
+    closed = []
+
+    def factory():
+        try:
+            yield from ["a", "b"]
+        finally:
+            closed.append(1)
+
+    leader = flights.iterate("k", factory)
+    assert next(leader) == "a"
+    leader.close()
+    assert closed == [1]
+    # 次の呼び出しは新しく上流を回す
+    assert list(flights.iterate("k", factory)) == ["a", "b"]
+
+
+# ============================================
+# レート制限（トークンバケット）
+# ============================================
+def test_rate_limiter_disabled_never_waits():
+    limiter = RateLimiter(0, 0)
+    assert not limiter.enabled
+    assert all(limiter.acquire(10_000) == 0 for _ in range(100))
+
+
+def test_rate_limiter_burst_then_blocks_until_refill():
+    # 10 リクエスト／秒・バケットは 0.2 秒分（2件）
+    limiter = RateLimiter(requests_per_min=600, tokens_per_min=0, burst_sec=0.2)
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 0
+    started = time.monotonic()
+    waited = limiter.acquire()
+    assert 0.05 < waited <= 0.11
+    assert time.monotonic() - started >= waited * 0.9
+
+
+def test_rate_limiter_refills_over_time():
+    limiter = RateLimiter(requests_per_min=600, tokens_per_min=0, burst_sec=0.1)
+    limiter.acquire()
+    time.sleep(0.12)
+    assert limiter.acquire() == 0
+
+
+def test_rate_limiter_token_bucket_and_max_wait():
+    # 10 トークン／秒・容量 10。待ちが max_wait_sec を超える呼び出しは予約せずに断る
+    limiter = RateLimiter(requests_per_min=0, tokens_per_min=600, burst_sec=1, max_wait_sec=0.2)
+    assert limiter.acquire(10) == 0
+    before = limiter.snapshot()["tokens_available"]
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(5)
+    assert limiter.snapshot()["tokens_available"] == pytest.approx(before, abs=0.5)
+    assert 0 < limiter.acquire(1) <= 0.2
+
+
+def test_rate_limiter_serves_waiters_in_arrival_order():
+    limiter = RateLimiter(requests_per_min=600, tokens_per_min=0, burst_sec=0.1)
+    limiter.acquire()
+    results, errors = _run_concurrently(limiter.acquire, 3)
+    assert errors == [None] * 3
+    # 予約方式なので、同時に来た3件は 0.1 秒ずつずれて通る
+    assert sorted(round(w, 1) for w in results) == [0.1, 0.2, 0.3]
@@ -0,0 +1,70 @@
+# tests/test_similar_logic.py
+from id_logic import IdGenerator
+from similar_logic import SimilarRequestIndex
+
+PATTERNS = [{"subject": "件名", "body": "本文"}]
+MESSAGE = "来週の会議室の予約を変更したいです"
+
+
+def _ids(n):
+    gen = IdGenerator(node_id=1)
+    return [gen.next_id() for _ in range(n)]
+
+
+def test_find_similar_ignores_punctuation_differences():
+    index = SimilarRequestIndex()
+    (gid,) = _ids(1)
+    index.add(gid, "依頼", "標準ビジネス", "社内", False, MESSAGE, PATTERNS)
+
+    match = index.find_similar("依頼", "標準ビジネス", "社内", False, MESSAGE + "。")
+    assert match is not None
+    assert match.generatedid == gid
+
+
+def test_find_similar_requires_same_seasonal_flag():
+    index = SimilarRequestIndex()
+    (gid,) = _ids(1)
+    index.add(gid, "依頼", "標準ビジネス", "社内", False, MESSAGE, PATTERNS)
+
+    # 時候の挨拶を入れる依頼に、入れずに作った結果を返さない
+    assert index.find_similar("依頼", "標準ビジネス", "社内", True, MESSAGE) is None
+
+
+def test_load_rows_reads_seasonal_flag():
+    index = SimilarRequestIndex()
+    (gid,) = _ids(1)
+    index.load_rows(
+        [
+            {
+                "generatedid": gid,
+                "pattern_index": 1,
+                "template": "依頼",
+                "tone": "標準ビジネス",
+                "recipient": "社内",
+                "seasonal_greeting": True,
+                "user_message": MESSAGE,
+                "subject": "件名",
+                "body": "本文",
+            }
+        ]
+    )
+
+    assert index.find_similar("依頼", "標準ビジネス", "社内", False, MESSAGE) is None
+    assert index.find_similar("依頼", "標準ビジネス", "社内", True, MESSAGE).generatedid == gid
+
+
+def test_index_evicts_oldest_groups_beyond_max_groups():
+    index = SimilarRequestIndex(max_groups=2)
+    old, mid, new = _ids(3)
+    index.add(mid, "依頼", "標準ビジネス", "社内", False, MESSAGE, PATTERNS)
+    index.add(old, "依頼", "標準ビジネス", "社内", False, MESSAGE, PATTERNS)
+    index.add(new, "依頼", "標準ビジネス", "社内", False, MESSAGE, PATTERNS)
+
+    assert len(index) == 2
+    # LSH のバケットからも消えている
+    assert {gid for band in index._buckets for ids in band.values() for gid in ids} == {mid, new}
+    assert index.find_similar("依頼", "標準ビジネス", "社内", False, MESSAGE).generatedid == new
+
+    # 手元のどれよりも古いグループは入れない
+    index.add(old, "依頼", "標準ビジネス", "社内", False, MESSAGE, PATTERNS)
+    assert len(index) == 2
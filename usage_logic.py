@@ -0,0 +1,195 @@
+# usage_logic.py
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List
+
+# ============================================
+# 設定（環境変数で上書き可能）
+# ============================================
+# 呼び出しごとの使用量を JSONL で追記するファイル（空なら書かない）
+# bench/usage_report.py でキャッシュヒット率・生成1回あたりのコストを集計できる
+USAGE_LOG_PATH = os.getenv("ARKY_USAGE_LOG", "")
+
+# プロセス内で覚えておく生成（generation_id）の数
+USAGE_MAX_GENERATIONS = int(os.getenv("ARKY_USAGE_MAX_GENERATIONS", "1000"))
+
+# 100万トークンあたりの料金（USD）：(入力, キャッシュ済み入力, 出力)
+PRICES_PER_1M_TOKENS = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+
+def new_generation_id() -> str:
+    """1回の生成（送信1回ぶん。並列生成・修復の呼び出しもまとめる）の ID。"""
+    return uuid.uuid4().hex[:12]
+
+
+def estimate_cost_usd(
+    model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int
+) -> float | None:
+    """料金表にあるモデルなら概算コスト（USD）、無ければ None。"""
+    prices = PRICES_PER_1M_TOKENS.get(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (
+        uncached * input_price + cached_tokens * cached_price + completion_tokens * output_price
+    ) / 1_000_000
+
+
+@dataclass
+class UsageRecord:
+    """chat.completions 1回分の使用量。"""
+
+    ts: float
+    generation_id: str
+    kind: str
+    model: str
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def usage_record_from(usage, generation_id: str, kind: str, model: str) -> UsageRecord | None:
+    """
+    OpenAI のレスポンス（またはストリームの最終チャンク）の usage から UsageRecord を作る。
+    usage が無い（古い SDK・スタブなど）場合は None。
+    """
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    return UsageRecord(
+        ts=time.time(),
+        generation_id=generation_id,
+        kind=kind,
+        model=model,
+        prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+        cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+        completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+    )
+
+
+def summarize(records: Iterable[UsageRecord]) -> dict:
+    """
+    使用量を集計する。
+
+    - cache_hit_rate : 入力トークンのうちキャッシュ済みだった割合
+    - cost_per_generation_usd : 生成（generation_id）1回あたりの平均コスト
+    - by_kind : 呼び出しの種類（stream / full / pattern / structured / repair）ごとの内訳
+    """
+    totals = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    by_kind: Dict[str, dict] = {}
+    generations = set()
+    cost = 0.0
+    cost_known = True
+
+    for r in records:
+        generations.add(r.generation_id)
+        kind = by_kind.setdefault(r.kind, {k: 0 for k in totals})
+        for bucket in (totals, kind):
+            bucket["calls"] += 1
+            bucket["prompt_tokens"] += r.prompt_tokens
+            bucket["cached_tokens"] += r.cached_tokens
+            bucket["completion_tokens"] += r.completion_tokens
+        record_cost = estimate_cost_usd(
+            r.model, r.prompt_tokens, r.cached_tokens, r.completion_tokens
+        )
+        if record_cost is None:
+            cost_known = False
+        else:
+            cost += record_cost
+
+    summary = dict(totals)
+    summary["generations"] = len(generations)
+    summary["cache_hit_rate"] = (
+        totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+    )
+    summary["cost_usd"] = cost if cost_known else None
+    summary["cost_per_generation_usd"] = (
+        cost / len(generations) if cost_known and generations else None
+    )
+    summary["by_kind"] = by_kind
+    return summary
+
+
+def format_report(summary: dict) -> str:
+    """summarize() の結果を人が読む形の表にする。"""
+    lines = [
+        f"generations          : {summary['generations']}",
+        f"calls                : {summary['calls']}",
+        f"prompt tokens        : {summary['prompt_tokens']}",
+        f"  cached             : {summary['cached_tokens']} "
+        f"({summary['cache_hit_rate']:.1%})",
+        f"completion tokens    : {summary['completion_tokens']}",
+    ]
+    if summary["cost_usd"] is not None:
+        lines.append(f"cost (USD)           : {summary['cost_usd']:.6f}")
+        if summary["cost_per_generation_usd"] is not None:
+            lines.append(f"cost / generation    : {summary['cost_per_generation_usd']:.6f}")
+    else:
+        lines.append("cost (USD)           : 料金表に無いモデルが含まれるため省略")
+
+    if summary["by_kind"]:
+        lines.append("")
+        lines.append(f"{'kind':<12}{'calls':>7}{'prompt':>10}{'cached':>10}{'hit':>8}{'output':>10}")
+        for kind, k in sorted(summary["by_kind"].items()):
+            hit = k["cached_tokens"] / k["prompt_tokens"] if k["prompt_tokens"] else 0.0
+            lines.append(
+                f"{kind:<12}{k['calls']:>7}{k['prompt_tokens']:>10}{k['cached_tokens']:>10}"
+                f"{hit:>8.1%}{k['completion_tokens']:>10}"
+            )
+    return "\n".join(lines)
+
+
+def load_usage_log(path: str) -> List[UsageRecord]:
+    """ARKY_USAGE_LOG の JSONL を読み込む（壊れた行は飛ばす）。"""
+    records: List[UsageRecord] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(UsageRecord(**json.loads(line)))
+            except (json.JSONDecodeError, TypeError):
+                continue
+    return records
+
+
+class UsageLedger:
+    """
+    プロセス全体の使用量の記録。スレッドセーフ。
+    直近 max_generations 回分の生成を覚えておき、それより古いものは捨てる。
+    """
+
+    def __init__(self, max_generations: int = USAGE_MAX_GENERATIONS, log_path: str = USAGE_LOG_PATH):
+        self.max_generations = max_generations
+        self.log_path = log_path
+        self._generations: "OrderedDict[str, List[UsageRecord]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, record: UsageRecord | None) -> None:
+        if record is None:
+            return
+        with self._lock:
+            self._generations.setdefault(record.generation_id, []).append(record)
+            self._generations.move_to_end(record.generation_id)
+            while len(self._generations) > self.max_generations:
+                self._generations.popitem(last=False)
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(asdict(record), ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print(f"[usage] 使用量ログを書き込めませんでした: {e}")
+
+    def records(self) -> List[UsageRecord]:
+        with self._lock:
+            return [r for records in self._generations.values() for r in records]
+
+    def summary(self) -> dict:
+        return summarize(self.records())